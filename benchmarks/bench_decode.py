@@ -0,0 +1,86 @@
+"""
+録音したパケットのデコードの速度を、パケットごとにexecutorに渡す方法と話者ごとにまとめて渡す方法で比較します。
+libopusが必要です。
+
+    python -m benchmarks.bench_decode
+"""
+from functools import partial
+import asyncio
+import time
+
+import numpy as np
+from discord.opus import Encoder
+
+from lib.discord.buffer_decoder import BufferDecoder, decode_into
+from lib.discord.jitter import JitterBuffer
+from lib.discord.opus import Decoder, _load_default
+from lib.timeline import Timeline
+
+SECONDS = 60
+SPEAKERS = (1, 5)
+
+
+class Packet:
+    def __init__(self, ssrc: int, seq: int, timestamp: int, real_time: float, decrypted: bytes) -> None:
+        self.ssrc = ssrc
+        self.seq = seq
+        self.timestamp = timestamp
+        self.real_time = real_time
+        self.decrypted = decrypted
+
+
+def encode_packets() -> list:
+    encoder = Encoder()
+    t = np.arange(48000 * SECONDS) / 48000
+    pcm = (np.sin(2 * np.pi * 440 * t) * 8000).astype("<i2").repeat(2).tobytes()
+    return [encoder.encode(pcm[i:i + Encoder.FRAME_SIZE], Encoder.SAMPLES_PER_FRAME) for i in range(0, len(pcm), Encoder.FRAME_SIZE)]
+
+
+async def per_packet(decoder: BufferDecoder, speakers: int, frames: list) -> None:
+    # 以前のdecode_oneと同じく、パケットごとにexecutorに渡す
+    async def decode(ssrc: int) -> None:
+        opus = Decoder()
+        timeline = Timeline()
+        for frame in frames:
+            await decoder.loop.run_in_executor(decoder.executor, partial(decode_into, timeline, opus, frame))
+
+    await asyncio.gather(*[decode(ssrc) for ssrc in range(speakers)])
+
+
+async def batched(decoder: BufferDecoder, speakers: int, frames: list) -> None:
+    # decode_to_pcmと同じく、話者ごとに1回だけexecutorに渡す
+    start = time.time()
+    queues = []
+    for ssrc in range(speakers):
+        queue = JitterBuffer()
+        for seq, frame in enumerate(frames):
+            queue.push(Packet(ssrc, seq % 65536, seq * 960, start + seq * 0.02, frame))
+        queues.append(queue)
+    await asyncio.gather(*[
+        decoder.loop.run_in_executor(decoder.executor, partial(decoder.decode_one, queue)) for queue in queues
+    ])
+
+
+async def measure(fn, *args) -> float:
+    start = time.perf_counter()
+    await fn(*args)
+    return time.perf_counter() - start
+
+
+async def main() -> None:
+    if not _load_default():
+        print("libopusが見つかりません")
+        return
+    frames = encode_packets()
+    decoder = BufferDecoder(asyncio.get_running_loop())
+    print(f"{SECONDS}秒の録音をデコード(packets/s)")
+    print(f"{'speakers':>8} {'per packet':>12} {'batched':>12}")
+    for speakers in SPEAKERS:
+        count = len(frames) * speakers
+        before = await measure(per_packet, decoder, speakers, frames)
+        after = await measure(batched, decoder, speakers, frames)
+        print(f"{speakers:>8} {count / before:>12.0f} {count / after:>12.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
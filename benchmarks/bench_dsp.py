@@ -0,0 +1,75 @@
+"""
+lib.dspとaudioopのPCM変換の速度を比較します。
+まとめて変換する場合と、再生中と同じく20msずつ変換する場合を測ります。
+
+    python -m benchmarks.bench_dsp
+"""
+import time
+import warnings
+
+import numpy as np
+
+from lib.dsp import Converter, convert
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop
+    except ImportError:  # Python 3.13以降
+        audioop = None
+
+SECONDS = 30
+BLOCK_SECONDS = 0.02
+
+
+def audioop_convert(pcm: bytes, rate: int, channels: int) -> bytes:
+    if channels == 1:
+        pcm = audioop.tostereo(pcm, 2, 1, 1)
+    if rate != 48000:
+        pcm = audioop.ratecv(pcm, 2, 2, rate, 48000, None)[0]
+    return pcm
+
+
+def audioop_blocks(pcm: bytes, rate: int, channels: int) -> None:
+    step = int(rate * BLOCK_SECONDS) * channels * 2
+    state = None
+    for i in range(0, len(pcm), step):
+        block = pcm[i:i + step]
+        if channels == 1:
+            block = audioop.tostereo(block, 2, 1, 1)
+        if rate != 48000:
+            block, state = audioop.ratecv(block, 2, 2, rate, 48000, state)
+        audioop.mul(block, 2, 0.8)
+
+
+def dsp_blocks(pcm: bytes, rate: int, channels: int) -> None:
+    step = int(rate * BLOCK_SECONDS) * channels * 2
+    # 再生するときと同じく音量も変える
+    converter = Converter(rate, channels, gain=0.8)
+    for i in range(0, len(pcm), step):
+        converter.convert(pcm[i:i + step])
+
+
+def measure(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    rng = np.random.default_rng(0)
+    print(f"{SECONDS}秒のPCMを48kHz・ステレオに変換")
+    print(f"{'input':>16} {'audioop':>10} {'lib.dsp':>10} {'audioop 20ms':>13} {'lib.dsp 20ms':>13}")
+    for rate in (48000, 44100, 22050):
+        for channels in (1, 2):
+            pcm = (rng.standard_normal(rate * SECONDS * channels) * 3000).astype("<i2").tobytes()
+            dsp_time = measure(convert, pcm, rate, channels, 2)
+            audioop_time = measure(audioop_convert, pcm, rate, channels) if audioop is not None else float("nan")
+            dsp_block_time = measure(dsp_blocks, pcm, rate, channels)
+            audioop_block_time = measure(audioop_blocks, pcm, rate, channels) if audioop is not None else float("nan")
+            print(f"{rate:>10}Hz {channels}ch {audioop_time:>9.3f}s {dsp_time:>9.3f}s "
+                  f"{audioop_block_time:>12.3f}s {dsp_block_time:>12.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+話者のPCMのミックスを、サンプルごとのPythonのループとlib.dsp.mixで比較します。
+
+    python -m benchmarks.bench_mixer
+"""
+from itertools import zip_longest
+import time
+
+import numpy as np
+
+from lib.dsp import mix
+
+SECONDS = 5
+SPEAKERS = (1, 5, 15)
+
+
+def python_mix(tracks: list) -> list:
+    """
+    以前のBufferDecoderと同じ、サンプルごとに重ね合わせる実装
+    """
+    result_list = []
+    for samples in zip_longest(*tracks):
+        result = 0
+        for b in samples:
+            if b is None:
+                continue
+            if result < 0 and b < 0:
+                result = result + b - (result * b * -1)
+            elif result > 0 and b > 0:
+                result = result + b - (result * b)
+            else:
+                result = result + b
+        result_list.append(min(max(result, -1), 1))
+    return result_list
+
+
+def measure(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    rng = np.random.default_rng(0)
+    print(f"{SECONDS}秒・ステレオのPCMをミックス")
+    print(f"{'speakers':>8} {'python':>10} {'lib.dsp':>10} {'speedup':>8}")
+    for speakers in SPEAKERS:
+        tracks = [
+            (rng.standard_normal(48000 * 2 * SECONDS) * 0.2).clip(-1, 1).astype(np.float32)
+            for _ in range(speakers)
+        ]
+        lists = [track.tolist() for track in tracks]
+        python_time = measure(python_mix, lists)
+        numpy_time = measure(mix, tracks)
+        assert np.allclose(mix(tracks), python_mix(lists), atol=1e-5)
+        print(f"{speakers:>8} {python_time:>9.3f}s {numpy_time:>9.4f}s {python_time / numpy_time:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+音声の受信処理(復号とRTPのパース)の1コアあたりのpackets/sを、以前の実装と比較します。
+
+    python -m benchmarks.bench_receive
+"""
+import struct
+import time
+
+import nacl.secret
+import nacl.utils
+
+from lib.discord.buffer_decoder import RTPPacket
+from lib.discord.websocket import MiniMaidVoiceWebSocket
+
+PACKETS = 50000
+MODES = ("xsalsa20_poly1305", "xsalsa20_poly1305_suffix", "xsalsa20_poly1305_lite")
+
+
+class LegacyRTPPacket:
+    def __init__(self, header: bytes, decrypted: bytes):
+        self.version = (header[0] & 0b11000000) >> 6
+        self.padding = (header[0] & 0b00100000) >> 5
+        self.extend = (header[0] & 0b00010000) >> 4
+        self.cc = header[0] & 0b00001111
+        self.marker = header[1] >> 7
+        self.payload_type = header[1] & 0b01111111
+        self.offset = 0
+        self.ext_length = None
+        self.ext_header = None
+        self.csrcs = None
+        self.profile = None
+        self.real_time = None
+        self.header = header
+        self.decrypted = decrypted
+        self.seq, self._timestamp, self.ssrc = struct.unpack_from('>HII', header, 2)
+
+    calc_extention_header_length = RTPPacket.calc_extention_header_length
+
+
+class LegacyDecryptor:
+    """
+    以前のMiniMaidVoiceWebSocketと同じく、パケットごとにnonceのbytearrayを作って復号する
+    """
+    def __init__(self, box: nacl.secret.SecretBox, mode: str) -> None:
+        self.box = box
+        self.mode = mode
+
+    def decrypt_xsalsa20_poly1305(self, data: bytes) -> tuple:
+        header, encrypted = data[:12], data[12:]
+        nonce = bytearray(24)
+        nonce[:12] = header
+        return header, self.box.decrypt(bytes(encrypted), bytes(nonce))
+
+    def decrypt_xsalsa20_poly1305_suffix(self, data: bytes) -> tuple:
+        header, encrypted, nonce = data[:12], data[12:-24], data[-24:]
+        return header, self.box.decrypt(bytes(encrypted), bytes(nonce))
+
+    def decrypt_xsalsa20_poly1305_lite(self, data: bytes) -> tuple:
+        header, encrypted, _nonce = data[:12], data[12:-4], data[-4:]
+        nonce = bytearray(24)
+        nonce[:4] = _nonce
+        return header, self.box.decrypt(bytes(encrypted), bytes(nonce))
+
+
+def make_packets(box: nacl.secret.SecretBox, mode: str) -> list:
+    packets = []
+    for seq in range(PACKETS):
+        header = struct.pack('>BBHII', 0x90, 0x78, seq % 65536, seq * 960, 1)
+        # Discordと同じく1バイトのヘッダー拡張のあとにOpusのパケットが続く
+        payload = b"\xbe\xde\x00\x01\x10\xff\x90\x00" + bytes([0xfc]) + nacl.utils.random(80)
+        if mode == "xsalsa20_poly1305":
+            nonce = header + bytes(12)
+            packets.append(header + box.encrypt(payload, nonce).ciphertext)
+        elif mode == "xsalsa20_poly1305_suffix":
+            nonce = nacl.utils.random(24)
+            packets.append(header + box.encrypt(payload, nonce).ciphertext + nonce)
+        else:
+            counter = struct.pack('>I', seq)
+            packets.append(header + box.encrypt(payload, counter + bytes(20)).ciphertext + counter)
+    return packets
+
+
+def legacy(decryptor: LegacyDecryptor, packets: list) -> None:
+    for recv in packets:
+        decrypt_fn = getattr(decryptor, f'decrypt_{decryptor.mode}')
+        header, data = decrypt_fn(recv)
+        packet = LegacyRTPPacket(header, data)
+        packet.calc_extention_header_length(data)
+        packet.real_time = time.time()
+
+
+def current(ws: MiniMaidVoiceWebSocket, packets: list) -> None:
+    decryptor = getattr(ws, f'decrypt_{ws._connection.mode}')
+    for recv in packets:
+        header, data = decryptor(recv)
+        packet = RTPPacket(header, data)
+        packet.calc_extention_header_length(data)
+        packet.real_time = time.time()
+
+
+def measure(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return PACKETS / (time.perf_counter() - start)
+
+
+def main() -> None:
+    box = nacl.secret.SecretBox(nacl.utils.random(32))
+    ws = MiniMaidVoiceWebSocket.__new__(MiniMaidVoiceWebSocket)
+    ws.box = box
+    print("受信したパケットの復号とパース(packets/s)")
+    print(f"{'mode':>26} {'before':>10} {'after':>10}")
+    for mode in MODES:
+        packets = make_packets(box, mode)
+        ws._connection = type("Connection", (), {"mode": mode})()
+        before = measure(legacy, LegacyDecryptor(box, mode), packets)
+        after = measure(current, ws, packets)
+        print(f"{mode:>26} {before:>10.0f} {after:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
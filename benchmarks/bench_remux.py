@@ -0,0 +1,43 @@
+"""
+リプレイを話者ごとのOgg Opusにするときの時間とファイルの大きさを、ミックスしたwavの大きさと比較します。
+Opusのパケットはデコードしないので、libopusがなくても実行できます。
+
+    python -m benchmarks.bench_remux
+"""
+import os
+import time
+
+from lib.discord.journal import JournalPacket
+from lib.discord.remux import remux
+
+SECONDS = 30
+SPEAKERS = (1, 5, 15)
+PACKET_SIZE = 120  # 64kbpsの20msのパケットとほぼ同じ大きさ
+WAV_SIZE = 48000 * 2 * 2 * SECONDS + 44
+
+
+def make_packets(speakers: int) -> list:
+    packets = []
+    for ssrc in range(speakers):
+        for i in range(SECONDS * 50):
+            if i % 200 >= 150:
+                continue  # 話していない間はパケットが届かない
+            payload = bytes([31 << 3]) + os.urandom(PACKET_SIZE - 1)
+            packets.append(JournalPacket(ssrc, i % 65536, i * 960, 1000.0 + i * 0.02, payload))
+    return packets
+
+
+def main() -> None:
+    print(f"{SECONDS}秒のリプレイ(wavは{WAV_SIZE / 1024 ** 2:.2f}MB)")
+    print(f"{'speakers':>8} {'packets/s':>10} {'ogg total':>10}")
+    for speakers in SPEAKERS:
+        packets = make_packets(speakers)
+        start = time.perf_counter()
+        tracks = remux(packets)
+        elapsed = time.perf_counter() - start
+        size = sum(file.getbuffer().nbytes for _, file in tracks)
+        print(f"{speakers:>8} {len(packets) / elapsed:>10.0f} {size / 1024 ** 2:>8.2f}MB")
+
+
+if __name__ == "__main__":
+    main()
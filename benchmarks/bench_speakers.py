@@ -0,0 +1,55 @@
+"""
+話者の数を増やしたときのミックスの時間を測ります。
+話者はそれぞれ一部の時間だけ話しているものとし、上限なしの場合とVOICE_MAX_SPEAKERSで選んだ場合、
+話している区間だけを持つタイムラインをミックスした場合を比較します。
+
+    python -m benchmarks.bench_speakers
+"""
+from typing import List, Tuple
+import time
+
+import numpy as np
+
+from lib.discord.activity import MAX_SPEAKERS, select_segments, select_tracks
+from lib.dsp import mix
+from lib.timeline import Segment, mix_segments
+
+SECONDS = 30
+SPEAKERS = (5, 15, 50, 100)
+TALKING = 0.15  # 話している時間の割合
+
+
+def make_track(rng: np.random.Generator) -> Tuple[np.ndarray, List[Segment]]:
+    track = np.zeros((48000 * SECONDS, 2), dtype=np.float32)
+    segments = []
+    position = 0
+    while position < len(track):
+        length = int(rng.uniform(0.5, 4) * 48000)
+        if rng.random() < TALKING:
+            track[position:position + length] = rng.standard_normal((min(length, len(track) - position), 1)) * 0.1
+            segments.append((position, track[position:position + length]))
+        position += length
+    return track, segments
+
+
+def measure(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    rng = np.random.default_rng(0)
+    print(f"{SECONDS}秒・ステレオのPCMをミックス(話している時間{TALKING:.0%})")
+    print(f"{'speakers':>8} {'dense':>9} {'sparse':>9} {f'top {MAX_SPEAKERS}':>9} {'timeline':>9}")
+    for speakers in SPEAKERS:
+        tracks, timelines = zip(*[make_track(rng) for _ in range(speakers)])
+        dense = measure(mix, tracks, 10 ** 9)
+        sparse = measure(mix, tracks)
+        capped = measure(lambda: mix(select_tracks(list(tracks))))
+        segments = measure(lambda: mix_segments(select_segments(list(timelines)), 48000 * SECONDS))
+        print(f"{speakers:>8} {dense:>8.3f}s {sparse:>8.3f}s {capped:>8.3f}s {segments:>8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+UDPの受信でイベントループにかかるCPU時間を、パケットごとのsock_recvとadd_readerでまとめて読む方法で比較します。
+多くのサーバーで録音している状況として、20msごとに複数のパケットがまとめて届くようにします。
+
+    python -m benchmarks.bench_udp
+"""
+from typing import Callable, List
+import asyncio
+import multiprocessing
+import socket
+import time
+
+TICKS = 250  # 5秒
+BURSTS = (1, 10, 50)  # 20msごとに届くパケットの数
+PACKET = bytes([0x90, 0x78]) + bytes(118)
+
+
+def make_socket() -> socket.socket:
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.setblocking(False)
+    return receiver
+
+
+def send(address: tuple, burst: int) -> None:
+    # 受信側のCPU時間だけを測るため、別のプロセスで送信する
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(address)
+    for _ in range(TICKS):
+        for _ in range(burst):
+            sender.send(PACKET)
+        time.sleep(0.02)
+    sender.close()
+
+
+async def wait_sender(address: tuple, burst: int) -> None:
+    process = multiprocessing.Process(target=send, args=(address, burst))
+    process.start()
+    await asyncio.get_running_loop().run_in_executor(None, process.join)
+    await asyncio.sleep(0.05)
+
+
+async def per_packet(receiver: socket.socket, burst: int, handle: Callable) -> None:
+    loop = asyncio.get_running_loop()
+
+    async def receive() -> None:
+        while True:
+            handle([await loop.sock_recv(receiver, 2 ** 16)])
+
+    task = loop.create_task(receive())
+    await wait_sender(receiver.getsockname(), burst)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+async def batched(receiver: socket.socket, burst: int, handle: Callable) -> None:
+    loop = asyncio.get_running_loop()
+
+    def on_readable() -> None:
+        batch = []
+        for _ in range(256):
+            try:
+                batch.append(receiver.recv(2 ** 16))
+            except BlockingIOError:
+                break
+        handle(batch)
+
+    loop.add_reader(receiver.fileno(), on_readable)
+    await wait_sender(receiver.getsockname(), burst)
+    loop.remove_reader(receiver.fileno())
+
+
+async def measure(fn: Callable, burst: int) -> tuple:
+    receiver = make_socket()
+    received: List[int] = [0]
+
+    def handle(batch: list) -> None:
+        received[0] += len(batch)
+
+    start = time.process_time()
+    await fn(receiver, burst, handle)
+    elapsed = time.process_time() - start
+    receiver.close()
+    return elapsed / (TICKS * burst) * 10 ** 6, received[0]
+
+
+async def main() -> None:
+    print("受信したパケット1つあたりの受信側のCPU時間")
+    print(f"{'packets/20ms':>12} {'sock_recv':>12} {'add_reader':>12}")
+    for burst in BURSTS:
+        before, before_count = await measure(per_packet, burst)
+        after, after_count = await measure(batched, burst)
+        assert before_count == after_count == TICKS * burst
+        print(f"{burst:>12} {before:>10.1f}us {after:>10.1f}us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
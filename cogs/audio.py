@@ -1,10 +1,13 @@
-from typing import TYPE_CHECKING, Optional, List, Dict
-from collections import defaultdict
+from typing import TYPE_CHECKING, Optional, List, Dict, Set, Tuple, Union
 import asyncio
+import logging
 import re
 from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED
 from uuid import uuid4
+from collections import Counter
 from datetime import datetime
+from functools import partial
 import os
 
 from discord.ext.commands import (
@@ -18,46 +21,76 @@ from discord.ext.commands import (
     is_owner
 )
 import discord
-import aiohttp
 from sqlalchemy.exc import IntegrityError
-from pydub import AudioSegment
 
 from lib.context import Context
 from lib.checks import user_connected_only, bot_connected_only, voice_channel_only
-from lib.audio import AudioEngine
+from lib.audio import AudioEngine, FILESIZE_LIMIT, EXTENSIONS
+from lib.audio_queue import AudioQueue, Track, MAX_QUEUE_SIZE
+from lib.errors import MiniMaidException, AudioFileNotFound, AudioFileTooLarge, SeekFailed
 from lib.database.models import AudioTag
 from lib.database.query import select_audio_tag, select_audio_tags
 from lib.discord.voice_client import MiniMaidVoiceClient
+from lib.discord.journal import JOURNAL_DIR
+from lib.discord.recorder import render_journal, render_tracks
+from lib.discord.remux import remux_journal
+from lib.discord.ring_buffer import REPLAY_SECONDS
 
 if TYPE_CHECKING:
     from bot import MiniMaid
 
+logger = logging.getLogger(__name__)
+
+RECORD_LIMIT = 5
+MULTITRACK_MODES = ("multi", "multitrack", "tracks")
+TRIM_MODES = ("trim", "compact")  # 誰も話していない部分を詰める
+OGG_MODES = ("ogg", "opus")  # デコードせずに話者ごとのOgg Opusにする
+MIXED_OGG_MODES = ("all", "both")  # 話者ごとのOgg Opusとミックスしたwavの両方
+MAX_ATTACHMENTS = 10
 url_compiled = re.compile(r"^https?://[\w!?/+\-_~=;.,*&@#$%()'\[\]]+$")
-FILESIZE_LIMIT = 25 * 10 ** 6
+time_compiled = re.compile(r"^(?:(\d+):)?(\d+(?:\.\d+)?)(?:s|秒)?$")
+
+
+def parse_time(text: str) -> Optional[float]:
+    """
+    `23`、`23s`、`1:23`の形式の時間を秒に変換します。
+
+    :param text: 変換する文字列
+    :return: 秒数。形式が正しくない場合はNone
+    """
+    match = time_compiled.match(text)
+    if match is None:
+        return None
+    minutes, seconds = match.groups()
+    return int(minutes or 0) * 60 + float(seconds)
+
+
+def tag_filename(name: str, audio_url: str) -> str:
+    return f"{name}.{audio_url.split('.')[-1]}"
 
 
 class TagAttachment:
     def __init__(self, audio_tag: AudioTag):
         self.tag = audio_tag
         self.filetype = audio_tag.audio_url.split(".")[-1]
-        self.filename = f"{self.tag.name}.{self.filetype}"
+        self.filename = tag_filename(self.tag.name, self.tag.audio_url)
         self.url = self.tag.audio_url
-
-    async def read(self) -> bytes:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.tag.audio_url) as response:
-                return await response.read()
+        self.gain = self.tag.gain
 
 
 class AudioBase(Cog):
     def __init__(self, bot: 'MiniMaid') -> None:
         self.bot = bot
         self.connecting_guilds: List[int] = []
-        self.locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
         self.engine = AudioEngine(self.bot.loop)
+        self.queues: Dict[int, AudioQueue] = {}
+        self.transcoding: Set[str] = set()
         self.recording_guilds: List[int] = []
         self.invent_mode = False if os.environ.get("INVENT", "0") == "0" else True
 
+    def cog_unload(self) -> None:
+        self.bot.loop.create_task(self.engine.close())
+
     @command()
     @is_owner()
     async def invent_mode(self, ctx: Context) -> None:
@@ -132,25 +165,25 @@ class AudioCommandMixin(AudioBase):
 
         if ctx.message.attachments:
             attachment = ctx.message.attachments[0]
-            if attachment.filename.endswith((".mp3", ".wav")):
+            if attachment.filename.endswith(EXTENSIONS):
                 if attachment.size > FILESIZE_LIMIT:
                     await ctx.error("ファイルサイズがデカすぎます。25MB以内にしてください。")
                     return ctx.command.reset_cooldown(ctx)
                 file = attachment
             else:
-                await ctx.error("ファイルの拡張子はmp3かwavにしてください。")
+                await ctx.error("ファイルの拡張子はmp3、wav、ogg、opusのいずれかにしてください。")
                 return ctx.command.reset_cooldown(ctx)
         elif message is not None:
             msg: discord.Message = message
             if msg.attachments:
                 attachment = msg.attachments[0]
-                if attachment.filename.endswith((".mp3", ".wav")):
+                if attachment.filename.endswith(EXTENSIONS):
                     if attachment.size > FILESIZE_LIMIT:
                         await ctx.error("ファイルサイズがデカすぎます。25MB以内にしてください。")
                         return ctx.command.reset_cooldown(ctx)
                     file = attachment
                 else:
-                    await ctx.error("ファイルの拡張子はmp3かwavにしてください。")
+                    await ctx.error("ファイルの拡張子はmp3、wav、ogg、opusのいずれかにしてください。")
                     return ctx.command.reset_cooldown(ctx)
             else:
                 await ctx.error("このメッセージにはファイルがついていません。")
@@ -163,29 +196,99 @@ class AudioCommandMixin(AudioBase):
                     await ctx.error("その名前のタグは存在しませんでした。")
                     return ctx.command.reset_cooldown(ctx)
             file = TagAttachment(audio_tag)
+            if audio_tag.gain is None:
+                # ラウドネスを測定する前に作られたタグ
+                self.bot.loop.create_task(self.transcode_tag(ctx.guild.id, audio_tag.name, audio_tag.audio_url))
         else:
             await ctx.error("ファイルを一緒に送信するかファイルがついているメッセージを引数に入れてください。")
             return ctx.command.reset_cooldown(ctx)
 
-        source = await self.engine.create_source(file)
-        async with self.locks[ctx.guild.id]:
-            if ctx.guild.voice_client is None:
-                return ctx.command.reset_cooldown(ctx)
+        if isinstance(file, TagAttachment):
+            track = Track(file, True, ctx, file.gain)
+        else:
+            track = Track(file, False, ctx)
+        queue = self.queues.get(ctx.guild.id)
+        if queue is not None and queue.is_full:
+            await ctx.error(f"キューには{MAX_QUEUE_SIZE}曲までしか追加できません。")
+            return ctx.command.reset_cooldown(ctx)
+        if queue is not None and queue.add(track):
+            await ctx.success(f"{file.filename}をキューに追加しました。", f"{len(queue)}曲目です。")
+            return
 
-            def check(ctx2: Context) -> bool:
-                return ctx2.channel.id == ctx.channel.id
-            await ctx.success(f"{file.filename}を再生します", f"[ファイルURL]({file.url})")
-
-            event = asyncio.Event(loop=self.bot.loop)
-            ctx.voice_client.play(source, after=lambda x: event.set())
-            for coro in asyncio.as_completed([event.wait(), self.bot.wait_for("skip", check=check, timeout=None)]):
-                result = await coro
-                if isinstance(result, Context):
-                    ctx.voice_client.stop()
-                    await result.success("skipしました。")
-                break
-            await asyncio.sleep(5)
-            ctx.command.reset_cooldown(ctx)
+        queue = AudioQueue(self.engine, self.on_track_start, self.on_track_error)
+        queue.add(track)
+        self.queues[ctx.guild.id] = queue
+        if ctx.voice_client.is_playing():
+            # 前のキューが終了処理中の場合
+            ctx.voice_client.stop()
+        ctx.voice_client.play(
+            queue,
+            after=lambda e: self.bot.loop.call_soon_threadsafe(self.on_queue_end, ctx.guild.id, queue)
+        )
+
+    async def on_track_start(self, track: Track) -> None:
+        await track.ctx.success(f"{track.filename}を再生します", f"[ファイルURL]({track.url})")
+
+    async def on_track_error(self, track: Track, error: MiniMaidException) -> None:
+        await track.ctx.error(f"{track.filename}を再生できませんでした。", error.message())
+
+    def on_queue_end(self, guild_id: int, queue: AudioQueue) -> None:
+        if self.queues.get(guild_id) is queue:
+            del self.queues[guild_id]
+
+    @Cog.listener(name="on_skip")
+    async def skip_audio(self, ctx: Context) -> None:
+        if ctx.guild is None:
+            return
+        queue = self.queues.get(ctx.guild.id)
+        if queue is not None and queue.skip():
+            await ctx.success("skipしました。")
+
+    @audio.command(name="queue", aliases=["q"])
+    @guild_only()
+    async def show_queue(self, ctx: Context) -> None:
+        queue = self.queues.get(ctx.guild.id)
+        tracks = queue.items() if queue is not None else []
+        if not tracks:
+            await ctx.error("キューは空です。")
+            return
+        lines = [f"{i}. [{track.filename}]({track.url})" for i, track in enumerate(tracks)]
+        lines[0] = f"再生中: [{tracks[0].filename}]({tracks[0].url})"
+        embed = discord.Embed(title="キュー", description="\n".join(lines))
+        await ctx.embed(embed)
+
+    @audio.command(name="clear")
+    @voice_channel_only()
+    @bot_connected_only()
+    @user_connected_only()
+    @guild_only()
+    async def clear_queue(self, ctx: Context) -> None:
+        queue = self.queues.get(ctx.guild.id)
+        if queue is None:
+            await ctx.error("キューは空です。")
+            return
+        queue.clear()
+        await ctx.success("キューを空にしました。")
+
+    @audio.command(name="seek", aliases=["jump"])
+    @voice_channel_only()
+    @bot_connected_only()
+    @user_connected_only()
+    @guild_only()
+    async def seek_audio(self, ctx: Context, position: str) -> None:
+        queue = self.queues.get(ctx.guild.id)
+        seconds = parse_time(position)
+        if seconds is None:
+            await ctx.error("時間は`23`や`1:23`の形式で指定してください。")
+            return
+        try:
+            if queue is None or not queue.seek(seconds):
+                await ctx.error("再生中のオーディオがありません。")
+                return
+        except SeekFailed as e:
+            await ctx.error(e.message())
+            return
+        await ctx.success(f"{position}に移動しました。")
 
     @audio.group(name="tag", invoke_without_command=True)
     @guild_only()
@@ -209,13 +312,13 @@ class AudioCommandMixin(AudioBase):
             message: discord.Message = msg
             if message.attachments:
                 attachment = message.attachments[0]
-                if attachment.filename.endswith((".mp3", ".wav")):
+                if attachment.filename.endswith(EXTENSIONS):
                     if attachment.size > FILESIZE_LIMIT:
                         await ctx.error("ファイルサイズがデカすぎます。25MB以内にしてください。")
                         return
                     audio_url = attachment.url
                 else:
-                    await ctx.error("ファイルの拡張子はmp3かwavにしてください。")
+                    await ctx.error("ファイルの拡張子はmp3、wav、ogg、opusのいずれかにしてください。")
                     ctx.command.reset_cooldown(ctx)
                     return
             else:
@@ -224,31 +327,30 @@ class AudioCommandMixin(AudioBase):
 
         elif ctx.message.attachments:
             attachment = ctx.message.attachments[0]
-            if attachment.filename.endswith((".mp3", ".wav")):
+            if attachment.filename.endswith(EXTENSIONS):
                 if attachment.size > FILESIZE_LIMIT:
                     await ctx.error("ファイルサイズがデカすぎます。25MB以内にしてください。")
                     return
                 audio_url = attachment.url
             else:
-                await ctx.error("ファイルの拡張子はmp3かwavにしてください。")
+                await ctx.error("ファイルの拡張子はmp3、wav、ogg、opusのいずれかにしてください。")
                 ctx.command.reset_cooldown(ctx)
                 return
 
         elif url is not None and url_compiled.match(url):
-            async with aiohttp.ClientSession() as http_session:
-                async with http_session.get(url) as response:
-                    if not (200 <= response.status <= 299):
-                        await ctx.error("URLからファイルの取得に失敗しました。")
-                        return
-                    data = await response.read()
-                    if len(data) > FILESIZE_LIMIT:
-                        await ctx.error("ファイルサイズがデカすぎます。25MB以内にしてください。")
-                        return
-                    message = await ctx.send(file=discord.File(
-                        BytesIO(data),
-                        filename=f"{uuid4()}.{url.split('.')[-1]}"
-                    ))
-                    audio_url = message.attachments[0].url
+            try:
+                data = await self.engine.download(url)
+            except AudioFileNotFound:
+                await ctx.error("URLからファイルの取得に失敗しました。")
+                return
+            except AudioFileTooLarge:
+                await ctx.error("ファイルサイズがデカすぎます。25MB以内にしてください。")
+                return
+            message = await ctx.send(file=discord.File(
+                BytesIO(data),
+                filename=f"{uuid4()}.{url.split('.')[-1]}"
+            ))
+            audio_url = message.attachments[0].url
         else:
             await ctx.error("ファイルを一緒に送信するかファイルがついているメッセージか音楽のURLを引数に入れてください。")
             return
@@ -269,9 +371,35 @@ class AudioCommandMixin(AudioBase):
                 async with session.begin():
                     result = await session.execute(select_audio_tag(ctx.guild.id, name))
                     old_tag = result.scalars().first()
+                    self.engine.cache.invalidate(old_tag.audio_url)
+                    if old_tag.audio_url != audio_url:
+                        # 前のファイルの音量のまま再生しないように、変換が終わるまで測り直す対象にする
+                        old_tag.gain = None
                     old_tag.audio_url = audio_url
                 text = f"タグ: `{name}`を更新しました。"
         await ctx.success(text)
+        self.bot.loop.create_task(self.transcode_tag(ctx.guild.id, name, audio_url))
+
+    async def transcode_tag(self, guild_id: int, name: str, audio_url: str) -> None:
+        """タグのオーディオを再生時にエンコードしなくていいようにOpusに変換し、ラウドネスを揃える音量を保存しておく"""
+        if audio_url in self.transcoding:
+            return
+        self.transcoding.add(audio_url)
+        try:
+            gain = await self.engine.transcode(audio_url, tag_filename(name, audio_url))
+        except Exception:
+            # 変換できなくても再生するときにデコードするので、ログだけ残す
+            logger.exception(f"failed to transcode tag {name}")
+            return
+        finally:
+            self.transcoding.discard(audio_url)
+
+        async with self.bot.db.SerializedSession() as session:
+            async with session.begin():
+                result = await session.execute(select_audio_tag(guild_id, name))
+                tag = result.scalars().first()
+                if tag is not None and tag.audio_url == audio_url:
+                    tag.gain = gain
 
     @voice_tag.command(name="remove", aliases=["delete", "rm"])
     async def voice_tag_delete(self, ctx: Context, name: str) -> None:
@@ -283,6 +411,7 @@ class AudioCommandMixin(AudioBase):
                 return
             await session.delete(tag)
             await session.commit()
+        self.engine.cache.invalidate(tag.audio_url)
         await ctx.success(f"タグ: {name}の削除に成功しました。")
 
     @audio.command(name="replay", aliases=["clip"])
@@ -291,7 +420,10 @@ class AudioCommandMixin(AudioBase):
     @user_connected_only()
     @guild_only()
     @cooldown(1, 35, BucketType.guild)
-    async def replay_audio(self, ctx: Context) -> None:
+    async def replay_audio(self, ctx: Context, seconds: Optional[float] = None, mode: Optional[str] = None) -> None:
+        length = REPLAY_SECONDS if seconds is None else min(max(seconds, 1.0), REPLAY_SECONDS)
+        mode = mode.lower() if mode is not None else None
+        trim = mode in TRIM_MODES
         if ctx.guild.id not in self.connecting_guilds:
             await ctx.error("オーディオプレーヤー側では接続されていません。")
             ctx.command.reset_cooldown(ctx)
@@ -301,12 +433,25 @@ class AudioCommandMixin(AudioBase):
             return
         self.recording_guilds.append(ctx.guild.id)
         try:
-            await ctx.success("30秒前からのクリップを作成します...")
-            file = await ctx.voice_client.replay()
+            await ctx.success(f"{length:g}秒前からのクリップを作成します...")
+            timestamp = datetime.utcnow().timestamp()
+            if mode in OGG_MODES or mode in MIXED_OGG_MODES:
+                tracks = await ctx.voice_client.replay_tracks(length)
+                if not tracks:
+                    await ctx.error("クリップにできる音声がありません。")
+                    return
+                filenames = self.track_filenames(ctx, [(ssrc, user_id) for ssrc, user_id, _ in tracks], "opus")
+                files: List[Tuple[str, Union[str, BytesIO]]] = [
+                    (filename, file) for filename, (_, _, file) in zip(filenames, tracks)
+                ]
+                await self.send_files(ctx, files, f"replay_{timestamp}")
+                if mode in OGG_MODES:
+                    await ctx.success("作成終了しました。")
+                    return
+            file = await ctx.voice_client.replay(length, trim)
             if file is None:
                 await ctx.error("エラーが発生しました。もしエラーが再発するようであれば再接続してください。")
                 return
-            timestamp = datetime.utcnow().timestamp()
             file.seek(0)
             await ctx.send("作成終了しました。", file=discord.File(file, f"{timestamp}.wav"))
         except Exception as e:
@@ -324,6 +469,21 @@ class AudioCommandMixin(AudioBase):
             value=f"**{ctx.prefix}record start**で録音を開始します。最大30秒まで録音できます。",
             inline=False
         )
+        embed.add_field(
+            name="話者ごとの録音",
+            value=f"**{ctx.prefix}record start multi**で話者ごとに別のファイルとして録音します。",
+            inline=False
+        )
+        embed.add_field(
+            name="無音を詰めた録音",
+            value=f"**{ctx.prefix}record start trim**で誰も話していない部分を詰めて録音します。",
+            inline=False
+        )
+        embed.add_field(
+            name="Ogg Opusでの録音",
+            value=f"**{ctx.prefix}record start ogg**で話者ごとに、受信した音声をそのままOgg Opusとして保存します。",
+            inline=False
+        )
         embed.add_field(
             name="録音の終了の仕方",
             value=f"録音を途中でやめたい場合は、**{ctx.prefix}record stop**でやめることができます。",
@@ -341,7 +501,10 @@ class AudioCommandMixin(AudioBase):
     @bot_connected_only()
     @user_connected_only()
     @cooldown(1, 86400, BucketType.guild)
-    async def record_start(self, ctx: Context) -> None:
+    async def record_start(self, ctx: Context, mode: Optional[str] = None) -> None:
+        mode = mode.lower() if mode is not None else None
+        multitrack = mode in MULTITRACK_MODES or mode in OGG_MODES
+        trim = mode in TRIM_MODES
         if ctx.guild.id not in self.connecting_guilds:
             await ctx.error("オーディオプレーヤー側では接続されていません。")
             ctx.command.reset_cooldown(ctx)
@@ -355,31 +518,33 @@ class AudioCommandMixin(AudioBase):
         try:
             await ctx.success("録音開始します...")
             print("Start recording...", flush=True)
-            max_file_limit = 5  # 1 minute × 5 file
-            for file_no in range(1, max_file_limit + 1):
-                file, is_continuing = await ctx.voice_client.record(self.invent_mode)
-                filepath = f"/tmp/recorded_voice_{file_no:03}.mp3"
-                with open(filepath, "wb") as f:
-                    f.write(file.getbuffer())
-                print(f"file {filepath} done", flush=True)
-                # test
-                #await ctx.send(file=discord.File(filepath))
-
-                if not is_continuing:
-                    break
-            
-            # mp3を結合
-            print(f"Start merging mp3 files...", flush=True)
-            voice_data = AudioSegment.from_file("/tmp/recorded_voice_001.mp3", "mp3")
-            for i in range(2, file_no + 1):
-                voice_data += AudioSegment.from_file(f"/tmp/recorded_voice_{i:03}.mp3", "mp3")
-
             timestamp = datetime.utcnow().timestamp()
-            result_filepath = f"/tmp/recorded_voice_{timestamp}.mp3"
-            voice_data.export(result_filepath, format="mp3")
+            filepath = f"/tmp/recorded_voice_{timestamp}.mp3"
+            # 途中でBotが落ちても record recover で復元できるようにパケットを保存しておく
+            os.makedirs(JOURNAL_DIR, exist_ok=True)
+            journal_path = os.path.join(JOURNAL_DIR, f"{ctx.guild.id}-{timestamp}.journal")
+            timeout = RECORD_LIMIT * (60 if self.invent_mode else 30)  # 最大5分
+            if multitrack:
+                # ミックスせずにジャーナルだけ書き込み、録音後に話者ごとに並列でデコードする
+                if not await ctx.voice_client.record(None, timeout, journal_path):
+                    os.remove(journal_path)
+                    await ctx.error("音声が録音されませんでした。")
+                    return
+                if mode in OGG_MODES:
+                    await self.send_opus_tracks(ctx, journal_path, f"recorded_voice_{timestamp}")
+                else:
+                    await self.send_tracks(ctx, journal_path, f"recorded_voice_{timestamp}")
+                os.remove(journal_path)
+            else:
+                if not await ctx.voice_client.record(filepath, timeout, journal_path, trim):
+                    os.remove(journal_path)
+                    await ctx.error("音声が録音されませんでした。")
+                    return
+                print(f"file {filepath} done", flush=True)
 
-            await ctx.send(file=discord.File(result_filepath))
-            
+                await ctx.send(file=discord.File(filepath))
+                os.remove(filepath)
+                os.remove(journal_path)
 
             """録音データの作成を開始します。"""
             """
@@ -412,6 +577,124 @@ class AudioCommandMixin(AudioBase):
             await asyncio.sleep(10)
             ctx.command.reset_cooldown(ctx)
 
+    async def send_tracks(self, ctx: Context, journal_path: str, name: str) -> None:
+        """
+        ジャーナルから話者ごとのMP3を作って送信します。
+        サーバーのファイルサイズの上限に収まる場合はzipにまとめ、収まらない場合は別々に送信します。
+        :param ctx: Context
+        :param journal_path: ジャーナルのパス
+        :param name: zipのファイル名
+        """
+        directory = f"/tmp/{name}"
+        os.makedirs(directory, exist_ok=True)
+        try:
+            tracks = await render_tracks(self.bot.loop, journal_path, directory)
+            if not tracks:
+                await ctx.error("音声が録音されませんでした。")
+                return
+
+            filenames = self.track_filenames(ctx, [(ssrc, user_id) for ssrc, user_id, _ in tracks], "mp3")
+            files: List[Tuple[str, Union[str, BytesIO]]] = [
+                (filename, path) for filename, (_, _, path) in zip(filenames, tracks)
+            ]
+            await self.send_files(ctx, files, name)
+        finally:
+            for entry in os.listdir(directory):
+                os.remove(os.path.join(directory, entry))
+            os.rmdir(directory)
+
+    async def send_opus_tracks(self, ctx: Context, journal_path: str, name: str) -> None:
+        """
+        ジャーナルのOpusのパケットをデコードせずに話者ごとのOgg Opusにして送信します。
+        :param ctx: Context
+        :param journal_path: ジャーナルのパス
+        :param name: zipのファイル名
+        """
+        tracks = await self.bot.loop.run_in_executor(self.engine.executor, partial(remux_journal, journal_path))
+        if not tracks:
+            await ctx.error("音声が録音されませんでした。")
+            return
+        filenames = self.track_filenames(ctx, [(ssrc, user_id) for ssrc, user_id, _ in tracks], "opus")
+        files: List[Tuple[str, Union[str, BytesIO]]] = [
+            (filename, file) for filename, (_, _, file) in zip(filenames, tracks)
+        ]
+        await self.send_files(ctx, files, name)
+
+    @staticmethod
+    def track_filenames(ctx: Context, speakers: List[Tuple[int, Optional[int]]], extension: str) -> List[str]:
+        """
+        話者ごとのファイル名を作ります。
+        再接続などで同じメンバーが複数のSSRCで話した場合は、名前が重ならないようにSSRCをつけます。
+        :param ctx: Context
+        :param speakers: ssrcとユーザーID(わからない場合はNone)の組のリスト
+        :param extension: 拡張子
+        :return: speakersと同じ順番のファイル名のリスト
+        """
+        names = []
+        for ssrc, user_id in speakers:
+            member = ctx.guild.get_member(user_id) if user_id is not None else None
+            names.append(member.display_name if member is not None else f"unknown-{ssrc}")
+        counts = Counter(names)
+        return [
+            f"{name}-{ssrc}.{extension}" if counts[name] > 1 else f"{name}.{extension}"
+            for name, (ssrc, _) in zip(names, speakers)
+        ]
+
+    async def send_files(self, ctx: Context, files: List[Tuple[str, Union[str, BytesIO]]], name: str) -> None:
+        """
+        話者ごとのファイルを送信します。
+        サーバーのファイルサイズの上限に収まる場合はzipにまとめ、収まらない場合は別々に送信します。
+        :param ctx: Context
+        :param files: ファイル名と、パスかファイルの組のリスト
+        :param name: zipのファイル名
+        """
+        def size(file: Union[str, BytesIO]) -> int:
+            return os.path.getsize(file) if isinstance(file, str) else file.getbuffer().nbytes
+
+        if sum(size(file) for _, file in files) < ctx.guild.filesize_limit:
+            archive = BytesIO()
+            with ZipFile(archive, "w", ZIP_STORED) as zf:  # MP3やOpusはほとんど圧縮できない
+                for i, (filename, file) in enumerate(files):
+                    if isinstance(file, str):
+                        zf.write(file, f"{i + 1:02}-{filename}")
+                    else:
+                        zf.writestr(f"{i + 1:02}-{filename}", file.getvalue())
+            archive.seek(0)
+            await ctx.send(file=discord.File(archive, f"{name}.zip"))
+            return
+        for i in range(0, len(files), MAX_ATTACHMENTS):
+            await ctx.send(files=[discord.File(file, filename) for filename, file in files[i:i + MAX_ATTACHMENTS]])
+
+    @voice_recorder.command(name="recover")
+    @guild_only()
+    @cooldown(1, 60, BucketType.guild)
+    async def record_recover(self, ctx: Context) -> None:
+        """録音中にBotが停止して送信できなかった録音を作り直します。"""
+        if ctx.guild.id in self.recording_guilds:
+            await ctx.error("録音中は使用できません。")
+            return
+        if not os.path.isdir(JOURNAL_DIR):
+            await ctx.error("復元できる録音はありません。")
+            return
+        journals = sorted(name for name in os.listdir(JOURNAL_DIR) if name.startswith(f"{ctx.guild.id}-"))
+        if not journals:
+            await ctx.error("復元できる録音はありません。")
+            return
+
+        await ctx.success(f"{len(journals)}件の録音を復元します...")
+        for name in journals:
+            journal_path = os.path.join(JOURNAL_DIR, name)
+            filepath = f"/tmp/recovered_voice_{name[:-len('.journal')]}.mp3"
+            recorded = await self.bot.loop.run_in_executor(
+                self.engine.executor,
+                partial(render_journal, journal_path, filepath)
+            )
+            if recorded:
+                await ctx.send(file=discord.File(filepath))
+            os.remove(filepath)
+            os.remove(journal_path)
+        await ctx.success("復元が終了しました。")
+
     @voice_recorder.command(name="stop", aliases=["end"])
     @voice_channel_only()
     @bot_connected_only()
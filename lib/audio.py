@@ -1,78 +1,795 @@
 import discord
-from lib.mpg123 import Mpg123
-import audioop
-import io
-import wave
+import aiohttp
+from lib.mpg123 import Mpg123, pool as mpg123_pool
+from lib.audio_cache import AudioCache, CacheWriter
+from lib.dsp import Converter, LoudnessMeter, loudness_gain, to_float, to_int16
+from lib.mpeg import FrameIndex
+from lib.ogg import OpusHead, iter_packets, page_index, parse_opus_head, packet_samples
+from lib.discord.opus import Decoder as OpusDecoder  # type: ignore
+from lib.errors import AudioFileNotFound, AudioFileTooLarge, AudioLoadFailed, InvalidAudioFile, MiniMaidException, SeekFailed
+from abc import ABC, abstractmethod
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import hashlib
+import logging
+import time
+from bisect import bisect_right
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from functools import partial
 import asyncio
+from typing import Optional, AsyncIterator, BinaryIO, List, Tuple, Union, Iterator, Deque
 
+logger = logging.getLogger(__name__)
 
-def make_pcm(content: bytes) -> io.BytesIO:
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+OPUS_HEADER = struct.Struct("<H")
+OPUS_OFFSET = struct.Struct("<I")
+OPUS_INDEX = struct.Struct("<I4s")  # パケットの数, OPUS_INDEX_MAGIC
+OPUS_INDEX_MAGIC = b"OIDX"
+FILESIZE_LIMIT = 25 * 10 ** 6
+CHUNK_SIZE = 64 * 1024
+PCM_BUFFER_SIZE = 1152 * 2 * 2 * 4  # MPEGの4フレーム分
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+EXTENSIONS = (".mp3", ".wav", ".ogg", ".opus")
+OGG_EXTENSIONS = (".ogg", ".opus")
+DEFAULT_GAIN = 0.8  # ラウドネスを測定していないファイルの音量
+TARGET_LOUDNESS = float(os.environ.get("AUDIO_TARGET_LOUDNESS", -18))
+
+
+def parse_wav(data: mmap.mmap) -> Tuple[int, int, int, int, int]:
+    """
+    wavのヘッダーを読み、PCMの形式とデータの位置を返します。
+    :param data: wavファイル
+    :return: サンプリングレート, チャンネル数, サンプル幅, データの開始位置, データのサイズ
+    """
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise InvalidAudioFile()
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        size, = struct.unpack_from("<I", data, offset + 4)
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            try:
+                tag, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", data, body)
+                if tag == WAVE_FORMAT_EXTENSIBLE:
+                    tag, = struct.unpack_from("<H", data, body + 24)
+            except struct.error:
+                # fmtチャンクが途中で切れている
+                raise InvalidAudioFile()
+            if tag != WAVE_FORMAT_PCM or channels == 0 or bits % 8:
+                raise InvalidAudioFile()
+            fmt = (rate, channels, bits // 8)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise InvalidAudioFile()
+            return fmt[0], fmt[1], fmt[2], body, min(size, len(data) - body)
+        offset = body + size + size % 2
+    raise InvalidAudioFile()
+
+
+class DecodedSource(discord.AudioSource, ABC):
+    """
+    デコードしたPCMを20msずつ返すAudioSourceの基底クラスです。
+    サブクラスはfillでbufferにPCMを書き込み、seek_positionで再生位置を移動します。
+    sinkが設定されている場合は、最初から最後まで再生されたときにデコードしたPCMをキャッシュに登録します。
+    サブクラスはPCMを変換するときにgainを音量の倍率としてかけます。
+    """
+    def __init__(self, gain: float = 1.0) -> None:
+        self.gain = gain
+        self.buffer = bytearray()
+        self.sink: Optional[CacheWriter] = None
+        self.content_hash: Optional[str] = None
+        self.seek_to: Optional[float] = None
+        self.is_decoded = False
+        self.is_end = False
+
+    def write(self, pcm: Union[bytes, memoryview]) -> None:
+        if self.sink is not None:
+            self.sink.write(pcm)
+        self.buffer += pcm
+
+    @abstractmethod
+    def fill(self, size: int) -> bool:
+        """
+        bufferにsize以上のPCMを書き込みます。最後まで書き込んだ場合はis_decodedをTrueにします。
+        :param size: bufferのバイト数の目標
+        :return: データが届いておらず書き込めなかった場合はFalse
+        """
+
+    def prefetch(self, size: int, timeout: float = 10) -> None:
+        """
+        再生を始める前にsizeバイトまで先にデコードしておきます。
+        :param size: デコードしておくバイト数
+        :param timeout: データが届くのを待つ最大の秒数
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.buffer) < size and not self.is_decoded and time.monotonic() < deadline:
+            self.fill(size)
+
+    def seek(self, seconds: float) -> None:
+        """
+        再生位置を移動します。移動は再生スレッドで次のフレームを読むときに行われます。
+        :param seconds: 先頭からの秒数
+        :raise SeekFailed: まだ移動できない位置の場合
+        """
+        if not self.can_seek(seconds):
+            raise SeekFailed()
+        self.seek_to = seconds
+
+    def can_seek(self, seconds: float) -> bool:
+        return True
+
+    @abstractmethod
+    def seek_position(self, seconds: float) -> bool:
+        """
+        デコードする位置を移動します。
+        :param seconds: 先頭からの秒数
+        :return: 移動できなかった場合はFalse。その場合は今の位置から再生を続けます
+        """
+
+    def read(self) -> bytes:
+        if self.seek_to is not None:
+            seconds, self.seek_to = self.seek_to, None
+            if self.seek_position(seconds):
+                if self.sink is not None:
+                    self.sink.abort()
+                    self.sink = None
+                self.buffer.clear()
+                self.is_decoded = False
+
+        if len(self.buffer) < FRAME_SIZE and not self.is_decoded and not self.fill(FRAME_SIZE):
+            # データが届いていない間は無音を流して待つ
+            return b"\0" * FRAME_SIZE
+
+        if not self.buffer:
+            self.is_end = True
+            return b""
+        data = bytes(self.buffer[:FRAME_SIZE])
+        del self.buffer[:FRAME_SIZE]
+        return data.ljust(FRAME_SIZE, b"\0")
+
+    def cleanup(self) -> None:
+        if self.sink is not None:
+            if self.is_end and self.content_hash is not None:
+                self.sink.commit(self.content_hash)
+            else:
+                self.sink.abort()
+        self.buffer.clear()
+
+
+class CachedSource(DecodedSource):
+    """
+    キャッシュされた48kHz・ステレオのPCMファイルを再生するAudioSourceです。音量はキャッシュする前にかけてあります。
+    """
+    def __init__(self, file: BinaryIO) -> None:
+        super().__init__()
+        self.file = file
+
+    def fill(self, size: int) -> bool:
+        size = max(size - len(self.buffer), 0)
+        data = self.file.read(size)
+        self.write(data)
+        self.is_decoded = len(data) < size
+        return True
+
+    def seek_position(self, seconds: float) -> bool:
+        self.file.seek(int(seconds * 48000) * 4)
+        return True
+
+    def cleanup(self) -> None:
+        super().cleanup()
+        self.file.close()
+
+
+class WavSource(DecodedSource):
+    """
+    一時ファイルに保存したwavをメモリマップし、再生が進むのに合わせて20msずつ変換するAudioSourceです。
+    """
+    def __init__(self, file: BinaryIO, gain: float = DEFAULT_GAIN) -> None:
+        super().__init__(gain)
+        self.file = file
+        self.data: Optional[mmap.mmap] = None
+        try:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.rate, self.channels, self.width, self.start, size = parse_wav(self.data)
+        except BaseException as e:
+            # 途中で失敗してもmmapとファイルを閉じる
+            self.cleanup()
+            if isinstance(e, ValueError):
+                raise InvalidAudioFile()
+            raise
+        self.frame_width = self.channels * self.width
+        self.position = self.start
+        self.end = self.start + size - size % self.frame_width
+        self.block = self.rate // 50 * self.frame_width
+        self.converter = Converter(self.rate, self.channels, self.width, self.gain)
+
+    def fill(self, size: int) -> bool:
+        assert self.data is not None
+        while len(self.buffer) < size:
+            if self.position >= self.end:
+                self.write(self.converter.flush())
+                self.is_decoded = True
+                break
+            block = self.data[self.position:min(self.position + self.block, self.end)]
+            self.position += len(block)
+            self.write(self.converter.convert(block))
+        return True
+
+    def seek_position(self, seconds: float) -> bool:
+        self.position = min(self.start + int(seconds * self.rate) * self.frame_width, self.end)
+        self.converter = Converter(self.rate, self.channels, self.width, self.gain)
+        return True
+
+    def cleanup(self) -> None:
+        super().cleanup()
+        # __init__の途中で失敗した場合もdiscord.AudioSourceの__del__から呼ばれる
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+
+class MP3Source(DecodedSource):
+    """
+    MP3のデータを再生しながら少しずつデコードするAudioSourceです。
+    ダウンロードしたデータはfeedで一時ファイルに書き込まれ、デコーダーは再生に必要な分だけそこから読み込みます。
+    同時にフレームの位置のインデックスを作り、シークのときはその位置からデコードし直します。
+    """
+    PREROLL = 2  # ビットリザーバのためにシーク先より前からデコードするフレーム数
+
+    def __init__(self, gain: float = DEFAULT_GAIN) -> None:
+        super().__init__(gain)
+        self.mp3: Optional[Mpg123] = mpg123_pool.acquire()
+        self.converter = Converter(48000, 2, gain=self.gain)
+        self.pcm = bytearray(PCM_BUFFER_SIZE)
+        self.file = tempfile.TemporaryFile()
+        self.index = FrameIndex()
+        self.size = 0  # 一時ファイルに書き込んだバイト数
+        self.position = 0  # デコーダーに渡したバイト数
+        self.skip = 0  # シークしたあとに捨てるPCMのバイト数
+        self.finished = False
+        self.condition = threading.Condition()
+        self.task: Optional[asyncio.Future] = None
+        self.error: Optional[MiniMaidException] = None  # ダウンロードが途中で失敗した理由
+
+    def feed(self, data: bytes) -> None:
+        """
+        ダウンロードしたデータを渡します。デコードは再生スレッドで行われます。
+        :param data: MP3のデータ
+        """
+        with self.condition:
+            self.file.seek(self.size)
+            self.file.write(data)
+            self.size += len(data)
+            self.index.feed(data)
+            self.condition.notify()
+
+    def finish(self, content_hash: Optional[str] = None) -> None:
+        """
+        データがこれ以上来ないことを通知します。
+        :param content_hash: 全てダウンロードできた場合はファイルのハッシュ
+        """
+        with self.condition:
+            self.finished = True
+            self.content_hash = content_hash
+            self.condition.notify()
+
+    def on_new_format(self, rate: int, channels: int, encoding: int) -> None:
+        self.converter = Converter(rate, channels, gain=self.gain)
+
+    def decode(self, size: int) -> None:
+        assert self.mp3 is not None
+        view = memoryview(self.pcm)
+        while len(self.buffer) < size:
+            length = self.mp3.read_into(view, self.on_new_format)
+            if not length:
+                return
+            skip = min(self.skip, length)
+            self.skip -= skip
+            if skip < length:
+                self.write(self.converter.convert(view[skip:length]))
+
+    def fill(self, size: int) -> bool:
+        assert self.mp3 is not None
+        while True:
+            self.decode(size)
+            if len(self.buffer) >= size:
+                return True
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.position < self.size or self.finished, timeout=0.02):
+                    return False
+                self.file.seek(self.position)
+                data = self.file.read(CHUNK_SIZE)
+                finished = self.finished
+            if data:
+                self.position += len(data)
+                self.mp3.feed(data)
+            elif finished:
+                self.write(self.converter.flush())
+                self.is_decoded = True
+                return True
+
+    def can_seek(self, seconds: float) -> bool:
+        with self.condition:
+            return self.index.offset(max(self.index.frame_at(seconds) - self.PREROLL, 0)) is not None
+
+    def seek_position(self, seconds: float) -> bool:
+        with self.condition:
+            frame = self.index.frame_at(seconds)
+            start = max(frame - self.PREROLL, 0)
+            offset = self.index.offset(start)
+            if offset is None:
+                # まだダウンロードされていない位置には移動しない
+                return False
+        assert self.mp3 is not None
+        self.mp3.reset()
+        self.position = offset
+        self.skip = (frame - start) * self.index.samples_per_frame * self.converter.channels * 2
+        # 前の位置のリサンプラーの状態を持ち越さない
+        self.converter = Converter(self.converter.rate, self.converter.channels, gain=self.gain)
+        return True
+
+    def cleanup(self) -> None:
+        if self.task is not None:
+            self.task.get_loop().call_soon_threadsafe(self.task.cancel)
+        super().cleanup()
+        self.file.close()
+        # discord.AudioSourceの__del__からもう一度呼ばれるので、ハンドルは一度だけプールに返す
+        if self.mp3 is not None:
+            mpg123_pool.release(self.mp3)
+            self.mp3 = None
+
+
+class OpusFileSource(discord.AudioSource):
+    """
+    キャッシュされたOpusのパケットをそのまま送るAudioSourceです。再生時にデコードもエンコードも行いません。
+    ファイルの末尾にパケットの位置のインデックスがあれば、シークはそこを読むだけで済みます。
+    """
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.seek_to: Optional[float] = None
+        self.end, self.count, self.index = read_opus_index(file)
+
+    def is_opus(self) -> bool:
+        return True
+
+    def prefetch(self, size: int, timeout: float = 10) -> None:
+        pass
+
+    def seek(self, seconds: float) -> None:
+        self.seek_to = seconds
+
+    def read(self) -> bytes:
+        if self.seek_to is not None:
+            frames, self.seek_to = int(self.seek_to * 50), None
+            if self.index is None:
+                # インデックスのない古いキャッシュは先頭から長さを読んでいく
+                self.file.seek(0)
+                for _ in range(frames):
+                    header = self.file.read(OPUS_HEADER.size)
+                    if len(header) < OPUS_HEADER.size:
+                        break
+                    self.file.seek(OPUS_HEADER.unpack(header)[0], 1)
+            elif frames >= self.count:
+                self.file.seek(self.end)
+            else:
+                self.file.seek(self.index + OPUS_OFFSET.size * frames)
+                self.file.seek(OPUS_OFFSET.unpack(self.file.read(OPUS_OFFSET.size))[0])
+
+        if self.file.tell() >= self.end:
+            return b""
+        header = self.file.read(OPUS_HEADER.size)
+        if len(header) < OPUS_HEADER.size:
+            return b""
+        return self.file.read(OPUS_HEADER.unpack(header)[0])
+
+    def cleanup(self) -> None:
+        self.file.close()
+
+
+def read_opus_index(file: BinaryIO) -> Tuple[int, int, Optional[int]]:
+    """
+    キャッシュされたOpusのファイルの末尾のインデックスを探します。
+    :param file: キャッシュのファイル
+    :return: パケットの終わりの位置, パケットの数, インデックスの位置。インデックスがない場合は(ファイルの大きさ, 0, None)
+    """
+    size = file.seek(0, os.SEEK_END)
+    result: Tuple[int, int, Optional[int]] = (size, 0, None)
+    if size >= OPUS_INDEX.size:
+        file.seek(size - OPUS_INDEX.size)
+        count, magic = OPUS_INDEX.unpack(file.read(OPUS_INDEX.size))
+        index = size - OPUS_INDEX.size - OPUS_OFFSET.size * count
+        if magic == OPUS_INDEX_MAGIC and index >= 0:
+            result = (index, count, index)
+    file.seek(0)
+    return result
+
+
+class OpusPacketWriter:
+    """
+    Opusのパケットを長さをつけてキャッシュに書き込み、finishで末尾にパケットの位置のインデックスを付けます。
+    """
+    def __init__(self, writer: CacheWriter) -> None:
+        self.writer = writer
+        self.offsets: List[int] = []
+        self.size = 0
+
+    def write(self, packet: bytes) -> None:
+        self.offsets.append(self.size)
+        self.writer.write(OPUS_HEADER.pack(len(packet)) + packet)
+        self.size += OPUS_HEADER.size + len(packet)
+
+    def finish(self) -> None:
+        self.writer.write(struct.pack(f"<{len(self.offsets)}I", *self.offsets))
+        self.writer.write(OPUS_INDEX.pack(len(self.offsets), OPUS_INDEX_MAGIC))
+
+
+class OggOpusSource(discord.AudioSource):
+    """
+    Ogg Opusファイルのパケットをデコードせずにそのまま送るAudioSourceです。
+    全てのパケットが20msの場合だけ使えます。
+    """
+    def __init__(self, file: BinaryIO, data: mmap.mmap) -> None:
+        self.file = file
+        self.data = data
+        self.content_hash: Optional[str] = None
+        self.seek_to: Optional[float] = None
+        self.packets = iter_audio_packets(data)
+        # 全てのパケットが20msなので、パケットの数からシーク先のページがわかる
+        self.offsets, self.counts = page_index(data, skip=2)
+
+    def is_opus(self) -> bool:
+        return True
+
+    def prefetch(self, size: int, timeout: float = 10) -> None:
+        pass
+
+    def seek(self, seconds: float) -> None:
+        self.seek_to = seconds
+
+    def read(self) -> bytes:
+        if self.seek_to is not None:
+            frames, self.seek_to = int(self.seek_to * 50), None
+            page = bisect_right(self.counts, frames) - 1
+            if page < 0:
+                self.packets = islice(iter_audio_packets(self.data), frames, None)
+            else:
+                packets = (packet for packet in iter_packets(self.data, self.offsets[page]) if packet)
+                self.packets = islice(packets, frames - self.counts[page], None)
+        return next(self.packets, b"")
+
+    def cleanup(self) -> None:
+        self.data.close()
+        self.file.close()
+
+
+class OggOpusDecodedSource(DecodedSource):
+    """
+    20ms以外のパケットを含むOgg OpusファイルをデコードするAudioSourceです。
+    """
+    PREROLL = 4  # シークのときにデコーダーを収束させるためにシーク先より前からデコードするパケット数
+
+    def __init__(self, file: BinaryIO, data: mmap.mmap, head: OpusHead, gain: float = DEFAULT_GAIN) -> None:
+        super().__init__(gain)
+        self.file = file
+        self.data = data
+        self.head = head
+        self.decoder = OpusDecoder()
+        self.converter = Converter(48000, 2, gain=gain)
+        self.packets = iter_audio_packets(data)
+        self.skip = head.pre_skip * 4  # 捨てるPCMのバイト数
+
+    def fill(self, size: int) -> bool:
+        while len(self.buffer) < size:
+            packet = next(self.packets, None)
+            if packet is None:
+                self.is_decoded = True
+                return True
+            pcm = self.decoder.decode(packet)
+            skip = min(self.skip, len(pcm))
+            self.skip -= skip
+            self.write(self.converter.convert(pcm[skip:]))
+        return True
+
+    def seek_position(self, seconds: float) -> bool:
+        target = int(seconds * 48000) + self.head.pre_skip
+        packets = iter_audio_packets(self.data)
+        recent: Deque[Tuple[bytes, int]] = deque(maxlen=self.PREROLL + 1)  # (パケット, 先頭のサンプルの位置)
+        position = 0
+        for packet in packets:
+            recent.append((packet, position))
+            position += packet_samples(packet)
+            if position > target:
+                break
+        self.decoder = OpusDecoder()
+        self.packets = chain([packet for packet, _ in recent], packets)
+        self.skip = max(target - recent[0][1], 0) * 4 if recent else 0
+        return True
+
+    def cleanup(self) -> None:
+        super().cleanup()
+        self.data.close()
+        self.file.close()
+
+
+def iter_audio_packets(data: mmap.mmap) -> Iterator[bytes]:
+    """
+    Ogg Opusファイルのヘッダー以外の空でないパケットを順番に返します。
+    """
+    packets = iter_packets(data)
+    next(packets, None)  # OpusHead
+    next(packets, None)  # OpusTags
+    return (packet for packet in packets if packet)
+
+
+def open_ogg(file: BinaryIO, gain: float = DEFAULT_GAIN) -> Union[OggOpusSource, OggOpusDecodedSource]:
     """
-    wavのファイルからヘッダーを取り除き、フレームレートなどを合わせます。
-    :param content: wavのデータ
-    :return: 出力するPCM
+    Ogg Opusファイルを開きます。
+    全てのパケットが20msのステレオかモノラルの場合はパケットをそのまま送るAudioSourceを、それ以外はデコードするAudioSourceを返します。
+    パケットをそのまま送る場合はgainは使われません。
+    :param file: Oggファイル
+    :param gain: デコードする場合の音量の倍率
+    :return: AudioSource
     """
-    with wave.open(io.BytesIO(content)) as wav:
-        bit = wav.getsampwidth()
-        pcm = wav.readframes(wav.getnframes())
-        if bit != 2:
-            pcm = audioop.lin2lin(pcm, bit, 2)
+    try:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise InvalidAudioFile()
+    try:
+        head = parse_opus_head(next(iter_packets(data), b""))
+        if head.channels <= 2 and head.mapping_family == 0 and all(
+            packet_samples(packet) == SAMPLES_PER_FRAME for packet in iter_audio_packets(data)
+        ):
+            return OggOpusSource(file, data)
+        return OggOpusDecodedSource(file, data, head, gain)
+    except BaseException:
+        data.close()
+        raise
 
-        if wav.getnchannels() == 1:
-            pcm = audioop.tostereo(pcm, 2, 1, 1)
-        if wav.getframerate() != 48000:
-            pcm = audioop.ratecv(pcm, 2, 2, wav.getframerate(), 48000, None)[0]
 
-    return io.BytesIO(pcm)
+def decode_all(source: DecodedSource, file: BinaryIO) -> Optional[float]:
+    """
+    DecodedSourceを最後までデコードしてfileに書き込み、同時にラウドネスを測定します。
+    :param source: デコードするAudioSource
+    :param file: 48kHz・16bit・ステレオのPCMの書き込み先
+    :return: 統合ラウドネス(LUFS)。測定できなかった場合はNone
+    """
+    meter = LoudnessMeter()
+    while True:
+        if not source.is_decoded:
+            source.fill(FRAME_SIZE * 50)
+        if source.buffer:
+            meter.process(to_float(source.buffer, 2, 2))
+            file.write(source.buffer)
+            source.buffer.clear()
+        if source.is_decoded:
+            return meter.integrated()
 
 
-def mp3_to_pcm(raw: bytes) -> io.BytesIO:
+def encode_opus(file: BinaryIO, writer: OpusPacketWriter, gain: float) -> None:
     """
-    MP3のデータをPCMに変換します。
-    :param raw: MP3のデータ
-    :return: 出力するPCM
+    PCMのファイルに音量をかけ、20msごとのOpusのパケットにしてwriterに書き込みます。
+    :param file: 48kHz・16bit・ステレオのPCMのファイル
+    :param writer: 書き込み先
+    :param gain: エンコードする前にかける音量の倍率
     """
-    mp3 = Mpg123()
-    mp3.feed(raw)
-    rate, channels, encoding = mp3.get_format()
-    data = b""
-    for frame in mp3.iter_frames():
-        data += frame
-    if rate != 48000:
-        data = audioop.ratecv(data, 2, channels, rate, 48000, None)[0]
+    encoder = discord.opus.Encoder()
+    file.seek(0)
+    while True:
+        data = file.read(FRAME_SIZE * 50)
+        if not data:
+            writer.finish()
+            return
+        pcm = to_int16(to_float(data.ljust(-(-len(data) // FRAME_SIZE) * FRAME_SIZE, b"\0"), 2, 2) * gain)
+        for i in range(0, len(pcm), FRAME_SIZE):
+            packet = encoder.encode(pcm[i:i + FRAME_SIZE], SAMPLES_PER_FRAME)
+            writer.write(packet)
 
-    return io.BytesIO(data)
+
+def copy_opus(source: OggOpusSource, writer: OpusPacketWriter) -> None:
+    """
+    OggOpusSourceのパケットをそのままwriterに書き込みます。
+    :param source: 読み込むAudioSource
+    :param writer: 書き込み先
+    """
+    for packet in source.packets:
+        writer.write(packet)
+    writer.finish()
+
+
+PlayableSource = Union[DecodedSource, OpusFileSource, OggOpusSource]
 
 
 class AudioEngine:
     def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
         self.loop = loop
         self.executor = ThreadPoolExecutor()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.cache = AudioCache()
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    async def open(self, url: str) -> aiohttp.ClientResponse:
+        """
+        URLへのリクエストを開始し、ヘッダーを確認します。
+
+        :param url: ファイルのURL
+        :return: ボディを読み込んでいないレスポンス
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        response = await self.session.get(url)
+        if not (200 <= response.status <= 299):
+            response.release()
+            raise AudioFileNotFound()
+        if response.content_length is not None and response.content_length > FILESIZE_LIMIT:
+            response.release()
+            raise AudioFileTooLarge()
+        return response
+
+    async def iter_chunks(self, response: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+        """
+        レスポンスのボディをFILESIZE_LIMITを確認しながら少しずつ読み込みます。
+
+        :param response: 読み込むレスポンス
+        :return: チャンクのイテレーター
+        """
+        size = 0
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if size > FILESIZE_LIMIT:
+                    raise AudioFileTooLarge()
+                yield chunk
+        finally:
+            response.release()
 
-    async def to_pcm(self, raw: bytes, filetype: str) -> io.BytesIO:
+    async def download(self, url: str) -> bytes:
         """
-        データをPCMに変換します。
+        ファイルをダウンロードします。
 
-        :param raw: 変換するデータ
-        :param filetype: 変換するデータのタイプ
-        :return: 出力するPCM
+        :param url: ファイルのURL
+        :return: ファイルのデータ
         """
-        if filetype == "mp3":
-            return await self.loop.run_in_executor(self.executor, partial(mp3_to_pcm, raw))
+        response = await self.open(url)
+        return b"".join([chunk async for chunk in self.iter_chunks(response)])
+
+    async def feed_source(self, response: aiohttp.ClientResponse, source: MP3Source) -> None:
+        content_hash = hashlib.sha1()
+        completed = False
+        try:
+            async for chunk in self.iter_chunks(response):
+                content_hash.update(chunk)
+                source.feed(chunk)
+            completed = True
+        except Exception as e:
+            # このタスクの結果は誰も待たないので、ダウンロードできたところまで再生してからキューに報告させる
+            if isinstance(e, MiniMaidException):
+                source.error = e
+            else:
+                logger.exception(f"failed to download {response.url}")
+                source.error = AudioLoadFailed()
+        finally:
+            source.finish(content_hash.hexdigest() if completed else None)
+
+    async def spool(self, response: aiohttp.ClientResponse) -> Tuple[BinaryIO, str]:
+        """
+        レスポンスのボディを一時ファイルに書き込みます。
+
+        :param response: 読み込むレスポンス
+        :return: 一時ファイルとファイルのハッシュ
+        """
+        file = tempfile.TemporaryFile()
+        content_hash = hashlib.sha1()
+        try:
+            async for chunk in self.iter_chunks(response):
+                content_hash.update(chunk)
+                file.write(chunk)
+            file.flush()
+        except BaseException:
+            file.close()
+            raise
+        return file, content_hash.hexdigest()
+
+    async def load(self, url: str, filename: str, gain: float = DEFAULT_GAIN) -> Union[DecodedSource, OggOpusSource]:
+        """
+        ファイルをダウンロードし、AudioSourceを作成します。
+
+        :param url: ファイルのURL
+        :param filename: 形式の判定に使うファイル名
+        :param gain: デコードするときにかける音量の倍率
+        :return: デコードするAudioSourceか、Opusのパケットをそのまま送るAudioSource
+        """
+        response = await self.open(url)
+
+        if filename.endswith(".mp3"):
+            mp3 = await self.loop.run_in_executor(self.executor, partial(MP3Source, gain))
+            mp3.task = self.loop.create_task(self.feed_source(response, mp3))
+            return mp3
+
+        file, content_hash = await self.spool(response)
+        source: Union[DecodedSource, OggOpusSource]
+        try:
+            if filename.endswith(OGG_EXTENSIONS):
+                source = await self.loop.run_in_executor(self.executor, partial(open_ogg, file, gain))
+            else:
+                source = await self.loop.run_in_executor(self.executor, partial(WavSource, file, gain))
+        except InvalidAudioFile:
+            file.close()
+            raise
+        source.content_hash = content_hash
+        return source
+
+    async def transcode(self, url: str, filename: str) -> float:
+        """
+        ファイルを一度だけデコードしてラウドネスを測定し、それを揃える音量でOpusにエンコードしてキャッシュに保存します。
+        以降はcreate_sourceでエンコード済みのパケットをそのまま再生できます。
+
+        :param url: 変換するファイルのURL
+        :param filename: 形式の判定に使うファイル名
+        :return: ラウドネスを揃えるための音量の倍率
+        """
+        source = await self.load(url, filename, gain=1.0)
+        writer = self.cache.writer(url, "opus")
+        try:
+            if isinstance(source, OggOpusSource):
+                # パケットをそのまま送れるファイルは音量を変えずに保存する
+                gain = 1.0
+                await self.loop.run_in_executor(self.executor, partial(copy_opus, source, OpusPacketWriter(writer)))
+            else:
+                with tempfile.TemporaryFile() as pcm:
+                    loudness = await self.loop.run_in_executor(self.executor, partial(decode_all, source, pcm))
+                    gain = loudness_gain(loudness, TARGET_LOUDNESS)
+                    await self.loop.run_in_executor(self.executor, partial(encode_opus, pcm, OpusPacketWriter(writer), gain))
+            if isinstance(source, MP3Source) and source.error is not None:
+                # 途中までのファイルで測った音量を保存しない
+                raise source.error
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            source.cleanup()
+        if source.content_hash is not None:
+            writer.commit(source.content_hash)
         else:
-            return await self.loop.run_in_executor(self.executor, partial(make_pcm, raw))
+            writer.abort()
+        return gain
 
-    async def create_source(self, attachment: discord.Attachment) -> discord.AudioSource:
+    async def create_source(self,
+                            attachment: discord.Attachment,
+                            cache: bool = False,
+                            gain: Optional[float] = None) -> PlayableSource:
         """
-        Attachmentからdiscord.PCMAudioを作成します。
+        Attachmentからdiscord.AudioSourceを作成します。
+        MP3の場合はダウンロードを待たずに再生できるAudioSourceを返します。
+        20msのパケットのOgg Opusの場合はデコードせずにパケットをそのまま送るAudioSourceを返します。
 
         :param attachment: 変換するアタッチメント
-        :return: 出力するPCMAudio
+        :param cache: キャッシュを使うか。Opusに変換済みの場合はそのパケットを再生し、そうでなければデコードしたPCMをキャッシュします
+        :param gain: 音量の倍率。ラウドネスを測定していない場合はNone
+        :return: 出力するAudioSource
         """
-        raw = await attachment.read()
-
-        data = await self.to_pcm(raw, "mp3" if attachment.filename.endswith(".mp3") else "wav")
+        if cache:
+            encoded = self.cache.open(attachment.url, "opus")
+            if encoded is not None:
+                return OpusFileSource(encoded)
+            cached = self.cache.open(attachment.url)
+            if cached is not None:
+                return CachedSource(cached)
 
-        return discord.PCMVolumeTransformer(discord.PCMAudio(data), volume=0.8)
+        source = await self.load(attachment.url, attachment.filename, DEFAULT_GAIN if gain is None else gain)
+        if cache and isinstance(source, DecodedSource):
+            source.sink = self.cache.writer(attachment.url)
+        return source
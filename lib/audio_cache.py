@@ -0,0 +1,148 @@
+"""
+デコード済みのオーディオをディスクに保存するキャッシュ
+
+kindが"pcm"のファイルは48kHz・16bit・ステレオのPCM、
+"opus"のファイルは2バイトのリトルエンディアンの長さが先頭についた20msごとのOpusのパケットの列で、
+末尾に各パケットの位置(4バイト)の表と、パケットの数(4バイト)とb"OIDX"が続きます。
+"""
+from typing import Optional, BinaryIO, Tuple, Union
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "minimaid_audio_cache"))
+CACHE_SIZE = int(os.environ.get("AUDIO_CACHE_SIZE", 500 * 10 ** 6))
+KINDS = ("pcm", "opus")
+
+
+def url_key(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+class CacheWriter:
+    """
+    キャッシュに書き込むためのファイル。
+    全て書き込んだあとにcommitされたときだけキャッシュに登録されます。
+    """
+    def __init__(self, cache: 'AudioCache', url: str, kind: str) -> None:
+        self.cache = cache
+        self.url = url
+        self.kind = kind
+        fd, self.path = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+        self.file: BinaryIO = os.fdopen(fd, "wb")
+        self.closed = False
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        if not self.closed:
+            self.file.write(data)
+
+    def commit(self, content_hash: str) -> None:
+        """
+        書き込んだデータをキャッシュに登録します。
+        :param content_hash: 元のファイルのハッシュ
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        self.cache.add(self.url, content_hash, self.path, self.kind)
+
+    def abort(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        os.remove(self.path)
+
+
+class AudioCache:
+    """
+    デコードしたオーディオをURLと元ファイルのハッシュをキーにして保存します。
+    合計サイズがmax_sizeを超えると最後に使われたのが古いものから削除されます。
+    """
+    def __init__(self, directory: str = CACHE_DIR, max_size: int = CACHE_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()  # url key.kind -> (path, size)
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self) -> None:
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            parts = name.split(".")
+            if len(parts) != 3 or parts[2] not in KINDS:
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, f"{parts[0]}.{parts[2]}", path, stat.st_size))
+
+        # 最後に使われた時刻(mtime)の順に並べてLRUの順番を復元する
+        for _, key, path, size in sorted(files):
+            self.entries[key] = (path, size)
+            self.size += size
+        self.evict()
+
+    def evict(self) -> None:
+        while self.size > self.max_size and self.entries:
+            _, (path, size) = self.entries.popitem(last=False)
+            self.size -= size
+            os.remove(path)
+
+    def open(self, url: str, kind: str = "pcm") -> Optional[BinaryIO]:
+        """
+        キャッシュされたオーディオを開きます。
+        :param url: オーディオファイルのURL
+        :param kind: "pcm"か"opus"
+        :return: キャッシュのファイル。キャッシュされていない場合はNone
+        """
+        key = f"{url_key(url)}.{kind}"
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            path, _ = self.entries[key]
+            os.utime(path)
+            return open(path, "rb")
+
+    def contains(self, url: str, kind: str = "pcm") -> bool:
+        with self.lock:
+            return f"{url_key(url)}.{kind}" in self.entries
+
+    def writer(self, url: str, kind: str = "pcm") -> CacheWriter:
+        return CacheWriter(self, url, kind)
+
+    def add(self, url: str, content_hash: str, tmp_path: str, kind: str = "pcm") -> None:
+        key = f"{url_key(url)}.{kind}"
+        path = os.path.join(self.directory, f"{url_key(url)}.{content_hash}.{kind}")
+        with self.lock:
+            self._remove(key)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            self.entries[key] = (path, size)
+            self.size += size
+            self.evict()
+
+    def _remove(self, key: str) -> None:
+        if key not in self.entries:
+            return
+        path, size = self.entries.pop(key)
+        self.size -= size
+        if os.path.exists(path):
+            os.remove(path)
+
+    def invalidate(self, url: str) -> None:
+        """
+        URLのキャッシュを削除します。
+        :param url: オーディオファイルのURL
+        """
+        with self.lock:
+            for kind in KINDS:
+                self._remove(f"{url_key(url)}.{kind}")
@@ -0,0 +1,207 @@
+"""
+サーバーごとのオーディオの再生キュー
+"""
+from typing import Any, Optional, Callable, Coroutine, Deque, List
+from collections import deque
+from functools import partial
+import asyncio
+import logging
+import threading
+
+import discord
+
+from lib.audio import AudioEngine, MP3Source, PlayableSource, FRAME_SIZE
+from lib.errors import AudioLoadFailed, MiniMaidException
+
+logger = logging.getLogger(__name__)
+
+MAX_QUEUE_SIZE = 10
+PREFETCH_SIZE = 48000 * 4 * 5  # 5秒分のPCM
+
+
+class Track:
+    def __init__(self, file: Any, cache: bool, ctx: Any, gain: Optional[float] = None) -> None:
+        self.file = file
+        self.cache = cache
+        self.ctx = ctx
+        self.gain = gain
+        self.source: Optional[PlayableSource] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def filename(self) -> str:
+        return self.file.filename
+
+    @property
+    def url(self) -> str:
+        return self.file.url
+
+
+class AudioQueue(discord.AudioSource):
+    """
+    キューに入っている曲を続けて再生するAudioSourceです。
+    再生中の曲の次の曲はバックグラウンドでダウンロードとデコードを先に行い、
+    曲の切り替えは同じreadの中で行うので曲間に無音が入りません。
+    """
+    def __init__(self,
+                 engine: AudioEngine,
+                 on_start: Callable[[Track], Coroutine[Any, Any, Any]],
+                 on_error: Callable[[Track, MiniMaidException], Coroutine[Any, Any, Any]]) -> None:
+        self.engine = engine
+        self.loop = engine.loop
+        self.on_start = on_start
+        self.on_error = on_error
+        self.tracks: Deque[Track] = deque()
+        self.current: Optional[Track] = None
+        self.lock = threading.Lock()
+        self.skip_requested = False
+        self.is_finished = False
+        self.is_opus_frame = False  # 最後にreadで返したフレームがOpusか
+
+    def __len__(self) -> int:
+        return len(self.tracks) + (self.current is not None)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self) >= MAX_QUEUE_SIZE
+
+    def items(self) -> List[Track]:
+        with self.lock:
+            return ([self.current] if self.current is not None else []) + list(self.tracks)
+
+    def add(self, track: Track) -> bool:
+        """
+        キューに曲を追加します。
+        :param track: 追加する曲
+        :return: 再生が終わっていて追加できなかった場合はFalse
+        """
+        with self.lock:
+            if self.is_finished:
+                return False
+            self.tracks.append(track)
+        self.prepare()
+        return True
+
+    def prepare(self) -> None:
+        """
+        次の曲の準備を開始します。イベントループから呼んでください。
+        """
+        with self.lock:
+            if not self.tracks or self.tracks[0].task is not None:
+                return
+            track = self.tracks[0]
+            track.task = self.loop.create_task(self._prepare(track))
+
+    async def _prepare(self, track: Track) -> None:
+        source = None
+        try:
+            source = await self.engine.create_source(track.file, cache=track.cache, gain=track.gain)
+            await self.loop.run_in_executor(self.engine.executor, partial(source.prefetch, PREFETCH_SIZE))
+        except Exception as e:
+            # ダウンロードやデコードのエラーでも曲を取り除かないと、キューが先頭で止まってしまう
+            if source is not None:
+                source.cleanup()
+            if isinstance(e, MiniMaidException):
+                error = e
+            else:
+                logger.exception(f"failed to prepare {track.filename}")
+                error = AudioLoadFailed()
+            with self.lock:
+                if track in self.tracks:
+                    self.tracks.remove(track)
+            await self.on_error(track, error)
+            self.prepare()
+            return
+
+        with self.lock:
+            if track in self.tracks:
+                track.source = source
+                return
+        source.cleanup()
+
+    def _started(self, track: Track) -> None:
+        self.prepare()
+        self.loop.create_task(self.on_start(track))
+
+    def _end_current(self) -> None:
+        if self.current is not None and self.current.source is not None:
+            source = self.current.source
+            if isinstance(source, MP3Source) and source.error is not None:
+                # ダウンロードが途中で失敗して早く終わった理由を知らせる
+                self.loop.call_soon_threadsafe(self._report, self.current, source.error)
+            source.cleanup()
+        self.current = None
+        self.skip_requested = False
+
+    def _report(self, track: Track, error: MiniMaidException) -> None:
+        self.loop.create_task(self.on_error(track, error))
+
+    def is_opus(self) -> bool:
+        # AudioPlayerはreadの直後にこれを呼ぶので、曲ごとにOpusかPCMかを切り替えられる
+        return self.is_opus_frame
+
+    def read(self) -> bytes:
+        while True:
+            # デコードやダウンロードを待つ間にイベントループ側を止めないように、ロックは曲を選ぶ間だけ持つ
+            with self.lock:
+                self.is_opus_frame = False
+                if self.skip_requested:
+                    self._end_current()
+                if self.current is None:
+                    if not self.tracks:
+                        self.is_finished = True
+                        return b""
+                    if self.tracks[0].source is None:
+                        # 次の曲の準備ができるまで無音を流す
+                        return b"\0" * FRAME_SIZE
+                    self.current = self.tracks.popleft()
+                    self.loop.call_soon_threadsafe(self._started, self.current)
+                assert self.current.source is not None
+                source = self.current.source
+
+            data = source.read()
+            if data:
+                self.is_opus_frame = source.is_opus()
+                return data
+            with self.lock:
+                self._end_current()
+
+    def skip(self) -> bool:
+        """
+        再生中の曲をスキップします。
+        :return: 再生中の曲があった場合はTrue
+        """
+        with self.lock:
+            if self.current is None:
+                return False
+            self.skip_requested = True
+            return True
+
+    def seek(self, seconds: float) -> bool:
+        """
+        再生中の曲の再生位置を移動します。
+        :param seconds: 先頭からの秒数
+        :return: 再生中の曲があった場合はTrue
+        :raise SeekFailed: まだ読み込まれていない位置の場合
+        """
+        with self.lock:
+            if self.current is None or self.current.source is None:
+                return False
+            self.current.source.seek(seconds)
+            return True
+
+    def clear(self) -> None:
+        """
+        再生中の曲以外をキューから削除します。
+        """
+        with self.lock:
+            tracks, self.tracks = self.tracks, deque()
+        for track in tracks:
+            if track.source is not None:
+                track.source.cleanup()
+
+    def cleanup(self) -> None:
+        with self.lock:
+            self.is_finished = True
+            self._end_current()
+        self.clear()
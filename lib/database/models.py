@@ -117,6 +117,7 @@ class AudioTag(Base):
 
     name = Column(String, nullable=False)
     audio_url = Column(String, nullable=False)
+    gain = Column(Float, nullable=True)  # ラウドネスを揃えるための倍率。まだ計算していない場合はNone
 
     owner_id = Column(BigInteger, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
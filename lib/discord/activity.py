@@ -0,0 +1,70 @@
+"""
+話者が多いときにミックスする話者を、話している量の多い順に選びます。
+"""
+from typing import Any, Callable, List, Mapping, Sequence, TypeVar
+import os
+
+import numpy as np
+
+from lib.timeline import Segment
+
+MAX_SPEAKERS = int(os.environ.get("VOICE_MAX_SPEAKERS", 16))  # 一度にミックスする話者の数の上限
+SILENCE_PACKET_SIZE = 10  # これより短いパケットは無音として扱う
+
+T = TypeVar("T")
+
+
+def packet_activity(packets: Sequence[Any]) -> int:
+    """
+    無音ではないパケットのOpusのバイト数の合計。デコードしなくても話している長さと音の複雑さの目安になります。
+    :param packets: 一人の話者のパケット
+    :return: バイト数
+    """
+    return sum(
+        len(packet.decrypted) for packet in packets
+        if packet.decrypted is not None and len(packet.decrypted) >= SILENCE_PACKET_SIZE
+    )
+
+
+def select_speakers(groups: Mapping[int, Sequence[Any]], limit: int = MAX_SPEAKERS) -> List[int]:
+    """
+    デコードする前に、話している量の多い順にlimit人の話者を選びます。
+    :param groups: ssrcごとのパケット
+    :param limit: 選ぶ人数
+    :return: 選んだssrcのリスト
+    """
+    if len(groups) <= limit:
+        return list(groups)
+    return sorted(groups, key=lambda ssrc: packet_activity(groups[ssrc]), reverse=True)[:limit]
+
+
+def select_tracks(tracks: List[np.ndarray], limit: int = MAX_SPEAKERS) -> List[np.ndarray]:
+    """
+    デコードしたPCMのエネルギーが大きい順にlimit人の話者を選びます。
+    :param tracks: 話者ごとのPCM
+    :param limit: 選ぶ人数
+    :return: 選んだPCMのリスト
+    """
+    return select_loudest(tracks, energy, limit)
+
+
+def select_segments(tracks: List[List[Segment]], limit: int = MAX_SPEAKERS) -> List[List[Segment]]:
+    """
+    select_tracksと同じく、話している区間のリストで表したPCMからエネルギーが大きい順にlimit人の話者を選びます。
+    :param tracks: 話者ごとの区間のリスト
+    :param limit: 選ぶ人数
+    :return: 選んだ区間のリストのリスト
+    """
+    return select_loudest(tracks, lambda segments: sum(energy(data) for _, data in segments), limit)
+
+
+def energy(track: np.ndarray) -> float:
+    return float(np.dot(track.reshape(-1), track.reshape(-1)))
+
+
+def select_loudest(tracks: List[T], key: Callable[[T], float], limit: int) -> List[T]:
+    if len(tracks) <= limit:
+        return tracks
+    energies = [key(track) for track in tracks]
+    order = sorted(range(len(tracks)), key=lambda i: energies[i], reverse=True)[:limit]
+    return [tracks[i] for i in sorted(order)]
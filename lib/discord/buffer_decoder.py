@@ -1,4 +1,5 @@
 # type: ignore
+from typing import Optional
 import asyncio
 from functools import partial
 from io import BytesIO
@@ -8,38 +9,61 @@ from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import time
 from collections import defaultdict
-from itertools import zip_longest
 import logging
-import lameenc
 
+from lib.timeline import Timeline, mix_segments
+
+from .activity import select_segments, select_speakers
+from .jitter import JitterBuffer
 from .opus import Decoder, OpusError
 
 logger = logging.getLogger(__name__)
 
 
 class PacketBase:
+    __slots__ = ()
+
     def is_rpc(self) -> bool:
         return False
 
 
+RTP_HEADER = struct.Struct('>HII')
+
+
 class RTPPacket(PacketBase):
-    def __init__(self, header: bytes, decrypted: bytes):
-        self.version = (header[0] & 0b11000000) >> 6
-        self.padding = (header[0] & 0b00100000) >> 5
-        self.extend = (header[0] & 0b00010000) >> 4
-        self.cc = header[0] & 0b00001111
-        self.marker = header[1] >> 7
-        self.payload_type = header[1] & 0b01111111
-        self.offset = 0
-        self.ext_length = None
-        self.ext_header = None
-        self.csrcs = None
-        self.profile = None
-        self.real_time = None
+    # 受信するパケットの数が多いので、__dict__を持たせずヘッダーのビットフィールドは必要なときだけ読む
+    __slots__ = ("header", "decrypted", "seq", "_timestamp", "ssrc", "real_time", "ext_length")
 
+    def __init__(self, header: bytes, decrypted: bytes):
         self.header = header
         self.decrypted = decrypted
-        self.seq, self._timestamp, self.ssrc = struct.unpack_from('>HII', header, 2)
+        self.seq, self._timestamp, self.ssrc = RTP_HEADER.unpack_from(header, 2)
+        self.real_time = None
+        self.ext_length = None
+
+    @property
+    def version(self):
+        return self.header[0] >> 6
+
+    @property
+    def padding(self):
+        return (self.header[0] >> 5) & 0b1
+
+    @property
+    def extend(self):
+        return (self.header[0] >> 4) & 0b1
+
+    @property
+    def cc(self):
+        return self.header[0] & 0b00001111
+
+    @property
+    def marker(self):
+        return self.header[1] >> 7
+
+    @property
+    def payload_type(self):
+        return self.header[1] & 0b01111111
 
     def set_real_time(self):
         self.real_time = time.time()
@@ -90,45 +114,30 @@ class SsrcPacketQueue:
         return self.queue
 
 
-class PacketQueue:
-    MAX_SRC = 65535
-
-    def __init__(self, data: list):
-        self.queue = data
-        self.last_seq = None
-
-    async def pop(self):
-        if not self.queue:
-            return None
-
-        if self.last_seq is None:
-            packet = self.queue.pop(0)
-            self.last_seq = packet.seq
-            return packet
-        if self.last_seq == self.MAX_SRC:
-            self.last_seq = -1
-        if self.queue[0].seq - 1 == self.last_seq:
-            packet = self.queue.pop(0)
-            self.last_seq = packet.seq
-            return packet
-
-        for i in range(1, min(1000, len(self.queue))):
-            if self.queue[i].seq - 1 == self.last_seq:
-                packet = self.queue.pop(i)
-                self.last_seq = packet.seq
-                return packet
-        self.last_seq = None
-        return -1
+def decode_into(timeline: Timeline, decoder: Decoder, data: Optional[bytes], fec: bool = False) -> int:
+    """
+    パケットをデコードしてtimelineの書き込み中の区間の後ろに直接書き込みます。
+    :return: デコードしたサンプル数
+    """
+    count = decoder.decode_float_into(data, timeline.reserve(decoder.frame_size(data)), fec=fec)
+    timeline.commit(count)
+    return count
 
 
 class ResultPCM:
-    def __init__(self, data: list, start_time: int) -> None:
-        self.data = data
+    """
+    一人の話者の話している区間と、最初のパケットを受信した時刻
+    """
+    def __init__(self, timeline: Timeline, start_time: float) -> None:
+        timeline.close()
+        self.timeline = timeline
         self.start_time = start_time
 
     def add_margin(self, diff: float) -> None:
-        byte_count = int(48000 * 2 * diff)  # 周波数 * bit数 * チャンネル数
-        self.data = ([0] * byte_count) + self.data
+        # 無音のPCMを前に付ける代わりに区間の位置をずらす
+        count = int(Decoder.SAMPLING_RATE * diff)  # サンプル数
+        if count > 0:
+            self.timeline.shift(count)
 
 
 class BufferDecoder:
@@ -146,93 +155,39 @@ class BufferDecoder:
     def add_ssrc(self, data: dict) -> None:
         self.ssrc[data["ssrc"]] = data["user_id"]
 
-    async def decode_to_pcm(self):
-        pcm_list = []
-        c = 0
-        for ssrc, packets in self.queue.get().items():
-            if c > 15:
-                break
-            queue = PacketQueue(packets)
-            try:
-                pcm: ResultPCM = await self.decode_one(queue)
-            except OpusError:
-                return None
-            pcm_list.append(pcm)
-            c += 1
+    async def decode_to_pcm(self, trim: bool = False):
+        # 話者ごとのパケットを1回の呼び出しでまとめてデコードし、話者同士は並列に処理する
+        groups = self.queue.get()
+        queues = []
+        # 話者が多い場合は話している量が多い話者だけをデコードする
+        for ssrc in select_speakers(groups):
+            queue = JitterBuffer()
+            for packet in groups[ssrc]:
+                queue.push(packet)
+            queues.append(queue)
+        try:
+            pcm_list = await asyncio.gather(*[
+                self.loop.run_in_executor(self.executor, partial(self.decode_one, queue)) for queue in queues
+            ])
+        except OpusError:
+            return None
         pcm_list.sort(key=lambda x: x.start_time)
         if not pcm_list:
             return None
         first_time = pcm_list[0].start_time
         for pcm in pcm_list:
-            await self.loop.run_in_executor(self.executor, partial(pcm.add_margin, pcm.start_time - first_time))
-
-        right_channel = []
-        left_channel = []
-
-        i = 0
-        for bytes_ in zip_longest(*map(lambda x: x.data, pcm_list)):
-            result = 0
-            for b in bytes_:
-                if b is None:
-                    continue
-                if result < 0 and b < 0:
-                    result = result + b - (result * b * -1)
-                elif result > 0 and b > 0:
-                    result = result + b - (result * b)
-                else:
-                    result = result + b
-            if result > 1:
-                if not i % 2:
-                    right_channel.append(1)
-                else:
-                    left_channel.append(1)
-            elif result < -1:
-                if not i % 2:
-                    right_channel.append(-1)
-                else:
-                    left_channel.append(-1)
-            else:
-                if not i % 2:
-                    right_channel.append(result)
-                else:
-                    left_channel.append(result)
-            i += 1
-
-        left_len = len(left_channel)
-        right_len = len(right_channel)
-        if left_len != right_len:
-            if not left_len % 2:
-                if left_len > right_len:
-                    right_channel += [0] * (left_len - right_len)
-                else:
-                    right_channel = right_channel[:left_len]
-            elif not right_len % 2:
-                if right_len > left_len:
-                    left_channel += [0] * (right_len - left_len)
-                else:
-                    left_channel = left_channel[:right_len]
+            pcm.add_margin(pcm.start_time - first_time)
 
-        audio = np.array([left_channel, right_channel]).T
+        # 話している区間だけをミックスする
+        length = max(pcm.timeline.position for pcm in pcm_list)
+        tracks = select_segments([pcm.timeline.segments for pcm in pcm_list])
+        audio = await self.loop.run_in_executor(self.executor, partial(mix_segments, tracks, length, trim))
 
         # Convert to (little-endian) 16 bit integers.
         audio = (audio * (2 ** 15 - 1)).astype(np.int16)
         return audio.tobytes()
 
-    async def decode_to_mp3(self):
-        encoder = lameenc.Encoder()
-        encoder.set_bit_rate(128)
-        encoder.set_quality(2)
-        encoder.set_channels(2)
-        encoder.set_in_sample_rate(48000)
-        audio = await self.decode_to_pcm()
-        if audio is None:
-            return None
-        mp3 = encoder.encode(audio)
-        mp3 += encoder.flush()
-        file = BytesIO(mp3)
-        return file
-
-    async def decode(self):
+    async def decode(self, trim: bool = False):
 
         file = BytesIO()
         wav = wave.open(file, "wb")
@@ -240,7 +195,7 @@ class BufferDecoder:
         wav.setsampwidth(Decoder.SAMPLE_SIZE // Decoder.CHANNELS)
         wav.setframerate(Decoder.SAMPLING_RATE)
 
-        audio = await self.decode_to_pcm()
+        audio = await self.decode_to_pcm(trim)
         if audio is None:
             return None
 
@@ -250,21 +205,30 @@ class BufferDecoder:
 
         return file
 
-    async def decode_one(self, queue: PacketQueue):
+    def decode_one(self, queue: JitterBuffer) -> ResultPCM:
+        """
+        一人の話者のパケットを順番にすべてデコードします。executorで実行されます。
+        欠落したパケットは、次のパケットがあればFECで、なければPLCで補完します。
+        """
         decoder = Decoder()
-        pcm = []
+        timeline = Timeline()
         start_time = None
 
         last_timestamp = None
 
         while True:
-            packet: RTPPacket = await queue.pop()
-            if packet is None:
+            item = queue.pop(flush=True)
+            if item is None:
                 break
-            if packet == -1:
-                data = decoder.decode_float(None)
-                pcm += data
-                last_timestamp = None
+            seq, packet = item
+            if packet is None:
+                following = queue.peek(seq + 1)
+                if following is not None and following.decrypted is not None and len(following.decrypted) >= 10:
+                    count = decode_into(timeline, decoder, following.decrypted, fec=True)
+                else:
+                    count = decode_into(timeline, decoder, None)
+                if last_timestamp is not None:
+                    last_timestamp += count
                 continue
             if start_time is None:
                 start_time = packet.real_time
@@ -272,8 +236,7 @@ class BufferDecoder:
                 start_time = min(packet.real_time, start_time)
 
             if packet.decrypted is None:
-                data = await self.loop.run_in_executor(self.executor, partial(decoder.decode_float, packet.decrypted))
-                pcm += data
+                decode_into(timeline, decoder, packet.decrypted)
                 last_timestamp = packet.timestamp
                 continue
 
@@ -284,20 +247,18 @@ class BufferDecoder:
             if last_timestamp is not None:
                 elapsed = (packet.timestamp - last_timestamp) / Decoder.SAMPLING_RATE
                 if elapsed > 0.02:
-                    margin = [0] * 2 * int(Decoder.SAMPLE_SIZE * (elapsed - 0.02) * Decoder.SAMPLING_RATE)
-                    # await self.loop.run_in_executor(self.executor, partial(pcm.append, margin))
-                    pcm += margin
+                    # 長い無音はPCMを持たずに区間を分ける
+                    timeline.skip(int((elapsed - 0.02) * Decoder.SAMPLING_RATE))
             try:
-                data = await self.loop.run_in_executor(self.executor, partial(decoder.decode_float, packet.decrypted))
+                decode_into(timeline, decoder, packet.decrypted)
             except Exception:
                 logger.error(f"{packet.cc=}")
                 logger.error(f"{packet.extend=}")
                 raise
-            pcm += data
             last_timestamp = packet.timestamp
 
         del decoder
-        return ResultPCM(pcm, start_time)
+        return ResultPCM(timeline, start_time)
 
     async def push(self, packet: PacketBase) -> None:
         await self.queue.push(packet)
@@ -0,0 +1,84 @@
+"""
+RTPのパケットをシーケンス番号の順に並べ直すジッターバッファ
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import heapq
+
+SEQ_MODULO = 2 ** 16
+WINDOW = 50  # 遅れて届くパケットを待つパケット数(1秒)
+MAX_CONCEAL = 5  # 続けて補完するパケット数の上限。これより長い欠落は補完せずに飛ばします
+
+
+class JitterBuffer:
+    """
+    パケットを拡張シーケンス番号(16bitのシーケンス番号の折り返しを数えた番号)のヒープで並べ替えます。
+    追加と取り出しはO(log n)で、重複したパケットと取り出し済みの位置より前のパケットは捨てます。
+    """
+    def __init__(self, window: int = WINDOW, max_conceal: int = MAX_CONCEAL) -> None:
+        self.window = window
+        self.max_conceal = max_conceal
+        self.heap: List[int] = []
+        self.packets: Dict[int, Any] = {}
+        self.highest: Optional[int] = None  # 受け取った中で最大の拡張シーケンス番号
+        self.next: Optional[int] = None  # 次に取り出す拡張シーケンス番号
+        self.concealed = 0  # 続けて欠落として返した数
+
+    def __len__(self) -> int:
+        return len(self.packets)
+
+    def extend(self, seq: int) -> int:
+        """
+        シーケンス番号を、最大の拡張シーケンス番号から前後32768の範囲にある拡張シーケンス番号にします。
+        """
+        if self.highest is None:
+            return seq
+        delta = (seq - self.highest) % SEQ_MODULO
+        if delta >= SEQ_MODULO // 2:
+            delta -= SEQ_MODULO
+        return self.highest + delta
+
+    def push(self, packet: Any) -> bool:
+        """
+        パケットを追加します。
+        :param packet: seqを持つパケット
+        :return: 重複しているか、すでに取り出した位置より前のパケットで捨てた場合はFalse
+        """
+        ext = self.extend(packet.seq)
+        if ext in self.packets or (self.next is not None and ext < self.next):
+            return False
+        self.highest = ext if self.highest is None else max(self.highest, ext)
+        self.packets[ext] = packet
+        heapq.heappush(self.heap, ext)
+        return True
+
+    def peek(self, ext: int) -> Optional[Any]:
+        """
+        取り出さずにパケットを返します。FECで前のパケットを復元するときに使います。
+        """
+        return self.packets.get(ext)
+
+    def pop(self, flush: bool = False) -> Optional[Tuple[int, Optional[Any]]]:
+        """
+        次のパケットを取り出します。
+        次の番号のパケットが届いていない場合、windowより多くのパケットが溜まっているかflushがTrueなら欠落として扱います。
+        :param flush: 遅れて届くパケットを待たない場合はTrue
+        :return: 拡張シーケンス番号とパケットの組。欠落した場合はパケットがNone。取り出せるものがない場合はNone
+        """
+        while self.heap:
+            ext = self.heap[0]
+            if self.next is None:
+                self.next = ext
+            if ext == self.next:
+                heapq.heappop(self.heap)
+                self.next += 1
+                self.concealed = 0
+                return ext, self.packets.pop(ext)
+            if not flush and len(self.packets) <= self.window:
+                return None
+            if self.concealed < self.max_conceal:
+                self.concealed += 1
+                self.next += 1
+                return self.next - 1, None
+            # 長い欠落は補完せずに次に届いているパケットまで飛ばす
+            self.next = ext
+        return None
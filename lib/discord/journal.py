@@ -0,0 +1,92 @@
+"""
+録音中に受信したパケットを追記していくディスク上のジャーナル
+
+ファイルはMAGICのあとにレコードが続きます。レコードはRECORDのヘッダーとlengthバイトのデータです。
+途中でプロセスが落ちても、最後の不完全なレコード以外は読み込めます。
+"""
+from typing import Any, BinaryIO, Iterator, NamedTuple, Optional, Union
+import os
+import struct
+import tempfile
+
+MAGIC = b"MMRJ\x01"
+RECORD = struct.Struct("<BIHIdH")  # 種類, ssrc, seq, timestamp, 受信時刻, データの長さ
+PACKET = 0
+SPEAKER = 1
+NO_PAYLOAD = 0xffff  # 復号できなかったパケット
+USER_ID = struct.Struct("<Q")
+JOURNAL_DIR = os.environ.get("RECORD_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "minimaid_record_journal"))
+
+
+class JournalPacket(NamedTuple):
+    ssrc: int
+    seq: int
+    timestamp: int
+    real_time: float
+    decrypted: Optional[bytes]
+
+
+class JournalSpeaker(NamedTuple):
+    ssrc: int
+    user_id: int
+
+
+class PacketJournal:
+    """
+    パケットをジャーナルに追記します。
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file: BinaryIO = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write_packet(self, packet: Any) -> None:
+        """
+        :param packet: RTPPacketかJournalPacket
+        """
+        length = NO_PAYLOAD if packet.decrypted is None else len(packet.decrypted)
+        self.file.write(RECORD.pack(PACKET, packet.ssrc, packet.seq, packet.timestamp, packet.real_time, length))
+        if packet.decrypted is not None:
+            self.file.write(packet.decrypted)
+
+    def write_speaker(self, ssrc: int, user_id: int) -> None:
+        self.file.write(RECORD.pack(SPEAKER, ssrc, 0, 0, 0, USER_ID.size))
+        self.file.write(USER_ID.pack(user_id))
+
+    def sync(self) -> None:
+        """
+        書き込んだレコードをディスクに反映します。
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.sync()
+        self.file.close()
+
+
+def read_journal(path: str) -> Iterator[Union[JournalPacket, JournalSpeaker]]:
+    """
+    ジャーナルのレコードを順番に読みます。最後の不完全なレコードは無視します。
+    :param path: ジャーナルのパス
+    :return: レコードのイテレーター
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, ssrc, seq, timestamp, real_time, length = RECORD.unpack(header)
+            payload = None
+            if length != NO_PAYLOAD:
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+            if kind == SPEAKER:
+                if payload is not None:
+                    yield JournalSpeaker(ssrc, USER_ID.unpack(payload)[0])
+            else:
+                yield JournalPacket(ssrc, seq, timestamp, real_time, payload)
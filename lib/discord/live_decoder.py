@@ -0,0 +1,217 @@
+"""
+受信したパケットをバックグラウンドで少しずつデコードしておき、リプレイをすぐに作れるようにするデコーダー
+"""
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+import asyncio
+import logging
+import os
+import struct
+import time
+import wave
+
+import numpy as np
+from nacl.exceptions import CryptoError
+
+from lib.dsp import to_int16
+from lib.timeline import Segment, mix_segments
+
+from .activity import SILENCE_PACKET_SIZE, select_segments
+from .buffer_decoder import RTPPacket
+from .jitter import JitterBuffer
+from .opus import Decoder, OpusError
+from .ring_buffer import REPLAY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+REPLAY_PREDECODE = os.environ.get("REPLAY_PREDECODE", "0") != "0"
+SAMPLING_RATE = 48000
+CHANNELS = 2
+DECODE_INTERVAL = 1.0  # デコードを行う間隔(秒)
+RESYNC_THRESHOLD = SAMPLING_RATE * 2  # RTPのタイムスタンプと受信時刻がこれ以上ずれたら受信時刻に合わせる
+
+
+class LiveSpeaker:
+    """
+    一人の話者のデコーダーと、デコードしたPCMの塊(開始位置, int16の配列)
+    """
+    def __init__(self, position: int) -> None:
+        self.decoder = Decoder()
+        self.jitter = JitterBuffer()
+        self.chunks: Deque[Tuple[int, np.ndarray]] = deque()
+        self.position = position
+        self.last_timestamp: Optional[int] = None
+        self.last_length = 0
+
+    def decode_into_chunk(self, data: Optional[bytes], fec: bool = False) -> int:
+        try:
+            pcm = np.empty((self.decoder.frame_size(data), CHANNELS), dtype=np.float32)
+            pcm = pcm[:self.decoder.decode_float_into(data, pcm, fec=fec)]
+        except OpusError:
+            if data is None:
+                raise
+            # 壊れたパケットは欠落したものとしてPLCで補う
+            return self.decode_into_chunk(None)
+        # float32の半分のメモリで保存する
+        self.chunks.append((self.position, np.frombuffer(to_int16(pcm), dtype="<i2").reshape(-1, CHANNELS)))
+        self.position += len(pcm)
+        return len(pcm)
+
+    def decode(self, origin: float, flush: bool) -> None:
+        while True:
+            item = self.jitter.pop(flush)
+            if item is None:
+                return
+            seq, packet = item
+            if packet is None:
+                following = self.jitter.peek(seq + 1)
+                if following is not None and following.decrypted is not None and len(following.decrypted) >= SILENCE_PACKET_SIZE:
+                    length = self.decode_into_chunk(following.decrypted, fec=True)
+                else:
+                    length = self.decode_into_chunk(None)
+                if self.last_timestamp is not None:
+                    self.last_timestamp = (self.last_timestamp + length) % 2 ** 32
+                self.last_length = length
+                continue
+
+            if self.last_timestamp is not None:
+                delta = (packet.timestamp - self.last_timestamp) % 2 ** 32
+                if delta == 0 or delta >= 2 ** 31:
+                    continue
+                if delta > self.last_length:
+                    self.position += delta - self.last_length
+            expected = int((packet.real_time - origin) * SAMPLING_RATE)
+            if abs(self.position - expected) > RESYNC_THRESHOLD:
+                self.position = expected
+            self.last_timestamp = packet.timestamp
+            self.last_length = 0
+            if packet.decrypted is not None and len(packet.decrypted) < SILENCE_PACKET_SIZE:
+                continue
+            self.last_length = self.decode_into_chunk(packet.decrypted)
+
+    def expire(self, before: int) -> None:
+        while self.chunks and self.chunks[0][0] + len(self.chunks[0][1]) <= before:
+            self.chunks.popleft()
+
+    def render(self, start: int, end: int) -> List[Segment]:
+        """
+        startからendまでのPCMを、続いている塊ごとにまとめた-1から1のfloat32の区間にします。
+        :return: startからの位置と(サンプル数, 2)の配列の組のリスト。無音の部分は含みません
+        """
+        runs: List[Tuple[int, List[np.ndarray]]] = []
+        run_end = None
+        for position, chunk in self.chunks:
+            if position + len(chunk) <= start or position >= end:
+                continue
+            part = chunk[max(start - position, 0):end - position]
+            position = max(position, start)
+            if position == run_end:
+                runs[-1][1].append(part)
+            else:
+                runs.append((position - start, [part]))
+            run_end = position + len(part)
+        return [(offset, np.concatenate(parts) * np.float32(1 / 2 ** 15)) for offset, parts in runs]
+
+
+class LiveDecoder:
+    """
+    受信したパケットをDECODE_INTERVALごとに1スレッドのexecutorで復号・デコードし、
+    話者ごとに直近max_age秒のPCMを保持します。replayは保持しているPCMをミックスするだけです。
+    """
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 decrypt: Callable[[bytes], Tuple[bytes, bytes]],
+                 max_age: float = REPLAY_SECONDS) -> None:
+        self.loop = loop
+        self.decrypt = decrypt
+        self.max_age = max_age
+        self.executor = ThreadPoolExecutor(1)
+        self.pending: List[Tuple[float, bytes]] = []
+        self.speakers: Dict[int, LiveSpeaker] = {}
+        self.origin: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.task = self.loop.create_task(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(DECODE_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                # 一度の失敗でデコードを止めると、pendingが溜まり続けてリプレイも古いままになる
+                logger.exception("failed to decode received packets")
+
+    def push(self, real_time: float, datagram: bytes) -> None:
+        if self.origin is None:
+            self.origin = real_time
+        self.pending.append((real_time, datagram))
+
+    async def flush(self, final: bool = False) -> None:
+        items, self.pending = self.pending, []
+        await self.loop.run_in_executor(self.executor, partial(self.process, items, final))
+
+    def process(self, items: List[Tuple[float, bytes]], final: bool) -> None:
+        """
+        executorで実行されます。パケットを復号して話者ごとにデコードし、古いPCMを捨てます。
+        """
+        if self.origin is None:
+            return
+        for real_time, datagram in items:
+            try:
+                header, data = self.decrypt(datagram)
+                packet = RTPPacket(header, data)
+                packet.calc_extention_header_length(data)
+            except (CryptoError, IndexError, struct.error):
+                # 復号できないパケットや短すぎるパケットは捨てる
+                continue
+            packet.real_time = real_time
+            speaker = self.speakers.get(packet.ssrc)
+            if speaker is None:
+                speaker = self.speakers[packet.ssrc] = LiveSpeaker(int((real_time - self.origin) * SAMPLING_RATE))
+            speaker.jitter.push(packet)
+
+        before = int((time.time() - self.origin - self.max_age) * SAMPLING_RATE)
+        for ssrc, speaker in list(self.speakers.items()):
+            speaker.decode(self.origin, final)
+            speaker.expire(before)
+            if not speaker.chunks and not len(speaker.jitter):
+                del self.speakers[ssrc]
+
+    def render(self, seconds: float, now: float, trim: bool = False) -> Optional[BytesIO]:
+        if self.origin is None:
+            return None
+        end = int((now - self.origin) * SAMPLING_RATE)
+        start = end - int(seconds * SAMPLING_RATE)
+        tracks = [segments for segments in (speaker.render(start, end) for speaker in self.speakers.values()) if segments]
+        if not tracks:
+            return None
+
+        file = BytesIO()
+        with wave.open(file, "wb") as wav:
+            wav.setnchannels(CHANNELS)
+            wav.setsampwidth(2)
+            wav.setframerate(SAMPLING_RATE)
+            wav.writeframes(to_int16(mix_segments(select_segments(tracks), end - start, trim)))
+        file.seek(0)
+        return file
+
+    async def replay(self, seconds: float = REPLAY_SECONDS, trim: bool = False) -> Optional[BytesIO]:
+        """
+        直近seconds秒の音声をwavにします。残っているパケットだけをデコードしてからミックスします。
+        :param seconds: 秒数
+        :param trim: Trueの場合は誰も話していない部分を詰めます
+        :return: wavのファイル。音声がない場合はNone
+        """
+        now = time.time()
+        await self.flush(final=True)
+        return await self.loop.run_in_executor(self.executor, partial(self.render, seconds, now, trim))
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
@@ -136,3 +136,29 @@ class Decoder(DiscordDecoder):
 
         # return array.array('f', pcm[:ret * channel_count]).tolist()
         return pcm[:ret * channel_count]
+
+    def frame_size(self, data):
+        """
+        パケットをデコードしたときのサンプル数を求めます。dataがNoneの場合は欠落したパケットを補うサンプル数です。
+        """
+        if data is None:
+            return self._get_last_packet_duration() or self.SAMPLES_PER_FRAME
+        return self.packet_get_nb_frames(data) * self.packet_get_samples_per_frame(data)
+
+    def decode_float_into(self, data, out, *, fec=False):
+        """
+        リストを作らずに、(サンプル数, 2)のC連続なfloat32のNumPy配列にそのままデコードします。
+        :param data: Opusのパケット。Noneの場合はパケットの欠落を補います
+        :param out: 書き込み先。frame_size以上の長さが必要です
+        :return: 書き込んだサンプル数
+        """
+        if not is_loaded():
+            _load_default()
+        if data is None and fec:
+            raise OpusError("Invalid arguments: FEC cannot be used with null data")
+        frame_size = self.frame_size(data)
+        if len(out) < frame_size or out.shape[1:] != (self.CHANNELS,) or out.dtype != "float32" or not out.flags.c_contiguous:
+            raise ValueError("out must be a C-contiguous float32 array of (frame_size, 2)")
+
+        pcm_ptr = out.ctypes.data_as(c_float_ptr)
+        return _lib.opus_decode_float(self._state, data, len(data) if data else 0, pcm_ptr, frame_size, fec)
@@ -0,0 +1,354 @@
+"""
+録音しながら少しずつデコード・ミックス・MP3エンコードを行うパイプライン
+"""
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import logging
+import os
+import time
+
+import lameenc
+import numpy as np
+
+from lib.dsp import mix
+from lib.timeline import TRIM_PADDING, squeeze_silence
+
+from .activity import select_tracks
+from .journal import PacketJournal, JournalPacket, read_journal
+from .opus import Decoder, OpusError
+
+if TYPE_CHECKING:
+    from .buffer_decoder import RTPPacket
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 48000
+CHANNELS = 2
+FLUSH_INTERVAL = 2.0  # デコードを行う間隔(秒)
+LATENCY = 1.0  # 遅れて届くパケットを待つ時間(秒)
+SILENCE_PACKET_SIZE = 10  # これより短いパケットは無音として扱う
+
+
+class SpeakerTrack:
+    """
+    話者ごとのデコーダーと、次にデコードしたPCMを置く録音の中の位置
+    """
+    def __init__(self, position: int) -> None:
+        self.decoder = Decoder()
+        self.position = position
+        self.last_seq: Optional[int] = None
+        self.last_timestamp: Optional[int] = None
+        self.last_length = 0  # 最後のパケットのサンプル数
+
+
+class RecordingPipeline:
+    """
+    受信したパケットを一定間隔でまとめてデコードし、ミックスして一つのMP3エンコーダーに渡し続けます。
+    デコード以降の処理はすべて1スレッドのexecutorで順番に行うので、イベントループを止めません。
+    録音が終わったときには最後の数秒分を処理するだけで済みます。
+    journal_pathを指定すると、デコードする前にパケットをジャーナルに追記するので、
+    プロセスが落ちてもrender_journalで録音を復元できます。
+    pathがNoneの場合はジャーナルに書き込むだけで、デコードもミックスも行いません。
+    trim_silenceがTrueの場合は、誰も話していない部分を前後TRIM_PADDINGずつ残して詰めてからエンコードします。
+    """
+    def __init__(self,
+                 loop: Optional[asyncio.AbstractEventLoop],
+                 path: Optional[str],
+                 journal_path: Optional[str] = None,
+                 bit_rate: int = 128,
+                 trim_silence: bool = False) -> None:
+        self.loop = loop
+        self.path = path
+        self.journal = PacketJournal(journal_path) if journal_path is not None else None
+        self.executor = ThreadPoolExecutor(1)
+        self.encoder = lameenc.Encoder()
+        self.encoder.set_bit_rate(bit_rate)
+        self.encoder.set_quality(2)
+        self.encoder.set_channels(CHANNELS)
+        self.encoder.set_in_sample_rate(SAMPLING_RATE)
+        self.file = open(path, "wb") if path is not None else None
+        self.received = 0  # 受信したパケットの数
+        self.pending: List['RTPPacket'] = []
+        self.pending_speakers: List[Tuple[int, int]] = []
+        self.ssrc: Dict[int, int] = {}
+        self.tracks: Dict[int, SpeakerTrack] = {}
+        self.buffers: Dict[int, np.ndarray] = {}  # ssrc -> writtenから始まる(サンプル数, 2)のPCM。余分に確保した部分は0
+        self.filled: Dict[int, int] = {}  # ssrc -> buffersのうちPCMを書き込んだ長さ
+        self.origin: Optional[float] = None  # 最初のパケットが届いた時刻
+        self.written = 0  # エンコードしたサンプル数
+        self.end = 0  # PCMがある最後の位置
+        self.trim_silence = trim_silence
+        self.silent = TRIM_PADDING  # 最後にエンコードした部分で続いている無音のサンプル数
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        assert self.loop is not None
+        self.task = self.loop.create_task(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                # 一度の失敗でジャーナルへの書き込みを止めない
+                logger.exception("failed to process recorded packets")
+
+    def push(self, packet: 'RTPPacket') -> None:
+        if self.origin is None:
+            self.origin = packet.real_time
+        self.received += 1
+        self.pending.append(packet)
+
+    def add_ssrc(self, data: dict) -> None:
+        self.ssrc[data["ssrc"]] = data["user_id"]
+        self.pending_speakers.append((data["ssrc"], data["user_id"]))
+
+    async def flush(self, final: bool = False) -> None:
+        assert self.loop is not None
+        packets, self.pending = self.pending, []
+        speakers, self.pending_speakers = self.pending_speakers, []
+        horizon = None
+        if not final and self.origin is not None:
+            horizon = int((time.time() - self.origin - LATENCY) * SAMPLING_RATE)
+        await self.loop.run_in_executor(self.executor, partial(self.process, packets, horizon, speakers))
+
+    async def finish(self) -> bool:
+        """
+        残りのパケットを処理してファイルを閉じます。
+        :return: 音声が一つでも録音されていた場合はTrue。pathがNoneの場合はパケットを受信した場合はTrue
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # タスクがどう終わっても残りを処理してファイルを閉じる
+                logger.exception("recording task failed")
+        try:
+            await self.flush(final=True)
+        finally:
+            assert self.loop is not None
+            await self.loop.run_in_executor(self.executor, self.close)
+            self.executor.shutdown(wait=False)
+        if self.file is None:
+            return self.received > 0
+        return self.end > 0
+
+    def process(self,
+                packets: List[Any],
+                horizon: Optional[int],
+                speakers: Optional[List[Tuple[int, int]]] = None) -> None:
+        """
+        executorで実行されます。パケットをジャーナルに書き込んでからデコードし、horizonまでをエンコードします。
+        :param packets: 前回から届いたパケット
+        :param horizon: エンコードする位置。Noneの場合は最後まで
+        :param speakers: 前回から届いたssrcとユーザーIDの組
+        """
+        if self.journal is not None:
+            for ssrc, user_id in speakers or []:
+                self.journal.write_speaker(ssrc, user_id)
+            for packet in packets:
+                self.journal.write_packet(packet)
+            self.journal.sync()
+        if self.file is None:
+            return
+
+        groups: Dict[int, List[Any]] = defaultdict(list)
+        for packet in packets:
+            groups[packet.ssrc].append(packet)
+        for ssrc, group in groups.items():
+            self.decode(ssrc, group)
+        self.emit(self.end if horizon is None else min(horizon, self.end))
+
+    def decode(self, ssrc: int, packets: List['RTPPacket']) -> None:
+        track = self.tracks.get(ssrc)
+        if track is None:
+            assert self.origin is not None
+            start = min(packet.real_time for packet in packets)
+            track = self.tracks[ssrc] = SpeakerTrack(int((start - self.origin) * SAMPLING_RATE))
+
+        base = packets[0].seq if track.last_seq is None else track.last_seq + 1
+        packets.sort(key=lambda p: (p.seq - base) % 65536)
+        for packet in packets:
+            if track.last_timestamp is not None:
+                delta = (packet.timestamp - track.last_timestamp) % 2 ** 32
+                if delta == 0 or delta >= 2 ** 31:
+                    # 重複しているか、すでにデコードした位置より前のパケット
+                    continue
+                if delta > track.last_length:
+                    track.position += delta - track.last_length
+            track.last_seq = packet.seq
+            track.last_timestamp = packet.timestamp
+            track.last_length = 0
+            if packet.decrypted is not None and len(packet.decrypted) < SILENCE_PACKET_SIZE:
+                continue
+
+            try:
+                pcm = self.decode_packet(track.decoder, packet.decrypted)
+            except OpusError:
+                # 壊れたパケットは欠落したものとしてPLCで補う
+                pcm = self.decode_packet(track.decoder, None)
+            self.place(ssrc, track.position, pcm)
+            track.position += len(pcm)
+            track.last_length = len(pcm)
+
+    @staticmethod
+    def decode_packet(decoder: Decoder, data: Optional[bytes]) -> np.ndarray:
+        pcm = np.empty((decoder.frame_size(data), CHANNELS), dtype=np.float32)
+        return pcm[:decoder.decode_float_into(data, pcm)]
+
+    def place(self, ssrc: int, position: int, pcm: np.ndarray) -> None:
+        offset = position - self.written
+        if offset < 0:
+            # すでにエンコードした部分には書き込めない
+            pcm = pcm[-offset:]
+            offset = 0
+        if not len(pcm):
+            return
+        end = offset + len(pcm)
+        self.reserve(ssrc, end)[offset:end] += pcm
+        self.filled[ssrc] = max(self.filled.get(ssrc, 0), end)
+        self.end = max(self.end, position + len(pcm))
+
+    def reserve(self, ssrc: int, end: int) -> np.ndarray:
+        """
+        話者のバッファをend個分まで使えるようにします。足りなくなったら倍の大きさに広げるので、
+        パケットが届くたびに全体をコピーし直すことはありません。
+        """
+        buffer = self.buffers.get(ssrc)
+        if buffer is None or len(buffer) < end:
+            capacity = max(end, len(buffer) * 2 if buffer is not None else 0, SAMPLING_RATE)
+            grown = np.zeros((capacity, CHANNELS), dtype=np.float32)
+            if buffer is not None:
+                filled = self.filled.get(ssrc, 0)
+                grown[:filled] = buffer[:filled]
+            buffer = self.buffers[ssrc] = grown
+        return buffer
+
+    def emit(self, until: int) -> None:
+        count = until - self.written
+        if count <= 0 or self.file is None:
+            return
+        tracks = [self.reserve(ssrc, count)[:count] for ssrc in list(self.buffers)]
+        if tracks:
+            mixed = mix(select_tracks(tracks))
+        else:
+            mixed = np.zeros((count, CHANNELS), dtype=np.float32)
+        for ssrc, buffer in self.buffers.items():
+            # エンコードした部分を捨て、残りを先頭に詰めて後ろを0に戻す
+            filled = self.filled.get(ssrc, 0)
+            rest = max(filled - count, 0)
+            buffer[:rest] = buffer[count:count + rest]
+            buffer[rest:filled] = 0
+            self.filled[ssrc] = rest
+        if self.trim_silence:
+            mixed, self.silent = squeeze_silence(mixed, self.silent, TRIM_PADDING * 2)
+        self.file.write(self.encoder.encode((mixed * (2 ** 15 - 1)).astype(np.int16).tobytes()))
+        self.written = until
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.write(self.encoder.flush())
+            self.file.close()
+        if self.journal is not None:
+            self.journal.close()
+
+
+def replay(pipeline: RecordingPipeline, packets: Iterable[JournalPacket]) -> None:
+    """
+    保存したパケットを録音中と同じ間隔でパイプラインに渡し、最後までエンコードします。
+    pipeline.originが設定されていない場合は最初のパケットの時刻を使います。
+    """
+    batch: List[JournalPacket] = []
+    deadline = None
+    for packet in packets:
+        pipeline.push(packet)
+        assert pipeline.origin is not None
+        if deadline is None:
+            deadline = pipeline.origin + FLUSH_INTERVAL
+        while packet.real_time >= deadline:
+            pipeline.process(batch, int((deadline - pipeline.origin - LATENCY) * SAMPLING_RATE))
+            batch = []
+            deadline += FLUSH_INTERVAL
+        batch.append(packet)
+    pipeline.process(batch, None)
+
+
+def render_journal(journal_path: str, path: str) -> bool:
+    """
+    ジャーナルから録音を作り直します。録音中と同じ間隔でパケットを処理するので同じ結果になります。
+    :param journal_path: ジャーナルのパス
+    :param path: MP3の書き込み先
+    :return: 音声が一つでも録音されていた場合はTrue
+    """
+    pipeline = RecordingPipeline(None, path)
+    try:
+        replay(pipeline, (record for record in read_journal(journal_path) if isinstance(record, JournalPacket)))
+    finally:
+        pipeline.close()
+    return pipeline.end > 0
+
+
+def split_journal(journal_path: str) -> Tuple[Optional[float], Dict[int, List[JournalPacket]], Dict[int, int]]:
+    """
+    ジャーナルのパケットを話者ごとに分けます。
+    :param journal_path: ジャーナルのパス
+    :return: 最初のパケットの時刻, ssrcごとのパケット, ssrcとユーザーIDの対応
+    """
+    origin = None
+    packets: Dict[int, List[JournalPacket]] = defaultdict(list)
+    users: Dict[int, int] = {}
+    for record in read_journal(journal_path):
+        if isinstance(record, JournalPacket):
+            if origin is None:
+                origin = record.real_time
+            packets[record.ssrc].append(record)
+        else:
+            users[record.ssrc] = record.user_id
+    return origin, packets, users
+
+
+def render_track(packets: List[JournalPacket], origin: float, path: str) -> bool:
+    """
+    一人の話者のパケットをMP3にします。他の話者と揃うように録音の開始時刻から無音を入れます。
+    """
+    pipeline = RecordingPipeline(None, path, bit_rate=64)
+    pipeline.origin = origin
+    try:
+        replay(pipeline, packets)
+    finally:
+        pipeline.close()
+    return pipeline.end > 0
+
+
+async def render_tracks(loop: asyncio.AbstractEventLoop,
+                        journal_path: str,
+                        directory: str) -> List[Tuple[int, Optional[int], str]]:
+    """
+    ジャーナルから話者ごとのMP3を並列に作ります。話者ごとに独立しているのでミックスは行いません。
+    :param loop: イベントループ
+    :param journal_path: ジャーナルのパス
+    :param directory: MP3を書き込むディレクトリ
+    :return: ssrc, ユーザーID(わからない場合はNone), MP3のパスの組のリスト
+    """
+    with ThreadPoolExecutor(1) as reader:
+        origin, groups, users = await loop.run_in_executor(reader, partial(split_journal, journal_path))
+    if origin is None:
+        return []
+
+    with ThreadPoolExecutor(min(len(groups), os.cpu_count() or 1)) as executor:
+        paths = {ssrc: os.path.join(directory, f"{ssrc}.mp3") for ssrc in groups}
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, partial(render_track, packets, origin, paths[ssrc]))
+            for ssrc, packets in groups.items()
+        ])
+    return [
+        (ssrc, users.get(ssrc), paths[ssrc])
+        for ssrc, recorded in zip(groups, results) if recorded
+    ]
@@ -0,0 +1,87 @@
+"""
+受信したOpusのパケットをデコードせずに、話者ごとのOgg Opusに詰め直します。
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from collections import defaultdict
+from io import BytesIO
+
+from lib.ogg import OggOpusWriter, SILENCE_SAMPLES
+
+from .recorder import split_journal
+
+SAMPLING_RATE = 48000
+
+
+def remux_speaker(packets: Sequence[Any], origin: float) -> Optional[BytesIO]:
+    """
+    一人の話者のパケットをOgg Opusにします。
+    RTPのタイムスタンプの間が空いているところと、originから話し始めるまでには無音のパケットを入れるので、
+    他の話者のファイルと同じ位置から再生できます。
+    :param packets: ssrc, timestamp, real_time, decryptedを持つパケット。RTPPacketかJournalPacket
+    :param origin: ファイルの先頭にする時刻
+    :return: Ogg Opusのファイル。書き込むパケットがない場合はNone
+    """
+    packets = [packet for packet in packets if packet.decrypted]
+    if not packets:
+        return None
+    first = min(packets, key=lambda packet: packet.real_time)
+    # 最初のパケットからのタイムスタンプの差で並べる。2 ** 31以上はそれより前に送られたものとして扱う
+    offsets: Dict[int, Any] = {}
+    for packet in packets:
+        offset = (packet.timestamp - first.timestamp) % 2 ** 32
+        if offset >= 2 ** 31:
+            offset -= 2 ** 32
+        offsets.setdefault(offset, packet)
+    start = min(offsets)
+
+    file = BytesIO()
+    writer = OggOpusWriter(file, first.ssrc)
+    base = int((first.real_time - origin) * SAMPLING_RATE) - start
+    for offset in sorted(offsets):
+        gap = base + offset - writer.position
+        if gap >= SILENCE_SAMPLES // 2:
+            writer.write_silence(gap)
+        elif gap <= -SILENCE_SAMPLES:
+            # すでに書き込んだ位置と重なっている
+            continue
+        writer.write(offsets[offset].decrypted)
+    writer.close()
+    file.seek(0)
+    return file
+
+
+def remux(packets: Sequence[Any], origin: Optional[float] = None) -> List[Tuple[int, BytesIO]]:
+    """
+    パケットを話者ごとに分けてOgg Opusにします。
+    :param packets: パケット
+    :param origin: ファイルの先頭にする時刻。Noneの場合は最初のパケットの時刻
+    :return: ssrcとOgg Opusのファイルの組のリスト
+    """
+    if not packets:
+        return []
+    if origin is None:
+        origin = min(packet.real_time for packet in packets)
+    groups: Dict[int, List[Any]] = defaultdict(list)
+    for packet in packets:
+        groups[packet.ssrc].append(packet)
+    return [
+        (ssrc, file) for ssrc, file in
+        ((ssrc, remux_speaker(group, origin)) for ssrc, group in groups.items()) if file is not None
+    ]
+
+
+def remux_journal(journal_path: str) -> List[Tuple[int, Optional[int], BytesIO]]:
+    """
+    ジャーナルから話者ごとのOgg Opusを作ります。デコードもエンコードもしないので、render_tracksよりずっと速く終わります。
+    :param journal_path: ジャーナルのパス
+    :return: ssrc, ユーザーID(わからない場合はNone), Ogg Opusのファイルの組のリスト
+    """
+    origin, groups, users = split_journal(journal_path)
+    if origin is None:
+        return []
+    result = []
+    for ssrc, packets in groups.items():
+        file = remux_speaker(packets, origin)
+        if file is not None:
+            result.append((ssrc, users.get(ssrc), file))
+    return result
@@ -1,37 +1,123 @@
-from collections import deque
+"""
+リプレイのために直近の音声パケットを溜めておくリングバッファ
+"""
+from typing import Dict, Iterator, List, Tuple
+from array import array
+from bisect import bisect_left
+import os
+
+REPLAY_SECONDS = float(os.environ.get("REPLAY_SECONDS", 30))  # 保存しておく秒数
+REPLAY_BUFFER_SIZE = int(os.environ.get("REPLAY_BUFFER_SIZE", 8 * 1024 * 1024))  # サーバーごとに保存するバイト数の上限
+COMPACT_THRESHOLD = 1024  # 捨てたパケットがこれより多くなったら配列を詰める
+EXPIRE_INTERVAL = 1.0
+
+
+class PacketHistory:
+    """
+    一人の話者のパケット。受信時刻とデータの位置の配列と、データをつなげた一つのbytearrayで保存します。
+    古いパケットは先頭の位置をずらして捨て、まとまった量になったら配列を詰めます。
+    """
+    def __init__(self) -> None:
+        self.times = array("d")
+        self.offsets = array("Q")  # 最初に追加したパケットからのデータの位置
+        self.data = bytearray()
+        self.head = 0  # 捨てていない最初のパケット
+        self.base = 0  # dataの先頭のoffset
+
+    def __len__(self) -> int:
+        return len(self.times) - self.head
+
+    def end(self, index: int) -> int:
+        return self.offsets[index + 1] if index + 1 < len(self.offsets) else self.base + len(self.data)
+
+    def append(self, real_time: float, datagram: bytes) -> None:
+        self.times.append(real_time)
+        self.offsets.append(self.base + len(self.data))
+        self.data += datagram
+
+    def drop(self, count: int) -> int:
+        """
+        古いパケットをcount個捨てます。
+        :return: 捨てたバイト数
+        """
+        if count <= 0:
+            return 0
+        size = self.end(self.head + count - 1) - self.offsets[self.head]
+        self.head += count
+        if self.head >= COMPACT_THRESHOLD and self.head * 2 >= len(self.times):
+            self.compact()
+        return size
+
+    def drop_before(self, real_time: float) -> int:
+        return self.drop(bisect_left(self.times, real_time, self.head) - self.head)
+
+    def compact(self) -> None:
+        start = self.offsets[self.head] if len(self) else self.base + len(self.data)
+        del self.data[:start - self.base]
+        del self.times[:self.head]
+        del self.offsets[:self.head]
+        self.base = start
+        self.head = 0
+
+    def since(self, real_time: float) -> Iterator[Tuple[float, bytes]]:
+        """
+        real_time以降に受信したパケットをコピーして返します。バッファの中身は変わりません。
+        """
+        for index in range(bisect_left(self.times, real_time, self.head), len(self.times)):
+            start = self.offsets[index] - self.base
+            yield self.times[index], bytes(self.data[start:self.end(index) - self.base])
 
 
 class RingBuffer:
-    def __init__(self, maxlen: int = 2 ** 12) -> None:
-        self.queues: dict = {}
-        self.maxlen = maxlen
+    """
+    話者ごとのPacketHistoryをまとめ、max_age秒より古いパケットとbudgetバイトを超えた分のパケットを捨てます。
+    読み出してもパケットは消えないので、何度でも同じ履歴からリプレイできます。
+    """
+    def __init__(self, max_age: float = REPLAY_SECONDS, budget: int = REPLAY_BUFFER_SIZE) -> None:
+        self.max_age = max_age
+        self.budget = budget
+        self.histories: Dict[int, PacketHistory] = {}
+        self.size = 0
+        self.expired_at = 0.0
+
+    def append(self, ssrc: int, real_time: float, datagram: bytes) -> None:
+        """
+        パケットを追加します。
+        :param ssrc: 話者のssrc
+        :param real_time: 受信した時刻
+        :param datagram: 受信したデータ
+        """
+        history = self.histories.get(ssrc)
+        if history is None:
+            history = self.histories[ssrc] = PacketHistory()
+        history.append(real_time, datagram)
+        self.size += len(datagram)
+
+        if real_time - self.expired_at >= EXPIRE_INTERVAL:
+            self.expire(real_time - self.max_age)
+        while self.size > self.budget:
+            oldest = min((h for h in self.histories.values() if len(h)), key=lambda h: h.times[h.head])
+            self.size -= oldest.drop(1)
+
+    def expire(self, before: float) -> None:
+        self.expired_at = before + self.max_age
+        for ssrc, history in list(self.histories.items()):
+            self.size -= history.drop_before(before)
+            if not len(history):
+                del self.histories[ssrc]
 
-    def append(self, ssrc: int, item: dict) -> None:
-        if ssrc not in self.queues.keys():
-            self.queues[ssrc] = deque(maxlen=self.maxlen)
-        self.queues[ssrc].append(item)
+    def snapshot(self, since: float) -> List[Tuple[int, float, bytes]]:
+        """
+        since以降に受信したパケットを話者ごとに受信した順番で返します。
+        :param since: 時刻
+        :return: ssrc, 受信した時刻, データの組のリスト
+        """
+        return [
+            (ssrc, real_time, datagram)
+            for ssrc, history in list(self.histories.items())
+            for real_time, datagram in history.since(since)
+        ]
 
     def clear(self) -> None:
-        self.queues = {}
-
-    def get_all_items(self, after: float) -> list:
-        """
-        get queue items after time
-        :param after: float
-        :return: List[List[dict]]
-        """
-        results: list = []
-        for ssrc in list(self.queues)[:15]:
-            queue = self.queues[ssrc]
-            result = []
-            while True:
-                try:
-                    item = queue.pop()
-                    if item['time'] < after:
-                        continue
-                    result.append(item)
-                except IndexError:
-                    break
-            results += reversed(result)
-
-        return results
+        self.histories = {}
+        self.size = 0
@@ -1,7 +1,8 @@
 from io import BytesIO
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from discord import VoiceClient
+from lib.discord.ring_buffer import REPLAY_SECONDS
 from lib.discord.websocket import MiniMaidVoiceWebSocket
 
 
@@ -14,8 +15,15 @@ class MiniMaidVoiceClient(VoiceClient):
         self._connected.set()
         return ws
 
-    async def record(self, is_invent: bool = False) -> tuple:  # Tuple[Optional[BytesIO], bool]:
-        return await self.ws.record(self.client, is_invent)
+    async def record(self,
+                     path: Optional[str],
+                     timeout: float,
+                     journal_path: Optional[str] = None,
+                     trim_silence: bool = False) -> bool:
+        return await self.ws.record(self.client, path, timeout, journal_path, trim_silence)
 
-    async def replay(self) -> Optional[BytesIO]:
-        return await self.ws.replay()
+    async def replay(self, seconds: float = REPLAY_SECONDS, trim: bool = False) -> Optional[BytesIO]:
+        return await self.ws.replay(seconds, trim)
+
+    async def replay_tracks(self, seconds: float = REPLAY_SECONDS) -> List[Tuple[int, Optional[int], BytesIO]]:
+        return await self.ws.replay_tracks(seconds)
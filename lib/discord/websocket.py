@@ -1,8 +1,9 @@
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 import asyncio
+import logging
 from aiohttp import ClientWebSocketResponse
 from io import BytesIO
-import sys
+import socket
 import struct
 import time
 
@@ -10,117 +11,197 @@ from discord.gateway import DiscordVoiceWebSocket
 import nacl.secret
 
 from lib.discord.buffer_decoder import BufferDecoder, RTPPacket
-from lib.discord.ring_buffer import RingBuffer
+from lib.discord.live_decoder import LiveDecoder, REPLAY_PREDECODE
+from lib.discord.recorder import RecordingPipeline
+from lib.discord.remux import remux
+from lib.discord.ring_buffer import RingBuffer, REPLAY_SECONDS
 
 if TYPE_CHECKING:
     from bot import MiniMaid
 
+logger = logging.getLogger(__name__)
+
+SSRC = struct.Struct('>I')
+MAX_BATCH = 256  # 1回の呼び出しで読むパケットの数の上限。他の処理を待たせすぎないようにする
+NONCE_PADDING = {size: bytes(24 - size) for size in (4, 8, 12)}
+
 
 class MiniMaidVoiceWebSocket(DiscordVoiceWebSocket):
     def __init__(self, websocket: ClientWebSocketResponse, loop: asyncio.AbstractEventLoop) -> None:
         super().__init__(websocket, loop)
         self.can_record = False
         self.box: Optional[nacl.secret.SecretBox] = None
-        self.decoder = BufferDecoder(self.loop)
+        self.decryptor: Optional[Callable[[bytes], Tuple[bytes, bytes]]] = None
+        self.recorder: Optional[RecordingPipeline] = None
         self.replay_decoder = BufferDecoder(self.loop)
-        self.record_task = None
+        self.receiving_socket: Optional[socket.socket] = None
         self.is_recording = False
         self.ring_buffer = RingBuffer()
+        self.live_decoder: Optional[LiveDecoder] = None
+        self.speakers: Dict[int, int] = {}  # ssrc -> ユーザーID
+
+    def load_decryptor(self) -> Callable[[bytes], Tuple[bytes, bytes]]:
+        """
+        セッションの鍵と暗号化の方式から、復号に使う関数を一度だけ決めます。
+        :return: 復号に使う関数
+        """
+        self.box = nacl.secret.SecretBox(bytes(self._connection.secret_key))
+        self.decryptor = decryptor = getattr(self, f'decrypt_{self._connection.mode}')
+        return decryptor
 
-    def decrypt_xsalsa20_poly1305(self, data: bytes) -> tuple:
+    def decrypt_xsalsa20_poly1305(self, data: bytes) -> Tuple[bytes, bytes]:
         if self.box is None:
             raise ValueError("box is None")
-        is_rtcp = 200 <= data[1] < 205
-        if is_rtcp:
-            header, encrypted = data[:8], data[8:]
-            nonce = bytearray(24)
-            nonce[:8] = header
-        else:
-            header, encrypted = data[:12], data[12:]
-            nonce = bytearray(24)
-            nonce[:12] = header
-        return header, self.box.decrypt(bytes(encrypted), bytes(nonce))
-
-    def decrypt_xsalsa20_poly1305_suffix(self, data: bytes) -> tuple:
+        view = memoryview(data)
+        # nonceはヘッダーの後ろを0で埋めたもの
+        size = 8 if 200 <= data[1] < 205 else 12
+        header = data[:size]
+        return header, self.box.decrypt(view[size:], header + NONCE_PADDING[size])
+
+    def decrypt_xsalsa20_poly1305_suffix(self, data: bytes) -> Tuple[bytes, bytes]:
         if self.box is None:
             raise ValueError("box is None")
-        is_rtcp = 200 <= data[1] < 205
-        if is_rtcp:
-            header, encrypted, nonce = data[:8], data[8:-24], data[-24:]
-        else:
-            header, encrypted, nonce = data[:12], data[12:-24], data[-24:]
-        return header, self.box.decrypt(bytes(encrypted), bytes(nonce))
-
-    def decrypt_xsalsa20_poly1305_lite(self, data: bytes) -> tuple:
+        view = memoryview(data)
+        size = 8 if 200 <= data[1] < 205 else 12
+        return data[:size], self.box.decrypt(view[size:-24], data[-24:])
+
+    def decrypt_xsalsa20_poly1305_lite(self, data: bytes) -> Tuple[bytes, bytes]:
         if self.box is None:
             raise ValueError("box is None")
-        is_rtcp = 200 <= data[1] < 205
-        if is_rtcp:
-            header, encrypted, _nonce = data[:8], data[8:-4], data[-4:]
-        else:
-            header, encrypted, _nonce = data[:12], data[12:-4], data[-4:]
-        nonce = bytearray(24)
-        nonce[:4] = _nonce
-        return header, self.box.decrypt(bytes(encrypted), bytes(nonce))
-
-    async def receive_audio_packet(self) -> None:
-        try:
-            state = self._connection
-            while True:
-                recv = await self.loop.sock_recv(state.socket, 2 ** 16)
-                if not self.is_recording:
-                    if 200 <= recv[1] <= 204:
-                        continue
-                    seq, timestamp, ssrc = struct.unpack_from('>HII', recv, 2)
-                    self.ring_buffer.append(ssrc, dict(time=time.time(), data=recv))
-                    continue
-                decrypt_fn = getattr(self, f'decrypt_{state.mode}')
-                header, data = decrypt_fn(recv)
-                if 200 <= recv[1] <= 204:
-                    continue
-                packet = RTPPacket(header, data)
-                packet.calc_extention_header_length(data)
-                packet.set_real_time()
-                await self.decoder.push(packet)
-        except Exception as e:
-            print(e)
-            print("error at record")
-            print(sys.exc_info())
-
-    async def replay(self) -> BytesIO:
-        self.box = nacl.secret.SecretBox(bytes(self._connection.secret_key))
-        state = self._connection
-        self.is_recording = True
-        try:
-            items = self.ring_buffer.get_all_items(time.time() - 30)
-            self.replay_decoder.clean()
-
-            for item in items:
-                decrypt_fn = getattr(self, f'decrypt_{state.mode}')
-                header, data = decrypt_fn(item['data'])
-                packet = RTPPacket(header, data)
-                packet.calc_extention_header_length(data)
-                packet.real_time = item['time']
-                await self.replay_decoder.push(packet)
-        finally:
-            self.is_recording = False
-
-        return await self.replay_decoder.decode()
-
-    async def record(self, bot: 'MiniMaid', is_invent: bool = False) -> tuple:  # Tuple[BytesIO, bool]
-        self.decoder.clean()
-        self.box = nacl.secret.SecretBox(bytes(self._connection.secret_key))
+        view = memoryview(data)
+        size = 8 if 200 <= data[1] < 205 else 12
+        return data[:size], self.box.decrypt(view[size:-4], data[-4:] + NONCE_PADDING[4])
+
+    def start_receiving(self) -> None:
+        """
+        UDPのソケットが読めるようになったらon_readableが呼ばれるようにします。
+        パケットごとにコルーチンを再開するのではなく、1回の呼び出しで溜まっているパケットをまとめて読みます。
+        """
+        self.stop_receiving()
+        self.receiving_socket = self._connection.socket
+        self.receiving_socket.setblocking(False)
+        self.loop.add_reader(self.receiving_socket.fileno(), self.on_readable)
+
+    def stop_receiving(self) -> None:
+        if self.receiving_socket is None:
+            return
+        fileno = self.receiving_socket.fileno()
+        if fileno != -1:
+            self.loop.remove_reader(fileno)
+        self.receiving_socket = None
+
+    def on_readable(self) -> None:
+        sock = self.receiving_socket
+        if sock is None:
+            return
+        batch = []
+        for _ in range(MAX_BATCH):
+            try:
+                batch.append(sock.recv(2 ** 16))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                logger.exception("failed to receive voice packets")
+                self.stop_receiving()
+                break
+        self.handle_datagrams(batch)
+
+    def handle_datagrams(self, batch: List[bytes]) -> None:
+        real_time = time.time()
+        for recv in batch:
+            try:
+                self.handle_datagram(recv, real_time)
+            except Exception:
+                # 壊れたパケットがあっても同じバッチの残りのパケットは処理する
+                logger.exception("failed to handle a voice packet")
+
+    def handle_datagram(self, recv: bytes, real_time: float) -> None:
+        if len(recv) < 12 or 200 <= recv[1] <= 204:
+            return
+        # 録音中も含めて常に暗号化されたまま溜めておき、リプレイするときだけ復号する
+        ssrc, = SSRC.unpack_from(recv, 8)
+        self.ring_buffer.append(ssrc, real_time, recv)
+        if self.live_decoder is not None:
+            self.live_decoder.push(real_time, recv)
+        if not self.is_recording or self.decryptor is None:
+            return
+        header, data = self.decryptor(recv)
+        packet = RTPPacket(header, data)
+        packet.calc_extention_header_length(data)
+        packet.real_time = real_time
+        if self.recorder is not None:
+            self.recorder.push(packet)
+
+    async def replay(self, seconds: float = REPLAY_SECONDS, trim: bool = False) -> Optional[BytesIO]:
+        """
+        直近seconds秒の音声をwavにします。リングバッファの中身は消さないので、続けて何度でも呼べます。
+        :param seconds: 秒数
+        :param trim: Trueの場合は誰も話していない部分を詰めます
+        :return: wavのファイル。音声がない場合はNone
+        """
+        if self.live_decoder is not None:
+            return await self.live_decoder.replay(seconds, trim)
+
+        self.replay_decoder.clean()
+        for packet in self.snapshot(seconds):
+            await self.replay_decoder.push(packet)
+
+        return await self.replay_decoder.decode(trim)
+
+    async def replay_tracks(self, seconds: float = REPLAY_SECONDS) -> List[Tuple[int, Optional[int], BytesIO]]:
+        """
+        直近seconds秒の音声を、デコードせずに話者ごとのOgg Opusにします。
+        :param seconds: 秒数
+        :return: ssrc, ユーザーID(わからない場合はNone), Ogg Opusのファイルの組のリスト
+        """
+        packets = self.snapshot(seconds)
+        tracks = await self.loop.run_in_executor(None, remux, packets, time.time() - seconds)
+        return [(ssrc, self.speakers.get(ssrc), file) for ssrc, file in tracks]
+
+    def snapshot(self, seconds: float) -> List[RTPPacket]:
+        """
+        リングバッファから直近seconds秒のパケットを取り出して復号します。
+        """
+        decrypt = self.load_decryptor()
+        packets = []
+        for _, real_time, datagram in self.ring_buffer.snapshot(time.time() - seconds):
+            header, data = decrypt(datagram)
+            packet = RTPPacket(header, data)
+            packet.calc_extention_header_length(data)
+            packet.real_time = real_time
+            packets.append(packet)
+        return packets
+
+    async def record(self,
+                     bot: 'MiniMaid',
+                     path: Optional[str],
+                     timeout: float,
+                     journal_path: Optional[str] = None,
+                     trim_silence: bool = False) -> bool:
+        """
+        record_stopが呼ばれるかtimeout秒たつまで録音し、MP3をpathに書き込みます。
+        journal_pathを指定すると受信したパケットをそこに追記します。
+        pathがNoneの場合はジャーナルに書き込むだけです。
+        trim_silenceがTrueの場合は誰も話していない部分を詰めて書き込みます。
+        :return: 音声が録音された場合はTrue
+        """
+        self.load_decryptor()
+        self.recorder = RecordingPipeline(self.loop, path, journal_path, trim_silence=trim_silence)
+        for ssrc, user_id in self.speakers.items():
+            # 録音を始める前に話した人も、ジャーナルと話者ごとのファイルで名前がわかるようにする
+            self.recorder.add_ssrc({"ssrc": ssrc, "user_id": user_id})
+        self.recorder.start()
 
         self.is_recording = True
-        is_continuing = False
         try:
-            await bot.wait_for("record_stop", timeout=1 * 60 if is_invent else 30)  # 1 file 1 minute
+            await bot.wait_for("record_stop", timeout=timeout)
         except asyncio.TimeoutError:
-            is_continuing = True
-        self.ring_buffer.clear()
-        self.is_recording = False
+            pass
+        finally:
+            self.is_recording = False
+            recorder, self.recorder = self.recorder, None
 
-        return (await self.decoder.decode_to_mp3(), is_continuing)
+        return await recorder.finish()
 
     async def received_message(self, msg: dict) -> None:
         await super(MiniMaidVoiceWebSocket, self).received_message(msg)
@@ -130,12 +211,20 @@ class MiniMaidVoiceWebSocket(DiscordVoiceWebSocket):
 
         if op == 4:
             self.can_record = True
-            self.record_task = self.loop.create_task(self.receive_audio_packet())
+            decrypt = self.load_decryptor()
+            if REPLAY_PREDECODE and self.live_decoder is None:
+                # 受信したパケットをバックグラウンドでデコードしておく
+                self.live_decoder = LiveDecoder(self.loop, decrypt)
+                self.live_decoder.start()
+            self.start_receiving()
         elif op == 5:
-            if self.is_recording:
-                self.decoder.add_ssrc(data)
+            if data is not None:
+                self.speakers[data["ssrc"]] = data["user_id"]
+            if self.recorder is not None and data is not None:
+                self.recorder.add_ssrc(data)
 
     async def close(self, code: int = 1000) -> None:
-        if self.record_task is not None:
-            self.record_task.cancel()
+        self.stop_receiving()
+        if self.live_decoder is not None:
+            await self.live_decoder.close()
         await super(MiniMaidVoiceWebSocket, self).close(code)
@@ -0,0 +1,379 @@
+"""
+audioopを使わずにNumPyでPCMを変換するモジュール
+
+サンプル幅の変換、チャンネル数の変換、ポリフェーズフィルタによるリサンプリングと、ラウドネスの測定を行います。
+PCMは(フレーム数, チャンネル数)のfloat32の配列として扱います。
+"""
+from typing import Union, List, Optional, Sequence
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+
+SAMPLING_RATE = 48000
+CHANNELS = 2
+# ITU-R BS.1770のK特性フィルタ(48kHz)の係数。(b, a)の組
+K_WEIGHTING = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+
+
+def to_float(data: Union[bytes, bytearray, memoryview], width: int, channels: int, gain: float = 1.0) -> np.ndarray:
+    """
+    リニアPCMを-1.0から1.0のfloat32の配列に変換します。
+    :param data: PCMのデータ
+    :param width: サンプル幅(byte)。1byteの場合はwavと同じく符号なしとして扱います
+    :param channels: チャンネル数
+    :param gain: 変換と同時にかける音量の倍率
+    :return: (フレーム数, チャンネル数)の配列
+    """
+    if width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        # 一番よく使う幅なので、型の変換と倍率をかけるのを1回の走査で行う
+        samples = np.multiply(np.frombuffer(data, dtype="<i2"), np.float32(gain / 2 ** 15), dtype=np.float32)
+        gain = 1.0
+    elif width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8)
+        raw = raw[:len(raw) - len(raw) % 3].reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values = np.where(values >= 2 ** 23, values - 2 ** 24, values)
+        samples = values.astype(np.float32) / 2 ** 23
+    elif width == 4:
+        samples = (np.frombuffer(data, dtype="<i4") / 2 ** 31).astype(np.float32)
+    else:
+        raise ValueError(f"unsupported sample width: {width}")
+    if gain != 1.0:
+        samples *= np.float32(gain)
+
+    return samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+
+
+def to_int16(samples: np.ndarray) -> bytes:
+    """
+    float32の配列を16bitのリニアPCMに変換します。
+    :param samples: -1.0から1.0の配列
+    :return: PCMのデータ
+    """
+    return np.clip(samples * 2 ** 15, -2 ** 15, 2 ** 15 - 1).astype("<i2").tobytes()
+
+
+def to_stereo(samples: np.ndarray) -> np.ndarray:
+    """
+    チャンネル数を2にします。
+    モノラルは両方のチャンネルに複製し、3チャンネル以上は偶数番目を左、奇数番目を右に平均します。
+    :param samples: (フレーム数, チャンネル数)の配列
+    :return: (フレーム数, 2)の配列
+    """
+    channels = samples.shape[1]
+    if channels == 2:
+        return samples
+    if channels == 1:
+        return np.repeat(samples, 2, axis=1)
+    return np.stack([samples[:, 0::2].mean(axis=1), samples[:, 1::2].mean(axis=1)], axis=1)
+
+
+def to_mono(samples: np.ndarray) -> np.ndarray:
+    return samples.mean(axis=1, keepdims=True)
+
+
+def soft_clip_add(result: np.ndarray, samples: np.ndarray) -> None:
+    """
+    resultにsamplesをその場で重ね合わせます。
+    """
+    # 同じ符号のときだけ積が正になる
+    product = result * samples
+    np.maximum(product, 0, out=product)
+    product *= np.sign(result)
+    result += samples
+    result -= product
+
+
+def mix(tracks: Sequence[Union[np.ndarray, List[float]]], block: int = 960) -> np.ndarray:
+    """
+    複数の話者のPCMを重ね合わせます。
+    前の話者までの結果と同じ符号のサンプルはa + b - |ab|で飽和させ、最後に-1から1の範囲に収めます。
+    話者ごとにサンプル全体をまとめて計算するので、ループは話者の数だけです。
+    無音のところは結果が変わらないので、blockサンプルごとに音があるところだけを計算します。
+    :param tracks: 話者ごとの-1から1のサンプルの配列。長さは違っていてもよく、短いものは無音として扱います
+    :param block: 無音かどうかを調べる単位のサンプル数
+    :return: 最も長い話者と同じ長さのfloat32の配列
+    """
+    arrays = [np.asarray(track, dtype=np.float32) for track in tracks]
+    if not arrays:
+        return np.zeros(0, dtype=np.float32)
+    length = max(len(array) for array in arrays)
+    result = np.zeros((length,) + arrays[0].shape[1:], dtype=np.float32)
+    for array in arrays:
+        blocks = len(array) // block
+        body = blocks * block
+        if blocks:
+            samples = array[:body].reshape(blocks, -1)
+            active = np.flatnonzero(samples.any(axis=1))
+            target = result[:body].reshape(blocks, -1)
+            if len(active) == blocks:
+                soft_clip_add(target, samples)
+            elif len(active):
+                selected = target[active]
+                soft_clip_add(selected, samples[active])
+                target[active] = selected
+        soft_clip_add(result[body:len(array)], array[body:])
+    return np.clip(result, -1, 1, out=result)
+
+
+@lru_cache(maxsize=16)
+def polyphase_filter(up: int, down: int, taps: int) -> np.ndarray:
+    """
+    Kaiser窓をかけたsinc関数のローパスフィルタをポリフェーズに分解します。
+    :param up: アップサンプリングの倍率
+    :param down: ダウンサンプリングの倍率
+    :param taps: 1フェーズあたりのタップ数
+    :return: (up, タップ数)の係数
+    """
+    taps *= max(1, -(-down // up))
+    # 遅延が整数になるように奇数長で設計し、足りない分は0で埋める
+    length = taps * up - (1 - taps * up % 2)
+    cutoff = 0.5 / max(up, down) * 0.95
+    n = np.arange(length) - (length - 1) // 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, 8.0) * up
+    h = np.concatenate([h, np.zeros(taps * up - length)])
+    # h[phase + k * up]がphaseのk番目の係数になる
+    return h.reshape(taps, up).T.astype(np.float32).copy()
+
+
+class Resampler:
+    """
+    状態を持ち、連続したブロックを順番に変換できるリサンプラーです。
+
+    up/downの比で変換するとき、出力のup個ごとに入力がdown個進み、各出力に使うフィルタの位相は同じ並びを繰り返します。
+    そのため、入力をdownずつずらしたウィンドウの行列と、係数を並べた行列の積で出力をまとめて計算します。
+    """
+    BLOCK = 2 ** 16
+
+    def __init__(self, rate: int, channels: int, out_rate: int = SAMPLING_RATE, taps: int = 16) -> None:
+        divisor = gcd(rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = rate // divisor
+        self.channels = channels
+        self.consumed = 0
+        self.produced = 0
+
+        coefficients = polyphase_filter(self.up, self.down, taps)
+        taps = coefficients.shape[1]
+        # フィルタの遅延の分だけ先の入力を使って出力の位置を合わせる
+        delay = (taps * self.up - 1) // 2
+        slots = np.arange(self.up)
+        bases = (slots * self.down + delay) // self.up
+        phases = (slots * self.down + delay) % self.up
+        self.low = int(bases[0]) - (taps - 1)
+        self.span = int(bases[-1]) - self.low + 1
+        self.weights = np.zeros((self.span, self.up), dtype=np.float32)
+        for k in range(taps):
+            self.weights[bases - k - self.low, slots] = coefficients[phases, k]
+
+        self.buffer = np.zeros((channels, max(0, -self.low)), dtype=np.float32)
+        self.start = -self.buffer.shape[1]  # bufferの先頭の入力の位置
+        self.period = 0  # 次に出力する周期
+
+    @property
+    def is_passthrough(self) -> bool:
+        return self.up == self.down == 1
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """
+        ブロックをリサンプリングします。
+        :param samples: (フレーム数, チャンネル数)の配列
+        :return: リサンプリングした配列
+        """
+        if self.is_passthrough:
+            return samples
+        self.consumed += len(samples)
+        results = [self._process(samples[i:i + self.BLOCK]) for i in range(0, len(samples), self.BLOCK)]
+        if not results:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        result = np.concatenate(results)
+        self.produced += len(result)
+        return result
+
+    def flush(self) -> np.ndarray:
+        """
+        フィルタに残っているサンプルを出力します。
+        :return: 残りの配列
+        """
+        if self.is_passthrough:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        expected = -(-self.consumed * self.up // self.down)
+        rest = expected - self.produced
+        if rest <= 0:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        last = (expected - 1) // self.up
+        padding = last * self.down + self.low + self.span - (self.start + self.buffer.shape[1])
+        result = self._process(np.zeros((max(padding, 0), self.channels), dtype=np.float32))[:rest]
+        self.produced += len(result)
+        return result
+
+    def _process(self, samples: np.ndarray) -> np.ndarray:
+        # 転置と型の変換を前回の残りとつなげるコピーと一緒に行う。チャンネルごとに代入するほうが転置全体より速い
+        rest = self.buffer.shape[1]
+        buffer = np.empty((self.channels, rest + len(samples)), dtype=np.float32)
+        buffer[:, :rest] = self.buffer
+        for channel in range(self.channels):
+            buffer[channel, rest:] = samples[:, channel]
+        end = self.start + buffer.shape[1]
+        last = (end - self.low - self.span) // self.down
+        count = last - self.period + 1
+        if count <= 0:
+            self.buffer = buffer
+            return np.zeros((0, self.channels), dtype=np.float32)
+
+        offset = self.period * self.down + self.low - self.start
+        channel_stride, stride = buffer.strides
+        windows = np.lib.stride_tricks.as_strided(
+            buffer[:, offset:],
+            shape=(self.channels, count, self.span),
+            strides=(channel_stride, stride * self.down, stride),
+            writeable=False
+        )
+        result = windows @ self.weights  # (チャンネル数, 周期数, up)
+
+        self.period += count
+        drop = self.period * self.down + self.low - self.start
+        self.buffer = buffer[:, drop:]
+        self.start += drop
+        return result.reshape(self.channels, count * self.up).T
+
+
+class LoudnessMeter:
+    """
+    EBU R128の方式で48kHzのPCMの統合ラウドネス(LUFS)を測定します。ブロックごとに続けて渡せます。
+
+    K特性フィルタはIIRフィルタを順番にかける代わりに、100msの区間ごとにFFTをとり、
+    周波数特性の2乗をかけてからパーセバルの定理でエネルギーを求めます。
+    400msのブロックは連続する4区間の平均になります。
+    """
+    SEGMENT = SAMPLING_RATE // 10
+
+    def __init__(self) -> None:
+        frequencies = np.fft.rfftfreq(self.SEGMENT) * 2 * np.pi
+        z = np.exp(-1j * frequencies)
+        response = np.ones_like(z)
+        for b, a in K_WEIGHTING:
+            response *= np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+        # 片側スペクトルなので直流とナイキスト以外は2倍する
+        self.weights = np.abs(response) ** 2 * 2
+        self.weights[0] /= 2
+        self.weights[-1] /= 2
+        self.weights /= self.SEGMENT ** 2
+        self.rest = np.zeros((0, CHANNELS), dtype=np.float32)
+        self.energies: List[np.ndarray] = []
+
+    def process(self, samples: np.ndarray) -> None:
+        """
+        PCMを渡します。
+        :param samples: 48kHzの(フレーム数, チャンネル数)の配列
+        """
+        samples = np.concatenate([self.rest, samples])
+        count = len(samples) // self.SEGMENT
+        self.rest = samples[count * self.SEGMENT:]
+        if not count:
+            return
+        segments = samples[:count * self.SEGMENT].reshape(count, self.SEGMENT, -1)
+        spectrum = np.abs(np.fft.rfft(segments, axis=1)) ** 2
+        # 区間ごとのチャンネルの平均二乗の和
+        self.energies.append(np.einsum("sfc,f->s", spectrum, self.weights))
+
+    def integrated(self) -> Optional[float]:
+        """
+        統合ラウドネスを返します。
+        :return: LUFS。短すぎるか無音の場合はNone
+        """
+        if not self.energies:
+            return None
+        energies = np.concatenate(self.energies)
+        if len(energies) < 4:
+            return None
+        blocks = np.convolve(energies, np.ones(4) / 4, mode="valid")
+        blocks = blocks[blocks > 0]
+        loudness = -0.691 + 10 * np.log10(blocks) if len(blocks) else blocks
+        gated = blocks[loudness > -70]
+        if not len(gated):
+            return None
+        threshold = -0.691 + 10 * np.log10(gated.mean()) - 10
+        gated = blocks[(loudness > -70) & (loudness > threshold)]
+        return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def loudness_gain(loudness: Optional[float], target: float = -18.0, max_gain: float = 4.0) -> float:
+    """
+    ラウドネスをtargetに揃えるための倍率を求めます。
+    :param loudness: 測定したラウドネス(LUFS)
+    :param target: 目標のラウドネス(LUFS)
+    :param max_gain: 小さい音を大きくするときの倍率の上限
+    :return: 倍率。ラウドネスが測定できなかった場合は1.0
+    """
+    if loudness is None:
+        return 1.0
+    return float(min(10 ** ((target - loudness) / 20), max_gain))
+
+
+class Converter:
+    """
+    任意のリニアPCMを48kHz・16bit・ステレオに変換します。ブロックごとに続けて変換できます。
+    gainを指定すると変換と同時に音量を変えます。
+    """
+    def __init__(self, rate: int, channels: int, width: int = 2, gain: float = 1.0) -> None:
+        self.rate = rate
+        self.channels = channels
+        self.width = width
+        self.gain = gain
+        self.resampler = Resampler(rate, CHANNELS)
+
+    @property
+    def is_passthrough(self) -> bool:
+        return self.rate == SAMPLING_RATE and self.channels == CHANNELS and self.width == 2 and self.gain == 1.0
+
+    def convert(self, data: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+        """
+        PCMを変換します。
+        :param data: 変換するPCM
+        :return: 変換したPCM
+        """
+        if self.is_passthrough:
+            return data
+        # 音量はリサンプリングの前にかけても結果は同じなので、float32に変換するときにまとめてかける
+        return self.output(self.resampler.process(to_stereo(to_float(data, self.width, self.channels, self.gain))))
+
+    def flush(self) -> bytes:
+        """
+        リサンプラーに残っているPCMを出力します。最後のブロックのあとに呼んでください。
+        :return: 残りのPCM
+        """
+        return self.output(self.resampler.flush())
+
+    @staticmethod
+    def output(samples: np.ndarray) -> bytes:
+        # samplesは変換の途中で作った配列なので、to_int16と同じ計算をその場で行って20msごとの確保を減らす
+        samples *= np.float32(2 ** 15)
+        np.clip(samples, -2 ** 15, 2 ** 15 - 1, out=samples)
+        if samples.flags.c_contiguous:
+            return samples.astype("<i2").tobytes()
+        # リサンプラーの出力はチャンネルごとに並んでいるので、チャンネルごとに代入して交互に並べる。全体を転置するより速い
+        pcm = np.empty(samples.shape, dtype="<i2")
+        for channel in range(samples.shape[1]):
+            pcm[:, channel] = samples[:, channel]
+        return pcm.tobytes()
+
+
+def convert(data: bytes, rate: int, channels: int, width: int, gain: float = 1.0) -> bytes:
+    """
+    PCMを一度に48kHz・16bit・ステレオに変換します。
+    :param data: 変換するPCM
+    :param rate: サンプリングレート
+    :param channels: チャンネル数
+    :param width: サンプル幅
+    :param gain: 音量の倍率
+    :return: 変換したPCM
+    """
+    converter = Converter(rate, channels, width, gain)
+    return b"".join([converter.convert(data), converter.flush()])
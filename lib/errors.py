@@ -23,6 +23,26 @@ class AudioFileNotFound(MiniMaidException):
         return "タグに紐つけられているオーディオファイルが存在しません。"
 
 
+class AudioFileTooLarge(MiniMaidException):
+    def message(self) -> str:
+        return "ファイルサイズがデカすぎます。25MB以内にしてください。"
+
+
+class InvalidAudioFile(MiniMaidException):
+    def message(self) -> str:
+        return "オーディオファイルの形式に対応していません。"
+
+
+class AudioLoadFailed(MiniMaidException):
+    def message(self) -> str:
+        return "オーディオファイルの読み込み中にエラーが発生しました。"
+
+
+class SeekFailed(MiniMaidException):
+    def message(self) -> str:
+        return "まだ読み込まれていない位置には移動できません。"
+
+
 class LibInitializationException(Exception):
     pass
 
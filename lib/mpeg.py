@@ -0,0 +1,121 @@
+"""
+MPEGオーディオのフレームヘッダーを読み、フレームの位置のインデックスを作成します。
+"""
+from typing import Optional, Tuple, Union
+from array import array
+
+# [version][layer] -> kbps
+BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLING_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 25: (11025, 12000, 8000)}
+VERSIONS = {0: 25, 2: 2, 3: 1}
+LAYERS = {1: 3, 2: 2, 3: 1}
+
+
+def parse_header(header: Union[bytes, bytearray]) -> Optional[Tuple[int, int, int]]:
+    """
+    フレームヘッダーを解析します。
+    :param header: フレームの先頭4バイト
+    :return: フレームのバイト数, サンプリングレート, フレームあたりのサンプル数。ヘッダーでない場合はNone
+    """
+    if header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return None
+    version = VERSIONS.get((header[1] >> 3) & 0b11)
+    layer = LAYERS.get((header[1] >> 1) & 0b11)
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0b11
+    if version is None or layer is None or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    padding = (header[2] >> 1) & 1
+    bitrate = BITRATES[(min(version, 2), layer)][bitrate_index] * 1000
+    rate = SAMPLING_RATES[version][rate_index]
+
+    if layer == 1:
+        return (12 * bitrate // rate + padding) * 4, rate, 384
+    if layer == 3 and version != 1:
+        return 72 * bitrate // rate + padding, rate, 576
+    return 144 * bitrate // rate + padding, rate, 1152
+
+
+def id3_size(data: Union[bytes, bytearray]) -> int:
+    """
+    ID3v2タグのバイト数を返します。
+    """
+    if data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+class FrameIndex:
+    """
+    少しずつ渡されるMPEGオーディオのデータから、各フレームのファイル内の位置を記録します。
+    時間からファイル内の位置をO(1)で求められます。
+    """
+    def __init__(self) -> None:
+        self.offsets = array("Q")
+        self.rate: Optional[int] = None
+        self.samples_per_frame = 1152
+        self.size = 0  # 渡されたデータのバイト数
+        self.position: Optional[int] = None  # 次に読むフレームヘッダーの位置
+        self.buffer = bytearray()  # positionから始まるまだ解析していないデータ
+
+    def feed(self, data: bytes) -> None:
+        start = self.size
+        self.size += len(data)
+        if self.position is None:
+            self.buffer += data
+            if len(self.buffer) < 10:
+                return
+            self.position = id3_size(self.buffer)
+            data = bytes(self.buffer)
+            start = 0
+            self.buffer.clear()
+        if self.position >= self.size:
+            return
+        self.buffer += data[max(self.position - start, 0):]
+        self.parse()
+
+    def parse(self) -> None:
+        assert self.position is not None
+        offset = 0
+        while offset + 4 <= len(self.buffer):
+            frame = parse_header(self.buffer[offset:offset + 4])
+            if frame is None:
+                offset += 1
+                continue
+            length, rate, samples = frame
+            if self.rate is None:
+                self.rate, self.samples_per_frame = rate, samples
+            self.offsets.append(self.position + offset)
+            offset += length
+        del self.buffer[:offset]
+        self.position += offset
+
+    @property
+    def duration(self) -> float:
+        if self.rate is None:
+            return 0
+        return len(self.offsets) * self.samples_per_frame / self.rate
+
+    def frame_at(self, seconds: float) -> int:
+        if self.rate is None:
+            return 0
+        return int(seconds * self.rate / self.samples_per_frame)
+
+    def offset(self, frame: int) -> Optional[int]:
+        """
+        フレームのファイル内の位置を返します。
+        :param frame: フレームの番号
+        :return: 位置。まだインデックスされていない場合はNone
+        """
+        if frame >= len(self.offsets):
+            return None
+        return self.offsets[frame]
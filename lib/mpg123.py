@@ -1,10 +1,11 @@
 """
 Code by https://github.com/20tab/mpg123-python
 """
-from typing import Any
+from typing import Any, Optional, List, Union
 import ctypes
 from ctypes.util import find_library
 import sys
+import threading
 
 from lib.errors import (
     LibInitializationException,
@@ -62,12 +63,19 @@ class ID3v1(ctypes.Structure):
     ]
 
 
-class Mpg123:
-    def plain_strerror(self, errcode: int) -> str:
-        self._lib.mpg123_plain_strerror.restype = ctypes.c_char_p
-        return self._lib.mpg123_plain_strerror(errcode).decode()
+_lib: Optional[ctypes.CDLL] = None
+_lib_lock = threading.Lock()
+
+
+def load_library(library_path: Optional[str] = None) -> ctypes.CDLL:
+    """
+    libmpg123を読み込みます。読み込みと初期化はプロセスで一度だけ行われます。
+    """
+    global _lib
+    with _lib_lock:
+        if _lib is not None:
+            return _lib
 
-    def init_library(self, library_path: str = None) -> ctypes.CDLL:
         if not library_path:
             library_path = find_library('mpg123')
 
@@ -78,19 +86,31 @@ class Mpg123:
             raise LibInitializationException('libmpg123 not found')
 
         lib = ctypes.CDLL(library_path)
+        lib.mpg123_plain_strerror.restype = ctypes.c_char_p
+        lib.mpg123_new.restype = ctypes.c_void_p
         errcode = lib.mpg123_init()
         if errcode != OK:
-            raise LibInitializationException(self.plain_strerror(errcode))
+            raise LibInitializationException(lib.mpg123_plain_strerror(errcode).decode())
+        _lib = lib
         return lib
 
+
+class Mpg123:
+    def plain_strerror(self, errcode: int) -> str:
+        return self._lib.mpg123_plain_strerror(errcode).decode()
+
+    def init_library(self, library_path: str = None) -> ctypes.CDLL:
+        return load_library(library_path)
+
     def __init__(self, filename: str = None, library_path: str = None) -> None:
         self.handle = None
         self._lib = self.init_library(library_path)
-        self._lib.mpg123_new.restype = ctypes.c_void_p
         self.c_handle = self._lib.mpg123_new(ctypes.c_char_p(None), None)
         self.handle = ctypes.c_void_p(self.c_handle)
-        self.is_feed = filename is None
         self.offset = ctypes.c_size_t(0)
+        self.open(filename)
+
+    def open(self, filename: Optional[str] = None) -> None:
         self.is_feed = filename is None
         if filename is None:
             errcode = self._lib.mpg123_open_feed(self.handle)
@@ -101,16 +121,30 @@ class Mpg123:
             if errcode != OK:
                 raise OpenFileException(self.plain_strerror(errcode))
 
-    def feed(self, data: bytes) -> None:
+    def reset(self) -> None:
+        """
+        ハンドルを閉じて、新しいストリームをfeedできる状態に戻します。
+        """
+        errcode = self._lib.mpg123_close(self.handle)
+        if errcode != OK:
+            raise CloseException(self.plain_strerror(errcode))
+        self.open()
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]) -> None:
         if not self.is_feed:
             raise NotFeedException('instance is not in feed mode')
         # encode string to bytes in modern python
         if sys.version_info[0] >= 3 and isinstance(data, str):
             data = data.encode()
-        data = memoryview(data)
-        errcode = self._lib.mpg123_feed(self.handle,
-                                        ctypes.c_char_p(data.tobytes()),
-                                        len(data))
+        if isinstance(data, bytes):
+            pointer: Any = data
+        else:
+            view = memoryview(data)
+            if view.readonly:
+                pointer = view.tobytes()
+            else:
+                pointer = (ctypes.c_char * view.nbytes).from_buffer(view)
+        errcode = self._lib.mpg123_feed(self.handle, pointer, len(data))
         if errcode != OK:
             raise FeedingException(self.plain_strerror(errcode))
 
@@ -191,9 +225,65 @@ class Mpg123:
                     continue
                 raise DecodeException(self.plain_strerror(errcode))
 
+    def read_into(self, buffer: Union[bytearray, memoryview], new_format_callback: Any = None) -> int:
+        """
+        デコードしたPCMをbufferに直接書き込みます。
+
+        :param buffer: 書き込み先
+        :param new_format_callback: フォーマットが変わったときに呼ばれる関数
+        :return: 書き込んだバイト数。データが足りない場合は0
+        """
+        view = memoryview(buffer)
+        out = (ctypes.c_char * view.nbytes).from_buffer(view)
+        done = ctypes.c_size_t(0)
+        while True:
+            errcode = self._lib.mpg123_read(self.handle, out, view.nbytes, ctypes.pointer(done))
+            if errcode == NEW_FORMAT:
+                if new_format_callback:
+                    new_format_callback(*self.get_format())
+                if done.value:
+                    return done.value
+                continue
+            if errcode in (OK, NEED_MORE, DONE):
+                return done.value
+            raise DecodeException(self.plain_strerror(errcode))
+
     def __del__(self) -> None:
         if not self.handle:
             return
         errcode = self._lib.mpg123_close(self.handle)
+        self._lib.mpg123_delete(self.handle)
         if errcode != OK:
             raise CloseException(self.plain_strerror(errcode))
+
+
+class Mpg123Pool:
+    """
+    feedモードのMpg123を使いまわすためのプールです。
+    """
+    def __init__(self, size: int = 8) -> None:
+        self.size = size
+        self.lock = threading.Lock()
+        self.handles: List[Mpg123] = []
+
+    def acquire(self) -> Mpg123:
+        with self.lock:
+            if self.handles:
+                return self.handles.pop()
+        return Mpg123()
+
+    def release(self, mpg123: Mpg123) -> None:
+        with self.lock:
+            if any(handle is mpg123 for handle in self.handles):
+                # 二度返されたハンドルを二つのソースで同時に使わないようにする
+                return
+        try:
+            mpg123.reset()
+        except CloseException:
+            return
+        with self.lock:
+            if len(self.handles) < self.size and all(handle is not mpg123 for handle in self.handles):
+                self.handles.append(mpg123)
+
+
+pool = Mpg123Pool()
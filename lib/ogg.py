@@ -0,0 +1,241 @@
+"""
+OggコンテナからOpusのパケットを取り出すデマルチプレクサと、OpusのパケットをOggに書き込むマルチプレクサ
+"""
+from typing import BinaryIO, Iterator, List, Tuple, Union, NamedTuple
+import mmap
+import struct
+import zlib
+
+from lib.errors import InvalidAudioFile
+
+PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+CONTINUED = 0x01
+BEGIN = 0x02
+END = 0x04
+MAX_SEGMENTS = 255  # 1ページのセグメントテーブルの最大の長さ
+PAGE_DURATION = 48000  # 1ページに入れる音声の長さの目安(サンプル数)。シークしやすいように1秒ごとにページを分ける
+OPUS_SILENCE = b"\xf8\xff\xfe"  # Discordが送ってくるのと同じ20msの無音のパケット
+SILENCE_SAMPLES = 960
+VENDOR = b"MiniMaid"
+# ビットの順番を反転する表。zlib.crc32(LSBから計算する)でOggのCRC(MSBから計算する)を求めるのに使う
+REVERSE_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+class OpusHead(NamedTuple):
+    channels: int
+    pre_skip: int
+    rate: int
+    mapping_family: int
+
+
+def iter_pages(data: Union[bytes, mmap.mmap], offset: int = 0) -> Iterator[Tuple[int, int, int, int, Tuple[int, ...]]]:
+    """
+    Oggのページを順番に読みます。CRCは確認しません。
+    :param data: Oggファイル
+    :param offset: 読み始める位置
+    :return: ヘッダーの種類, グラニュールポジション, シリアル番号, ボディの位置, セグメントテーブル
+    """
+    while offset + PAGE_HEADER.size <= len(data):
+        capture, version, header_type, granule, serial, _, _, count = PAGE_HEADER.unpack_from(data, offset)
+        if capture != b"OggS" or version != 0:
+            raise InvalidAudioFile()
+        table_start = offset + PAGE_HEADER.size
+        lacing = tuple(data[table_start:table_start + count])
+        body = table_start + count
+        yield header_type, granule, serial, body, lacing
+        offset = body + sum(lacing)
+
+
+def iter_packets(data: Union[bytes, mmap.mmap], offset: int = 0) -> Iterator[bytes]:
+    """
+    最初の論理ストリームのパケットを順番に読みます。
+    :param data: Oggファイル
+    :param offset: 読み始めるページの位置。page_indexで求めた、パケットの途中から始まらないページを指定してください
+    :return: パケットのイテレーター
+    """
+    stream = None
+    packet = bytearray()
+    for header_type, _, serial, body, lacing in iter_pages(data, offset):
+        if stream is None:
+            stream = serial
+        if serial != stream:
+            continue
+        if not header_type & CONTINUED:
+            packet.clear()
+        start = body
+        for size in lacing:
+            packet += data[start:start + size]
+            start += size
+            if size < 255:
+                yield bytes(packet)
+                packet.clear()
+
+
+def page_index(data: Union[bytes, mmap.mmap], skip: int = 0) -> Tuple[List[int], List[int]]:
+    """
+    途中からパケットを読めるように、最初の論理ストリームのページの位置を調べます。ページのヘッダーだけを読みます。
+    :param data: Oggファイル
+    :param skip: 数えないパケットの数。Ogg Opusのヘッダーの2つを除く場合は2
+    :return: パケットの途中から始まらないページの位置と、そのページより前にある空でないパケットの数のリスト
+    """
+    offsets: List[int] = []
+    counts: List[int] = []
+    stream = None
+    index = 0  # 読み終えたパケットの数
+    count = 0  # skipより後ろの空でないパケットの数
+    length = 0
+    for header_type, _, serial, body, lacing in iter_pages(data):
+        if stream is None:
+            stream = serial
+        if serial != stream:
+            continue
+        if not header_type & CONTINUED:
+            length = 0
+            if index >= skip:
+                offsets.append(body - len(lacing) - PAGE_HEADER.size)
+                counts.append(count)
+        for size in lacing:
+            length += size
+            if size < 255:
+                if index >= skip and length:
+                    count += 1
+                index += 1
+                length = 0
+    return offsets, counts
+
+
+def parse_opus_head(packet: bytes) -> OpusHead:
+    """
+    OpusHeadパケットを解析します。
+    :param packet: 最初のパケット
+    :return: OpusHead
+    """
+    if len(packet) < 19 or packet[:8] != b"OpusHead":
+        raise InvalidAudioFile()
+    channels, pre_skip, rate = struct.unpack_from("<BHI", packet, 9)
+    return OpusHead(channels, pre_skip, rate, packet[18])
+
+
+def packet_samples(packet: bytes) -> int:
+    """
+    Opusのパケットの48kHzでのサンプル数をTOCバイトから求めます。
+    :param packet: Opusのパケット
+    :return: サンプル数
+    """
+    if not packet:
+        return 0
+    config = packet[0] >> 3
+    if config < 12:
+        frame = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:
+        frame = (480, 960)[config % 2]
+    else:
+        frame = (120, 240, 480, 960)[config % 4]
+
+    code = packet[0] & 0b11
+    if code == 0:
+        return frame
+    if code in (1, 2):
+        return frame * 2
+    if len(packet) < 2:
+        return 0
+    return frame * (packet[1] & 0x3f)
+
+
+def crc32(data: bytes) -> int:
+    """
+    OggのCRC32(多項式0x04c11db7、初期値0、反転なし)を求めます。
+    ビットの順番を反転すればzlibのCRC32と同じ計算になるので、Pythonで1バイトずつ計算するより速くなります。
+    :param data: ページ
+    :return: CRC
+    """
+    reflected = zlib.crc32(data.translate(REVERSE_BITS), 0xffffffff) ^ 0xffffffff
+    return int(f"{reflected:032b}"[::-1], 2)
+
+
+class OggWriter:
+    """
+    一つの論理ストリームのパケットをOggのページにして書き込みます。
+    """
+    def __init__(self, file: BinaryIO, serial: int) -> None:
+        self.file = file
+        self.serial = serial & 0xffffffff
+        self.sequence = 0
+        self.packets: List[bytes] = []
+        self.lacing: List[int] = []
+        self.granule = 0
+        self.page_start = 0  # 書き込み中のページの最初のグラニュールポジション
+
+    def write_packet(self, packet: bytes, granule: int) -> None:
+        """
+        パケットを追加します。ページがいっぱいになったら書き込みます。
+        :param packet: パケット
+        :param granule: このパケットの終わりのグラニュールポジション
+        """
+        lacing = [255] * (len(packet) // 255) + [len(packet) % 255]
+        if self.packets and (len(self.lacing) + len(lacing) > MAX_SEGMENTS or granule - self.page_start > PAGE_DURATION):
+            self.flush()
+        self.packets.append(packet)
+        self.lacing += lacing
+        self.granule = granule
+
+    def flush(self, header_type: int = 0) -> None:
+        """
+        追加したパケットを1ページとして書き込みます。
+        :param header_type: ページの種類
+        """
+        if not self.packets and not header_type & END:
+            return
+        if self.sequence == 0:
+            header_type |= BEGIN
+        page = bytearray(PAGE_HEADER.pack(
+            b"OggS", 0, header_type, self.granule, self.serial, self.sequence, 0, len(self.lacing)
+        ))
+        page += bytes(self.lacing)
+        for packet in self.packets:
+            page += packet
+        struct.pack_into("<I", page, 22, crc32(bytes(page)))
+        self.file.write(page)
+        self.sequence += 1
+        self.packets = []
+        self.lacing = []
+        self.page_start = self.granule
+
+    def close(self) -> None:
+        self.flush(END)
+
+
+class OggOpusWriter:
+    """
+    Opusのパケットをデコードせずに、RFC 7845のOgg Opusとして書き込みます。
+    グラニュールポジションは書き込んだパケットのサンプル数から求めます。
+    """
+    def __init__(self, file: BinaryIO, serial: int, channels: int = 2, pre_skip: int = 0) -> None:
+        self.ogg = OggWriter(file, serial)
+        self.position = 0  # 書き込んだサンプル数(48kHz)
+        self.ogg.write_packet(b"OpusHead" + struct.pack("<BBHIhB", 1, channels, pre_skip, 48000, 0, 0), 0)
+        self.ogg.flush()
+        self.ogg.write_packet(b"OpusTags" + struct.pack("<I", len(VENDOR)) + VENDOR + struct.pack("<I", 0), 0)
+        self.ogg.flush()
+
+    def write(self, packet: bytes) -> int:
+        """
+        パケットを追加します。
+        :param packet: Opusのパケット
+        :return: パケットのサンプル数
+        """
+        samples = packet_samples(packet)
+        self.position += samples
+        self.ogg.write_packet(packet, self.position)
+        return samples
+
+    def write_silence(self, samples: int) -> None:
+        """
+        samplesサンプルにもっとも近い長さになるように無音のパケットを追加します。
+        :param samples: 無音の長さ
+        """
+        for _ in range((samples + SILENCE_SAMPLES // 2) // SILENCE_SAMPLES):
+            self.write(OPUS_SILENCE)
+
+    def close(self) -> None:
+        self.ogg.close()
@@ -0,0 +1,148 @@
+"""
+話している部分だけを位置と一緒に保存する、疎なPCMのタイムライン
+
+無音の部分はPCMを持たないので、長い無音があってもメモリもミックスの時間も増えません。
+"""
+from typing import List, Sequence, Tuple
+from bisect import bisect_right
+
+import numpy as np
+
+from lib.dsp import CHANNELS, SAMPLING_RATE, soft_clip_add
+
+MIN_GAP = SAMPLING_RATE // 10  # これより短い無音は区間を分けずに0で埋める
+TRIM_PADDING = SAMPLING_RATE // 4  # 無音を詰めるときに話している部分の前後に残す長さ
+
+Segment = Tuple[int, np.ndarray]  # 開始位置, (サンプル数, 2)のfloat32の配列
+
+
+class Timeline:
+    """
+    一人の話者のPCMを区間のリストとして保存します。
+    reserveで確保した配列に直接書き込んでからcommitし、無音はskipで飛ばします。
+    """
+    def __init__(self, min_gap: int = MIN_GAP) -> None:
+        self.min_gap = min_gap
+        self.segments: List[Segment] = []
+        self.offset = 0  # 書き込み中の区間の開始位置
+        self.buffer = np.zeros((0, CHANNELS), dtype=np.float32)
+        self.length = 0  # 書き込み中の区間のサンプル数
+
+    @property
+    def position(self) -> int:
+        return self.offset + self.length
+
+    def reserve(self, count: int) -> np.ndarray:
+        """
+        書き込み中の区間の後ろにcount個分の領域を確保します。足りなくなったら倍の大きさに広げます。
+        """
+        end = self.length + count
+        if end > len(self.buffer):
+            buffer = np.zeros((max(end, len(self.buffer) * 2, SAMPLING_RATE), CHANNELS), dtype=np.float32)
+            buffer[:self.length] = self.buffer[:self.length]
+            self.buffer = buffer
+        return self.buffer[self.length:end]
+
+    def commit(self, count: int) -> None:
+        self.length += count
+
+    def skip(self, count: int) -> None:
+        """
+        count個分の無音を入れます。短い無音は0で埋め、長い無音は区間を分けます。
+        """
+        if count <= 0:
+            return
+        if self.length and count < self.min_gap:
+            self.reserve(count)[:] = 0
+            self.length += count
+            return
+        self.close()
+        self.offset += count
+
+    def close(self) -> None:
+        if self.length:
+            data = self.buffer[:self.length]
+            if len(self.buffer) > self.length * 5 // 4:
+                data = data.copy()  # 余分に確保した領域を手放す
+            self.segments.append((self.offset, data))
+        self.offset += self.length
+        self.buffer = np.zeros((0, CHANNELS), dtype=np.float32)
+        self.length = 0
+
+    def shift(self, count: int) -> None:
+        """
+        全体を後ろにずらします。途中から話し始めた話者の位置を合わせるのに使います。
+        """
+        self.segments = [(offset + count, data) for offset, data in self.segments]
+        self.offset += count
+
+    def spans(self) -> List[Segment]:
+        if not self.length:
+            return list(self.segments)
+        return self.segments + [(self.offset, self.buffer[:self.length])]
+
+
+def speech_ranges(tracks: Sequence[Sequence[Segment]], length: int, padding: int) -> List[Tuple[int, int]]:
+    """
+    どれかの話者が話している範囲を前後にpaddingだけ広げ、重なるものをまとめます。
+    """
+    ranges = sorted(
+        (max(offset - padding, 0), min(offset + len(data) + padding, length))
+        for segments in tracks for offset, data in segments
+    )
+    merged: List[Tuple[int, int]] = []
+    for start, end in ranges:
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def mix_segments(tracks: Sequence[Sequence[Segment]],
+                 length: int,
+                 trim: bool = False,
+                 padding: int = TRIM_PADDING) -> np.ndarray:
+    """
+    区間のリストで表した話者をlib.dsp.mixと同じ式で重ね合わせます。話している部分だけを計算します。
+    :param tracks: 話者ごとの区間のリスト
+    :param length: 出力するサンプル数
+    :param trim: Trueの場合は誰も話していない部分を詰め、話している部分の前後paddingサンプルだけを残します
+    :param padding: 詰めるときに残す長さ
+    :return: (サンプル数, 2)のfloat32の配列
+    """
+    if trim:
+        ranges = speech_ranges(tracks, length, padding)
+    else:
+        ranges = [(0, length)]
+    starts = [start for start, _ in ranges]
+    positions = np.cumsum([0] + [end - start for start, end in ranges])
+    result = np.zeros((int(positions[-1]), CHANNELS), dtype=np.float32)
+
+    for segments in tracks:
+        for offset, data in segments:
+            start, end = max(offset, 0), min(offset + len(data), length)
+            index = bisect_right(starts, start) - 1
+            if end <= start or index < 0:
+                continue
+            # 話している区間は必ず一つの範囲に含まれる
+            output = int(positions[index]) + start - ranges[index][0]
+            soft_clip_add(result[output:output + end - start], data[start - offset:end - offset])
+    return np.clip(result, -1, 1, out=result)
+
+
+def squeeze_silence(pcm: np.ndarray, silent: int, limit: int) -> Tuple[np.ndarray, int]:
+    """
+    録音しながら無音を詰めるために、続いている無音のうちlimitサンプルより後ろを捨てます。
+    長い無音はmix_segmentsでtrimしたときと同じく前後のpaddingを合わせた長さになります。
+    :param pcm: (サンプル数, 2)の配列
+    :param silent: 前回までに続いている無音のサンプル数
+    :param limit: 残す無音の長さ
+    :return: 詰めた配列と、最後に続いている無音のサンプル数
+    """
+    index = np.arange(len(pcm))
+    last = np.maximum.accumulate(np.where(pcm.any(axis=1), index, -silent - 1))
+    keep = index - last <= limit
+    return pcm[keep], len(pcm) - 1 - int(last[-1]) if len(pcm) else silent
@@ -1,16 +1,16 @@
 import asyncio
-import audioop
 import io
-import struct
 import re
 from typing import List, Optional
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 
 import discord
+import numpy as np
 
 from lib.database.models import GuildVoicePreference, UserVoicePreference, VoiceDictionary
 from lib.jtalk import JTalk
+from lib.dsp import to_stereo
 
 english_compiled = re.compile(r"[a-zA-Z]+")
 code_block_compiled = re.compile(r"```(?!.*```)[\s\S]*```")
@@ -44,8 +44,8 @@ class TextToSpeechEngine:
         pcm = self.jtalk.generate_pcm(text)
         if pcm is None:
             raise ValueError("pcm is None")
-        bin_pcm = struct.pack("h" * len(pcm), *pcm)
-        return io.BytesIO(audioop.tostereo(bin_pcm, 2, 1, 1))
+        samples = np.asarray(pcm, dtype="<i2").reshape(-1, 1)
+        return io.BytesIO(to_stereo(samples).tobytes())
 
     def escape_dictionary(self, text: str) -> str:
         for key in self.dictionaries.keys():
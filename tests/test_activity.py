@@ -0,0 +1,41 @@
+import numpy as np
+
+from lib.discord.activity import packet_activity, select_segments, select_speakers, select_tracks
+from lib.discord.journal import JournalPacket
+
+
+def packets(*sizes):
+    return [JournalPacket(1, i, i * 960, 0.0, None if size is None else bytes(size)) for i, size in enumerate(sizes)]
+
+
+def pcm(level, length=960):
+    return np.full((length, 2), level, dtype=np.float32)
+
+
+def test_packet_activity_ignores_silence():
+    # 無音のパケットと復号できなかったパケットは数えない
+    assert packet_activity(packets(100, 3, None, 50)) == 150
+
+
+def test_select_speakers_by_bytes():
+    groups = {1: packets(20), 2: packets(200, 3, 3), 3: packets(80, 80), 4: packets(3, 3, 3, 3)}
+    assert select_speakers(groups, limit=2) == [2, 3]
+    assert select_speakers(groups, limit=4) == [1, 2, 3, 4]
+
+
+def test_select_tracks_by_energy_keeps_order():
+    tracks = [pcm(0.1), pcm(0.5, length=100), pcm(0.2), pcm(0.05, length=96000)]
+    selected = select_tracks(tracks, limit=2)
+    # 長さも含めたエネルギーで選び、元の順番は変えない
+    assert [id(track) for track in selected] == [id(tracks[2]), id(tracks[3])]
+    assert select_tracks(tracks, limit=4) is tracks
+
+
+def test_select_segments_sums_segments():
+    tracks = [
+        [(0, pcm(0.3))],
+        [(0, pcm(0.2)), (48000, pcm(0.2)), (96000, pcm(0.2))],
+        [(0, pcm(0.1))],
+    ]
+    selected = select_segments(tracks, limit=2)
+    assert [id(segments) for segments in selected] == [id(tracks[0]), id(tracks[1])]
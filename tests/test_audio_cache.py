@@ -0,0 +1,77 @@
+import os
+
+from lib.audio_cache import AudioCache
+
+
+def put(cache, url, data, content_hash="hash", kind="pcm"):
+    writer = cache.writer(url, kind)
+    writer.write(data)
+    writer.commit(content_hash)
+
+
+def cache_files(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_evicts_least_recently_used_over_budget(tmp_path):
+    cache = AudioCache(str(tmp_path), max_size=250)
+    put(cache, "a", b"a" * 100)
+    put(cache, "b", b"b" * 100)
+    # 開いたものは最後に使われたものとして残る
+    cache.open("a").close()
+    put(cache, "c", b"c" * 100)
+    assert cache.contains("a")
+    assert not cache.contains("b")
+    assert cache.contains("c")
+    assert cache.size == 200
+    assert len(cache_files(str(tmp_path))) == 2
+
+
+def test_load_restores_order_from_mtime(tmp_path):
+    cache = AudioCache(str(tmp_path))
+    put(cache, "old", b"o" * 100)
+    put(cache, "new", b"n" * 100)
+    old, _ = cache.entries[next(iter(cache.entries))]
+    new, _ = cache.entries[next(reversed(cache.entries))]
+    os.utime(old, (1000, 1000))
+    os.utime(new, (2000, 2000))
+
+    reloaded = AudioCache(str(tmp_path), max_size=150)
+    assert not reloaded.contains("old")
+    assert reloaded.contains("new")
+    assert reloaded.size == 100
+    assert not os.path.exists(old)
+
+
+def test_changed_content_replaces_entry(tmp_path):
+    cache = AudioCache(str(tmp_path))
+    put(cache, "a", b"1" * 10, content_hash="first")
+    put(cache, "a", b"2" * 20, content_hash="second")
+    assert cache.size == 20
+    assert len(cache_files(str(tmp_path))) == 1
+    with cache.open("a") as file:
+        assert file.read() == b"2" * 20
+
+    put(cache, "a", b"3" * 30, content_hash="second", kind="opus")
+    cache.invalidate("a")
+    assert not cache.contains("a")
+    assert not cache.contains("a", "opus")
+    assert cache.size == 0
+    assert cache_files(str(tmp_path)) == []
+
+
+def test_aborted_writer_leaves_nothing(tmp_path):
+    cache = AudioCache(str(tmp_path))
+    writer = cache.writer("a")
+    writer.write(b"partial")
+    writer.abort()
+    writer.commit("hash")  # 中断したあとは登録されない
+    assert not cache.contains("a")
+    assert cache_files(str(tmp_path)) == []
+
+    # 書き込み中に落ちて残った一時ファイルは次に開いたときに消す
+    writer = cache.writer("b")
+    writer.write(b"partial")
+    writer.file.close()
+    AudioCache(str(tmp_path))
+    assert not [name for name in cache_files(str(tmp_path)) if name.endswith(".tmp")]
@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from lib.audio import FRAME_SIZE
+from lib.audio_queue import AudioQueue, MAX_QUEUE_SIZE, Track
+from lib.errors import AudioFileTooLarge, AudioLoadFailed
+
+SILENCE = b"\0" * FRAME_SIZE
+
+
+def frame(name, index):
+    return f"{name}{index}".encode().ljust(FRAME_SIZE, b"\0")
+
+
+class FakeFile:
+    def __init__(self, name, frames=3, error=None):
+        self.filename = name
+        self.url = f"https://example.com/{name}"
+        self.frames = frames
+        self.error = error
+
+
+class FakeSource:
+    def __init__(self, file):
+        self.name = file.filename
+        self.frames = [frame(file.filename, i) for i in range(file.frames)]
+        self.cleaned = False
+
+    def prefetch(self, size):
+        pass
+
+    def read(self):
+        return self.frames.pop(0) if self.frames else b""
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.cleaned = True
+
+
+class FakeEngine:
+    def __init__(self, loop):
+        self.loop = loop
+        self.executor = None
+        self.sources = {}
+
+    async def create_source(self, file, cache=False, gain=None):
+        if file.error is not None:
+            raise file.error
+        source = self.sources[file.filename] = FakeSource(file)
+        return source
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+class FakeContext:
+    def __init__(self):
+        self.started = []
+        self.errors = []
+
+
+@pytest.fixture
+def ctx():
+    return FakeContext()
+
+
+@pytest.fixture
+def queue(loop, ctx):
+    queue = AudioQueue(FakeEngine(loop), on_start, on_error)
+    queue.ctx = ctx
+    return queue
+
+
+async def on_start(track):
+    track.ctx.started.append(track.filename)
+
+
+async def on_error(track, error):
+    track.ctx.errors.append((track.filename, error))
+
+
+def settle(loop):
+    # 曲の準備とcall_soon_threadsafeで登録したコールバックを終わらせる
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+
+def add(queue, file):
+    return queue.add(Track(file, False, queue.ctx))
+
+
+def test_plays_next_track_without_gap(queue, loop):
+    add(queue, FakeFile("a", frames=2))
+    add(queue, FakeFile("b"))
+    assert queue.read() == SILENCE  # 準備ができるまでは無音
+    settle(loop)
+    assert queue.read() == frame("a", 0)
+    settle(loop)
+    assert queue.read() == frame("a", 1)
+    # 曲の終わりと次の曲の最初のフレームが同じreadで切り替わる
+    assert queue.read() == frame("b", 0)
+    assert queue.engine.sources["a"].cleaned
+    settle(loop)
+    assert queue.ctx.started == ["a", "b"]
+
+
+def test_skip(queue, loop):
+    assert not queue.skip()
+    add(queue, FakeFile("a"))
+    add(queue, FakeFile("b"))
+    settle(loop)
+    assert queue.read() == frame("a", 0)
+    settle(loop)
+    assert queue.skip()
+    assert queue.read() == frame("b", 0)
+    assert queue.engine.sources["a"].cleaned
+    assert queue.read() == frame("b", 1)
+
+
+def test_failed_track_is_reported_and_removed(queue, loop):
+    add(queue, FakeFile("broken", error=OSError("connection reset")))
+    add(queue, FakeFile("too_large", error=AudioFileTooLarge()))
+    add(queue, FakeFile("a"))
+    settle(loop)
+    names = [name for name, _ in queue.ctx.errors]
+    assert names == ["broken", "too_large"]
+    assert isinstance(queue.ctx.errors[0][1], AudioLoadFailed)
+    assert isinstance(queue.ctx.errors[1][1], AudioFileTooLarge)
+    assert [track.filename for track in queue.items()] == ["a"]
+    assert queue.read() == frame("a", 0)
+
+
+def test_finishes_after_last_track(queue, loop):
+    add(queue, FakeFile("a", frames=1))
+    settle(loop)
+    assert queue.read() == frame("a", 0)
+    assert queue.read() == b""
+    assert queue.is_finished
+    assert not add(queue, FakeFile("b"))
+
+
+def test_is_full(queue, loop):
+    for i in range(MAX_QUEUE_SIZE):
+        assert not queue.is_full
+        add(queue, FakeFile(str(i)))
+    assert queue.is_full
+    settle(loop)
+    queue.read()
+    # 再生中の曲も数に含める
+    assert len(queue) == MAX_QUEUE_SIZE
+    assert queue.is_full
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from lib.dsp import LoudnessMeter, Resampler, loudness_gain, to_float, to_int16, to_stereo, convert, mix
+
+
+def sine(rate: int, seconds: float = 0.5, frequency: int = 1000) -> np.ndarray:
+    t = np.arange(int(rate * seconds)) / rate
+    return np.sin(2 * np.pi * frequency * t).astype(np.float32)[:, None]
+
+
+def test_to_float_widths():
+    assert to_float(b"\x00\x80", 2, 1)[0, 0] == -1
+    assert to_float(b"\x80", 1, 1)[0, 0] == 0
+    assert to_float(b"\x00\x00\x80", 3, 1)[0, 0] == -1
+    assert to_float(b"\xff\xff\xff\x7f", 4, 2).shape == (0, 2)
+
+
+def test_to_stereo():
+    mono = np.array([[1], [2]], dtype=np.float32)
+    assert to_stereo(mono).tolist() == [[1, 1], [2, 2]]
+    surround = np.array([[1, 3, 3, 5]], dtype=np.float32)
+    assert to_stereo(surround).tolist() == [[2, 4]]
+
+
+def test_resample_length_and_accuracy():
+    for rate in (44100, 22050, 16000):
+        resampler = Resampler(rate, 1)
+        result = np.concatenate([resampler.process(sine(rate)), resampler.flush()])
+        assert len(result) == 24000
+        reference = sine(48000)
+        assert np.abs(result[100:-100] - reference[100:-100]).max() < 1e-3
+
+
+def test_resample_streaming_matches_one_shot():
+    data = sine(44100)
+    one_shot = Resampler(44100, 1)
+    expected = np.concatenate([one_shot.process(data), one_shot.flush()])
+    streaming = Resampler(44100, 1)
+    blocks = [streaming.process(data[i:i + 1152]) for i in range(0, len(data), 1152)]
+    result = np.concatenate(blocks + [streaming.flush()])
+    assert np.allclose(result, expected, atol=1e-6)
+
+
+def test_convert_passthrough():
+    pcm = to_int16(np.array([[0.5, -0.5], [0.25, -0.25]], dtype=np.float32))
+    assert convert(pcm, 48000, 2, 2) == pcm
+
+
+def test_mix_matches_soft_clip_law():
+    tracks = [[0.5, -0.5, 0.5, 0.75], [0.5, -0.5, -0.25], [0.5]]
+    # 0.5, 0.5 -> 0.75, 0.75 + 0.5 -> 0.875
+    assert mix(tracks).tolist() == [0.875, -0.75, 0.25, 0.75]
+    assert mix([[1.5], [-3.0, 0.5]]).tolist() == [-1.0, 0.5]
+    assert mix([]).shape == (0,)
+
+
+def test_mix_skips_silent_blocks():
+    rng = np.random.default_rng(0)
+    tracks = []
+    for length in (4800, 3000, 4801):
+        track = rng.uniform(-1, 1, (length, 2)).astype(np.float32)
+        track[960:2880] = 0
+        tracks.append(track)
+    assert np.array_equal(mix(tracks, block=960), mix(tracks, block=10 ** 6))
+
+
+def test_loudness_of_reference_sine():
+    # EBU Tech 3341: 両チャンネルに-23dBFSの1kHzの正弦波を入れると-23LUFS
+    tone = sine(48000, seconds=3) * 10 ** (-23 / 20)
+    meter = LoudnessMeter()
+    stereo = np.hstack([tone, tone])
+    for start in range(0, len(stereo), 960):
+        meter.process(stereo[start:start + 960])
+    assert meter.integrated() == pytest.approx(-23, abs=0.1)
+
+    meter = LoudnessMeter()
+    meter.process(np.hstack([tone, np.zeros_like(tone)]))
+    assert meter.integrated() == pytest.approx(-26, abs=0.1)
+
+
+def test_loudness_of_silence_and_short_input():
+    meter = LoudnessMeter()
+    meter.process(np.zeros((48000 * 2, 2), dtype=np.float32))
+    assert meter.integrated() is None
+    meter = LoudnessMeter()
+    meter.process(np.hstack([sine(48000, seconds=0.3)] * 2))
+    assert meter.integrated() is None  # 400msのブロックに足りない
+
+
+def test_loudness_gain():
+    assert loudness_gain(-18, target=-18) == pytest.approx(1)
+    assert loudness_gain(-12, target=-18) == pytest.approx(0.5, rel=0.01)
+    assert loudness_gain(-60, target=-18, max_gain=4) == 4
+    assert loudness_gain(None) == 1
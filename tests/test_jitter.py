@@ -0,0 +1,44 @@
+from lib.discord.jitter import JitterBuffer
+
+
+class Packet:
+    def __init__(self, seq: int) -> None:
+        self.seq = seq
+
+
+def drain(buffer: JitterBuffer, flush: bool = True) -> list:
+    result = []
+    while True:
+        item = buffer.pop(flush)
+        if item is None:
+            return result
+        result.append((item[0], item[1] and item[1].seq))
+
+
+def test_reorder_across_wraparound():
+    buffer = JitterBuffer()
+    for seq in (65534, 0, 65535, 1):
+        assert buffer.push(Packet(seq))
+    assert drain(buffer) == [(65534, 65534), (65535, 65535), (65536, 0), (65537, 1)]
+
+
+def test_duplicates_and_late_packets_are_dropped():
+    buffer = JitterBuffer()
+    assert buffer.push(Packet(10))
+    assert not buffer.push(Packet(10))
+    assert drain(buffer) == [(10, 10)]
+    assert not buffer.push(Packet(9))
+    assert buffer.push(Packet(11))
+
+
+def test_loss_waits_for_window_and_conceals():
+    buffer = JitterBuffer(window=2, max_conceal=2)
+    for seq in (1, 4):
+        buffer.push(Packet(seq))
+    assert drain(buffer, flush=False) == [(1, 1)]
+    buffer.push(Packet(5))
+    buffer.push(Packet(6))
+    # 2と3は欠落として返し、2パケットを超える欠落は飛ばす
+    assert drain(buffer, flush=False) == [(2, None), (3, None), (4, 4), (5, 5), (6, 6)]
+    buffer.push(Packet(20))
+    assert drain(buffer) == [(7, None), (8, None), (20, 20)]
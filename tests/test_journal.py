@@ -0,0 +1,43 @@
+import os
+
+from lib.discord.journal import JournalPacket, JournalSpeaker, PacketJournal, read_journal
+
+
+def write_records(path):
+    journal = PacketJournal(path)
+    journal.write_speaker(1, 1234567890123)
+    journal.write_packet(JournalPacket(1, 10, 960, 100.0, b"\xf8\xff\xfe"))
+    journal.write_packet(JournalPacket(2, 11, 1920, 100.5, None))  # 復号できなかったパケット
+    journal.write_packet(JournalPacket(1, 12, 2880, 101.0, b"opus" * 10))
+    journal.close()
+
+
+def test_read_journal_round_trip(tmp_path):
+    path = str(tmp_path / "a.journal")
+    write_records(path)
+    assert list(read_journal(path)) == [
+        JournalSpeaker(1, 1234567890123),
+        JournalPacket(1, 10, 960, 100.0, b"\xf8\xff\xfe"),
+        JournalPacket(2, 11, 1920, 100.5, None),
+        JournalPacket(1, 12, 2880, 101.0, b"opus" * 10),
+    ]
+
+
+def test_read_journal_stops_at_truncated_record(tmp_path):
+    path = str(tmp_path / "a.journal")
+    write_records(path)
+    size = os.path.getsize(path)
+    # 最後のレコードのデータの途中で落ちた場合
+    os.truncate(path, size - 5)
+    records = list(read_journal(path))
+    assert records[0] == JournalSpeaker(1, 1234567890123)
+    assert records[-1] == JournalPacket(2, 11, 1920, 100.5, None)
+    # ヘッダーの途中で落ちた場合
+    os.truncate(path, size - 40 - 3)
+    assert len(list(read_journal(path))) == 3
+
+
+def test_read_journal_ignores_other_files(tmp_path):
+    path = tmp_path / "a.journal"
+    path.write_bytes(b"not a journal")
+    assert list(read_journal(str(path))) == []
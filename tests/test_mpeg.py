@@ -0,0 +1,56 @@
+import pytest
+
+from lib.mpeg import FrameIndex, id3_size, parse_header
+
+HEADER = bytes([0xff, 0xfb, 0x94, 0x00])  # MPEG1 Layer3 128kbps 48kHz
+FRAME_LENGTH = 384
+
+
+def id3_tag(size):
+    return b"ID3\x04\x00\x00" + bytes([0, 0, size >> 7, size & 0x7f]) + bytes(size)
+
+
+def frames(count):
+    return HEADER.ljust(FRAME_LENGTH, b"\0") * count
+
+
+def feed_chunks(index, data, chunk):
+    for i in range(0, len(data), chunk):
+        index.feed(data[i:i + chunk])
+
+
+def test_parse_header():
+    assert parse_header(HEADER) == (FRAME_LENGTH, 48000, 1152)
+    # パディングがあるフレーム
+    assert parse_header(bytes([0xff, 0xfb, 0x96, 0x00])) == (FRAME_LENGTH + 1, 48000, 1152)
+    # MPEG2 Layer3 80kbps 24kHz
+    assert parse_header(bytes([0xff, 0xf3, 0x94, 0x00])) == (240, 24000, 576)
+    assert parse_header(b"\0\0\0\0") is None
+    assert parse_header(bytes([0xff, 0xfb, 0xf4, 0x00])) is None  # 使えないビットレート
+
+
+def test_id3_size():
+    assert id3_size(id3_tag(200)) == 210
+    assert id3_size(frames(1)) == 0
+
+
+@pytest.mark.parametrize("chunk", [3, 7, 100, 10000])
+def test_frame_offsets_across_chunks(chunk):
+    tag = id3_tag(300)
+    index = FrameIndex()
+    feed_chunks(index, tag + frames(20), chunk)
+    assert list(index.offsets) == [len(tag) + FRAME_LENGTH * i for i in range(20)]
+    assert index.rate == 48000
+    assert index.duration == pytest.approx(20 * 1152 / 48000)
+
+
+def test_frame_at_and_offset():
+    index = FrameIndex()
+    assert index.frame_at(1.0) == 0  # 形式がわかるまでは先頭
+    index.feed(frames(10))
+    frame = index.frame_at(0.1)
+    assert frame == 4
+    assert index.offset(frame) == FRAME_LENGTH * 4
+    assert index.offset(10) is None  # まだ届いていない位置
+    index.feed(frames(1))
+    assert index.offset(10) == FRAME_LENGTH * 10
@@ -0,0 +1,104 @@
+from io import BytesIO
+import struct
+
+import pytest
+
+from lib.errors import InvalidAudioFile
+from lib.ogg import (
+    BEGIN, END, OPUS_SILENCE, OggOpusWriter, crc32, iter_packets, iter_pages, page_index, parse_opus_head,
+    packet_samples
+)
+
+
+def page(packets, sequence, header_type=0, serial=1):
+    lacing = []
+    for packet in packets:
+        lacing += [255] * (len(packet) // 255) + [len(packet) % 255]
+    header = struct.pack("<4sBBqIIIB", b"OggS", 0, header_type, 0, serial, sequence, 0, len(lacing))
+    return header + bytes(lacing) + b"".join(packets)
+
+
+def test_iter_packets_joins_segments_and_pages():
+    large = bytes(range(100)) * 3
+    first = struct.pack("<4sBBqIIIB", b"OggS", 0, 2, 0, 1, 0, 0, 1) + b"\xff" + large[:255]
+    data = first
+    data += page([b"x"], 0, serial=2)  # 別の論理ストリームは無視する
+    data += page([large[255:], b"b"], 1, header_type=1)
+    assert list(iter_packets(data)) == [large, b"b"]
+    assert list(iter_packets(page([b"a" * 255, b""], 0))) == [b"a" * 255, b""]
+
+
+def test_parse_opus_head():
+    head = parse_opus_head(b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 312, 44100, 0, 0))
+    assert (head.channels, head.pre_skip, head.rate, head.mapping_family) == (2, 312, 44100, 0)
+    with pytest.raises(InvalidAudioFile):
+        parse_opus_head(b"OggS")
+
+
+def test_packet_samples():
+    assert packet_samples(bytes([31 << 3])) == 960  # CELT 20ms
+    assert packet_samples(bytes([1 << 3])) == 960  # SILK 20ms
+    assert packet_samples(bytes([16 << 3 | 1])) == 240  # CELT 2.5ms x2
+    assert packet_samples(bytes([31 << 3 | 3, 3])) == 2880
+
+
+def reference_crc(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1) & 0xffffffff
+    return crc
+
+
+def test_ogg_opus_writer_round_trip():
+    file = BytesIO()
+    writer = OggOpusWriter(file, 1234)
+    packets = [bytes([31 << 3]) + bytes([i]) * 80 for i in range(120)]
+    writer.write_silence(1000)  # 20msにまとめる
+    for packet in packets:
+        writer.write(packet)
+    writer.close()
+    data = file.getvalue()
+
+    read = list(iter_packets(data))
+    assert parse_opus_head(read[0]).channels == 2
+    assert read[1].startswith(b"OpusTags")
+    assert read[2:] == [OPUS_SILENCE] + packets
+    pages = list(iter_pages(data))
+    assert pages[0][0] & BEGIN and pages[-1][0] & END
+    assert pages[-1][1] == 121 * 960
+    # 1秒ごとにページを分け、CRCはOggの定義と一致する
+    assert all(granule <= 48000 * (i - 1) for i, (_, granule, _, _, _) in enumerate(pages) if i >= 2)
+    offset = 0
+    for _, _, _, body, lacing in pages:
+        end = body + sum(lacing)
+        page = bytearray(data[offset:end])
+        crc = struct.unpack_from("<I", page, 22)[0]
+        page[22:26] = bytes(4)
+        assert crc32(bytes(page)) == crc == reference_crc(page)
+        offset = end
+
+
+def test_page_index_reads_from_the_middle():
+    file = BytesIO()
+    writer = OggOpusWriter(file, 1)
+    packets = [bytes([31 << 3]) + bytes([i % 256]) * (i % 300) for i in range(400)]
+    for packet in packets:
+        writer.write(packet)
+    writer.close()
+    data = file.getvalue()
+
+    offsets, counts = page_index(data, skip=2)
+    assert len(offsets) > 2 and counts[0] == 0
+    for offset, count in zip(offsets, counts):
+        assert list(iter_packets(data, offset)) == packets[count:]
+
+    # パケットの続きから始まるページからは読み始めない
+    large = bytes(range(100)) * 3
+    split = struct.pack("<4sBBqIIIB", b"OggS", 0, 0, 0, 1, 2, 0, 2) + b"\x01\xff" + b"a" + large[:255]
+    data = page([b"OpusHead"], 0, header_type=2) + page([b"OpusTags"], 1) + split
+    data += page([large[255:], b"b"], 3, header_type=1) + page([b"", b"c"], 4)
+    offsets, counts = page_index(data, skip=2)
+    assert counts == [0, 3]
+    assert list(iter_packets(data, offsets[1])) == [b"", b"c"]
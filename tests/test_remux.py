@@ -0,0 +1,55 @@
+from lib.discord.journal import JournalPacket
+from lib.discord.remux import remux, remux_speaker
+from lib.ogg import OPUS_SILENCE, iter_packets
+
+
+def opus(index):
+    return bytes([31 << 3]) + bytes([index]) * 20  # CELT 20ms
+
+
+def packet(timestamp, real_time, index, ssrc=1):
+    return JournalPacket(ssrc, index, timestamp % 2 ** 32, real_time, opus(index))
+
+
+def audio_packets(file):
+    # OpusHeadとOpusTagsを除く
+    return list(iter_packets(file.getvalue()))[2:]
+
+
+def test_fills_gaps_and_start_with_silence():
+    packets = [
+        packet(1000, 100.1, 1),
+        packet(1960, 100.12, 2),
+        packet(1960, 100.12, 2),  # 重複して届いたパケット
+        JournalPacket(1, 3, 2920, 100.14, None),  # 復号できなかったパケット
+        packet(1000 + 960 * 5, 100.2, 3),
+    ]
+    file = remux_speaker(packets, origin=100.0)
+    assert file is not None
+    silence = [OPUS_SILENCE]
+    # 100.0から話し始めるまでの0.1秒と、タイムスタンプが飛んでいる3パケット分を無音で埋める
+    assert audio_packets(file) == silence * 5 + [opus(1), opus(2)] + silence * 3 + [opus(3)]
+
+
+def test_orders_across_timestamp_wraparound():
+    packets = [
+        packet(0, 100.0, 2),
+        packet(-960, 100.02, 1),  # 先に送られて遅れて届いたパケット
+        packet(960, 100.04, 3),
+    ]
+    file = remux_speaker(packets, origin=100.0)
+    assert file is not None
+    assert audio_packets(file) == [opus(1), opus(2), opus(3)]
+
+
+def test_remux_aligns_speakers_to_common_origin():
+    packets = [
+        packet(5000, 100.0, 1, ssrc=1),
+        packet(7000, 100.5, 2, ssrc=2),
+        JournalPacket(3, 1, 0, 100.0, None),
+    ]
+    files = dict(remux(packets))
+    assert set(files) == {1, 2}
+    assert audio_packets(files[1]) == [opus(1)]
+    assert audio_packets(files[2]) == [OPUS_SILENCE] * 25 + [opus(2)]
+    assert remux_speaker([], origin=100.0) is None
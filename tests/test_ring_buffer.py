@@ -0,0 +1,33 @@
+from lib.discord.ring_buffer import RingBuffer
+
+
+def test_snapshot_does_not_consume():
+    buffer = RingBuffer(max_age=30, budget=1024)
+    for i in range(10):
+        buffer.append(i % 2, 100.0 + i, bytes([i]) * 4)
+    first = buffer.snapshot(105.0)
+    assert [(ssrc, t) for ssrc, t, _ in first] == [(0, 106.0), (0, 108.0), (1, 105.0), (1, 107.0), (1, 109.0)]
+    assert first[0][2] == b"\x06" * 4
+    assert buffer.snapshot(105.0) == first
+    assert len(buffer.snapshot(0)) == 10
+
+
+def test_expire_by_age():
+    buffer = RingBuffer(max_age=5, budget=1024)
+    for i in range(2000):
+        buffer.append(1, i / 100, bytes([i % 256]))
+    # 1秒ごとに5秒より古いパケットを捨てる
+    assert buffer.snapshot(0)[0][1] == 14.0
+    assert buffer.snapshot(19.5)[0][2] == bytes([1950 % 256])
+    assert buffer.size == len(buffer.snapshot(0))
+
+
+def test_expire_by_budget():
+    buffer = RingBuffer(max_age=100, budget=40)
+    for i in range(20):
+        buffer.append(1, float(i), b"x" * 4)
+    assert [t for _, t, _ in buffer.snapshot(0)] == [float(i) for i in range(10, 20)]
+    buffer.append(2, 20.0, b"y" * 8)
+    # 上限を超えた分は全体で最も古いパケットから捨てる
+    assert buffer.size == 40
+    assert buffer.snapshot(0)[0][1] == 12.0
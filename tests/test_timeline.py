@@ -0,0 +1,53 @@
+import numpy as np
+
+from lib.dsp import mix
+from lib.timeline import Timeline, mix_segments, squeeze_silence
+
+
+def fill(timeline: Timeline, count: int, value: float) -> None:
+    timeline.reserve(count)[:] = value
+    timeline.commit(count)
+
+
+def test_timeline_splits_long_gaps():
+    timeline = Timeline(min_gap=10)
+    fill(timeline, 5, 0.5)
+    timeline.skip(3)
+    fill(timeline, 2, 0.25)
+    timeline.skip(100)
+    fill(timeline, 4, 0.125)
+    timeline.shift(7)
+    spans = timeline.spans()
+    assert [(offset, len(data)) for offset, data in spans] == [(7, 10), (117, 4)]
+    assert spans[0][1][4:9, 0].tolist() == [0.5, 0, 0, 0, 0.25]
+    assert timeline.position == 121
+
+
+def test_mix_segments_matches_dense_mix():
+    rng = np.random.default_rng(0)
+    tracks = [[(0, rng.uniform(-1, 1, (50, 2)).astype(np.float32))],
+              [(30, rng.uniform(-1, 1, (40, 2)).astype(np.float32)), (200, rng.uniform(-1, 1, (10, 2)).astype(np.float32))]]
+    dense = []
+    for segments in tracks:
+        track = np.zeros((250, 2), dtype=np.float32)
+        for offset, data in segments:
+            track[offset:offset + len(data)] = data
+        dense.append(track)
+    assert np.allclose(mix_segments(tracks, 250), mix(dense))
+
+    trimmed = mix_segments(tracks, 250, trim=True, padding=5)
+    # 0-75と195-215の範囲だけが残る
+    assert len(trimmed) == 75 + 20
+    assert np.allclose(trimmed[:75], mix(dense)[:75])
+    assert np.allclose(trimmed[75:], mix(dense)[195:215])
+
+
+def test_squeeze_silence_carries_runs_across_calls():
+    pcm = np.zeros((10, 2), dtype=np.float32)
+    pcm[2] = 0.5
+    squeezed, silent = squeeze_silence(pcm, 3, 4)
+    # 前回からの無音は残り1サンプル、音のあとは4サンプルだけ残る
+    assert len(squeezed) == 1 + 1 + 4
+    assert silent == 7
+    squeezed, silent = squeeze_silence(pcm[:5] * 0, silent, 4)
+    assert len(squeezed) == 0 and silent == 12